@@ -213,4 +213,30 @@ def setup():
     TinyPerson.clear_agents()
     TinyWorld.clear_environments()
 
-    yield
\ No newline at end of file
+    yield
+
+@pytest.fixture(scope="function")
+def mock_backend():
+    """
+    Makes the client use the offline mock backend during the test, and yields the client. Afterwards, the client is 
+    restored as it was, without creating its previous backend again, so no credentials are ever needed.
+    """
+    existing_client = openai_utils.LLMProvider._instance
+    previous_api_type = openai_utils.default["api_type"]
+    if existing_client is not None:
+        previous_state = dict(existing_client.__dict__)
+        previous_limit = existing_client._limiter.limit
+
+    openai_utils.force_api_type("mock")
+    try:
+        yield openai_utils.client()
+    finally:
+        openai_utils.default["api_type"] = previous_api_type
+        if existing_client is None:
+            # the client was created for the test, so the next one is created anew, as configured
+            openai_utils.LLMProvider._instance = None
+            openai_utils._llm_provider_instance = None
+        else:
+            existing_client.__dict__.clear()
+            existing_client.__dict__.update(previous_state)
+            existing_client._limiter.set_limit(previous_limit)
@@ -0,0 +1,899 @@
+import pytest
+import json
+import asyncio
+import threading
+import concurrent.futures
+import time
+import types
+
+import sys
+sys.path.insert(0, '../../tinytroupe/') # ensures that the package is imported from the parent directory, not the Python installation
+sys.path.insert(0, '../../') # ensures that the package is imported from the parent directory, not the Python installation
+sys.path.insert(0, '..') # ensures that the package is imported from the parent directory, not the Python installation
+
+from testing_utils import *
+
+from tinytroupe import openai_utils
+import tinytroupe.utils as utils
+from tinytroupe.openai_utils import ConcurrencyLimiter, AdaptiveConcurrency, SingleFlight, LLMResponseCache, RetryPolicy, TokenBucket, CircuitBreaker, CircuitOpenError, MockBackend, GeminiBackend, PooledBackend, Endpoint, NoHealthyEndpointError, LLMBackendResponse, compile_response_schema, LLMRequest, LLMBatcher, LocalBatchBackend, LLMBatchError
+from tinytroupe.agent import CognitiveActionModel
+from pydantic import BaseModel
+from typing import Optional
+import enum
+
+
+def test_concurrency_limiter_caps_threads():
+    limiter = ConcurrencyLimiter(2)
+    max_seen = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal max_seen
+        limiter.acquire()
+        try:
+            with lock:
+                max_seen = max(max_seen, limiter.in_flight)
+            time.sleep(0.05)
+        finally:
+            limiter.release()
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert max_seen == 2, "At most 2 requests should have been in flight at the same time."
+    assert limiter.in_flight == 0, "All slots should have been given back."
+
+
+def test_concurrency_limiter_caps_async_tasks():
+    limiter = ConcurrencyLimiter(3)
+    max_seen = 0
+
+    async def work():
+        nonlocal max_seen
+        await limiter.acquire_async()
+        try:
+            max_seen = max(max_seen, limiter.in_flight)
+            await asyncio.sleep(0.02)
+        finally:
+            limiter.release()
+
+    async def main():
+        await asyncio.gather(*[work() for _ in range(10)])
+
+    asyncio.run(main())
+
+    assert max_seen == 3, "At most 3 requests should have been in flight at the same time."
+    assert limiter.in_flight == 0, "All slots should have been given back."
+
+
+def test_concurrency_limiter_cancelled_waiter_does_not_leak():
+    limiter = ConcurrencyLimiter(1)
+
+    async def main():
+        await limiter.acquire_async()
+        waiter = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        limiter.release()
+
+    asyncio.run(main())
+
+    assert limiter.in_flight == 0, "A cancelled waiter must not keep a slot."
+
+
+def test_concurrency_limiter_serves_interactive_requests_first():
+    limiter = ConcurrencyLimiter(1)
+    limiter.acquire()
+    order = []
+
+    def request(priority):
+        limiter.acquire(priority)
+        order.append(priority)
+        time.sleep(0.01)
+        limiter.release()
+
+    async def async_request(priority):
+        await limiter.acquire_async(priority)
+        order.append(f"async {priority}")
+        limiter.release()
+
+    threads = [threading.Thread(target=request, args=("background",)),
+               threading.Thread(target=asyncio.run, args=(async_request("background"),)),
+               threading.Thread(target=request, args=("interactive",)),
+               threading.Thread(target=asyncio.run, args=(async_request("interactive"),))]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+
+    limiter.release()
+    for thread in threads:
+        thread.join(5)
+
+    assert set(order[:2]) == {"interactive", "async interactive"}
+    assert set(order[2:]) == {"background", "async background"}
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_concurrency_aimd():
+    limiter = ConcurrencyLimiter(4)
+    changes = []
+    controller = AdaptiveConcurrency(limiter, min_limit=1, max_limit=6, on_change=lambda limit, reason: changes.append((limit, reason)))
+
+    # successes while the limit is fully used raise it by one per round of calls, up to the maximum
+    for _ in range(4 + 5 + 6 + 10):
+        controller.record_success(0.1, in_flight=limiter.limit)
+    assert changes == [(5, "increase"), (6, "increase")]
+
+    # successes with spare capacity don't
+    controller.record_success(0.1, in_flight=1)
+    assert limiter.limit == 6
+
+    # a burst of throttling errors is a single signal
+    for _ in range(5):
+        controller.record_failure(openai_utils.MockThrottlingError())
+    assert limiter.limit == 3
+
+    # and so is a latency surge
+    time.sleep(0.7)
+    controller.record_success(5.0, in_flight=1)
+    assert changes[-1] == (1, "latency")
+
+
+def test_response_cache_roundtrip_and_counters(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite"))
+
+    messages = [{"role": "user", "content": "Hello!"}]
+    key = LLMResponseCache.compute_key(messages, "some-model", {"temperature": 0.5, "top_p": None}, None)
+
+    # the key must not depend on parameter order or on unset parameters
+    assert key == LLMResponseCache.compute_key(messages, "some-model", {"temperature": 0.5}, None)
+    assert key != LLMResponseCache.compute_key(messages, "some-model", {"temperature": 0.7}, None)
+    assert key != LLMResponseCache.compute_key(messages, "other-model", {"temperature": 0.5}, None)
+
+    assert cache.get(key) is None
+    cache.put(key, {"role": "assistant", "content": "Hi there."})
+    assert cache.get(key) == {"role": "assistant", "content": "Hi there."}
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["entries"] == 1
+
+    # the cache is persistent
+    cache.close()
+    reopened_cache = LLMResponseCache(str(tmp_path / "cache.sqlite"))
+    assert reopened_cache.get(key) == {"role": "assistant", "content": "Hi there."}
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+
+    for i in range(5):
+        cache.put(f"key-{i}", f"response {i}")
+        time.sleep(0.01)
+
+    # recently read entries survive eviction
+    cache.get("key-0")
+    cache.evict()
+
+    assert cache.stats()["entries"] == 3
+    assert cache.get("key-0") == "response 0"
+    assert cache.get("key-1") is None
+    assert cache.get("key-4") == "response 4"
+
+
+def test_retry_policy_backoff():
+    policy = RetryPolicy(max_attempts=4, waiting_time=1, exponential_backoff_factor=2, max_waiting_time=3)
+
+    # jittered, but within the upper half of the exponential backoff, and capped
+    for attempt, backoff in [(1, 1), (2, 2), (3, 3), (4, 3)]:
+        waiting_time = policy.waiting_time_before_retry(attempt)
+        assert backoff / 2 <= waiting_time <= backoff
+
+    assert policy.should_retry(RuntimeError("transient"), attempt=1)
+    assert not policy.should_retry(RuntimeError("transient"), attempt=4), "No retries beyond the maximum number of attempts."
+
+    class InvalidArgument(Exception):
+        pass
+
+    assert not policy.should_retry(InvalidArgument("bad request"), attempt=1), "Invalid requests must not be retried."
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate_per_minute=600, capacity=2) # 10 tokens per second, bursts of 2
+
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire(1)
+    elapsed = time.monotonic() - start
+
+    # the first 2 are the burst, the remaining 3 must wait 0.1s each
+    assert 0.25 <= elapsed <= 1.0
+
+
+def test_token_bucket_shared_by_async_tasks():
+    bucket = TokenBucket(rate_per_minute=1200, capacity=1) # 20 tokens per second
+
+    async def main():
+        await asyncio.gather(*[bucket.acquire_async(1) for _ in range(5)])
+
+    start = time.monotonic()
+    asyncio.run(main())
+    elapsed = time.monotonic() - start
+
+    assert 0.15 <= elapsed <= 1.0
+
+
+def test_token_bucket_background_takers_use_leftover_budget():
+    bucket = TokenBucket(rate_per_minute=600, capacity=1) # 10 tokens per second
+    bucket.acquire(1)
+    order = []
+
+    def take(priority):
+        bucket.acquire(1, priority)
+        order.append(priority)
+
+    background = threading.Thread(target=take, args=("background",))
+    background.start()
+    time.sleep(0.02)
+    interactive = threading.Thread(target=take, args=("interactive",))
+    interactive.start()
+
+    background.join(5)
+    interactive.join(5)
+    assert order == ["interactive", "background"]
+
+
+def test_single_flight_coalesces_threads_and_tasks():
+    single_flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "response"
+
+    async def async_call():
+        return call()
+
+    results = []
+    def follow():
+        results.append(single_flight.do("key", call))
+
+    async def follow_async():
+        results.append(await single_flight.do_async("key", async_call))
+
+    leader = threading.Thread(target=follow)
+    leader.start()
+    while single_flight.in_flight() == 0:
+        time.sleep(0.001)
+
+    followers = [threading.Thread(target=follow) for _ in range(3)] + [threading.Thread(target=asyncio.run, args=(follow_async(),)) for _ in range(2)]
+    for follower in followers:
+        follower.start()
+    while single_flight.coalesced_calls < 5:
+        time.sleep(0.001)
+    release.set()
+
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert results == ["response"] * 6
+    assert len(calls) == 1
+    assert single_flight.in_flight() == 0
+
+    # errors are shared too, but later calls are made anew
+    def failing_call():
+        raise ValueError("failed")
+    with pytest.raises(ValueError):
+        single_flight.do("key", failing_call)
+    assert single_flight.do("key", lambda: "again") == "again"
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker(failure_rate=0.5, window=4, cooldown=0.05)
+
+    for outcome in [True, False, True, True]:
+        breaker.before_call()
+        breaker.record_failure() if outcome else breaker.record_success()
+    assert breaker.is_open
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # after the cooldown, a single probe goes through; its failure doubles the cooldown
+    time.sleep(0.06)
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    time.sleep(0.06)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.05)
+    breaker.before_call()
+    breaker.record_success()
+    assert not breaker.is_open
+    breaker.before_call()
+
+
+def test_mock_backend_follows_action_script():
+    backend = MockBackend(seed=7)
+
+    stimuli = {"role": "user", "content": json.dumps({"stimuli": [{"type": "CONVERSATION", "content": "Hi!", "source": "Someone"}]})}
+    instruction = {"role": "user", "content": json.dumps("Now you must generate a sequence of actions.")}
+    messages = [{"role": "system", "content": json.dumps("You are a simulated person.")}, stimuli, instruction]
+
+    action_types = []
+    for _ in range(4):
+        response = backend.generate(messages, response_format=CognitiveActionModel)
+        action = CognitiveActionModel.model_validate_json(response.text) # schema-valid
+        action_types.append(action.action.type)
+        messages = messages[:-1] + [{"role": "assistant", "content": response.text}, instruction]
+
+    assert action_types == ["THINK", "TALK", "DONE", "DONE"]
+
+    # deterministic for the same request and seed
+    assert MockBackend(seed=7).generate(messages[:3], response_format=CognitiveActionModel).text == \
+           backend.generate(messages[:3], response_format=CognitiveActionModel).text
+
+
+def test_mock_backend_latency_and_errors():
+    backend = MockBackend(latency_distribution="lognormal", latency_mean=0.05, latency_stddev=0.02, error_rate=0.5, seed=1)
+    outcomes = [backend._draw_call_outcome() for _ in range(400)]
+
+    latencies = [latency for latency, _ in outcomes]
+    assert 0.04 <= sum(latencies) / len(latencies) <= 0.06
+    assert 0.35 <= sum(1 for _, fails in outcomes if fails) / len(outcomes) <= 0.65
+
+    with pytest.raises(TimeoutError):
+        MockBackend(latency_mean=0.2).generate([{"role": "user", "content": "Hi"}], timeout=0.01)
+
+
+def test_pooled_backend_routes_and_fails_over():
+    pool = PooledBackend([Endpoint("fast", MockBackend(latency_mean=0.01)),
+                          Endpoint("slow", MockBackend(latency_mean=0.1)),
+                          Endpoint("broken", MockBackend(error_rate=1.0))],
+                         failures_to_eject=2, ejection_time=60)
+
+    threads = [threading.Thread(target=pool.generate, args=([{"role": "user", "content": f"Hi {i}"}],)) for i in range(40)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+
+    stats = pool.stats()
+    assert stats["fast"]["calls"] > stats["slow"]["calls"] > 0
+    assert stats["broken"]["calls"] == 2 and stats["broken"]["ejected"] # its failures were failed over, not raised
+    assert all(endpoint_stats["outstanding"] == 0 for endpoint_stats in stats.values())
+
+    # with no endpoint left to fail over to, the error surfaces, and then the pool fails fast
+    broken_pool = PooledBackend([Endpoint("broken", MockBackend(error_rate=1.0))], failures_to_eject=1)
+    with pytest.raises(openai_utils.MockBackendError):
+        broken_pool.generate([{"role": "user", "content": "Hi"}])
+    with pytest.raises(NoHealthyEndpointError):
+        broken_pool.generate([{"role": "user", "content": "Hi"}])
+
+
+def test_pooled_backend_from_config():
+    openai_utils.config.read_string("""
+    [Endpoint.test-a]
+    API_TYPE=mock
+    WEIGHT=2
+    MAX_CONCURRENT_REQUESTS=3
+    LATENCY_MEAN=0.01
+    [Endpoint.test-b]
+    API_TYPE=mock
+    """)
+    try:
+        pool = PooledBackend.from_config(["test-a", "test-b"])
+        assert [(endpoint.name, endpoint.weight) for endpoint in pool.endpoints] == [("test-a", 2.0), ("test-b", 1.0)]
+        assert pool.endpoints[0].backend.latency_mean == 0.01
+        assert pool.max_concurrent_requests == 3 + openai_utils.default["max_concurrent_requests"]
+    finally:
+        openai_utils.config.remove_section("Endpoint.test-a")
+        openai_utils.config.remove_section("Endpoint.test-b")
+
+
+@pytest.fixture
+def mock_client(mock_backend):
+    return mock_backend
+
+
+def test_client_with_mock_backend(mock_client):
+    mock_client.backend.error_rate = 0.5 # transient errors must be retried transparently
+    mock_client.retry_policy = RetryPolicy(max_attempts=20, waiting_time=0.001, max_waiting_time=0.001)
+    mock_client.circuit_breaker = CircuitBreaker(failure_rate=0)
+
+    message = mock_client.send_message([{"role": "user", "content": "Hello!"}], response_format=CognitiveActionModel)
+    assert message["role"] == "assistant"
+    assert CognitiveActionModel.model_validate_json(message["content"]).action.type == "THINK"
+
+    async def main():
+        return await asyncio.gather(*[mock_client.send_message_async([{"role": "user", "content": f"Hello {i}!"}]) for i in range(5)])
+
+    messages = asyncio.run(main())
+    assert all(isinstance(message["content"], str) for message in messages)
+
+
+def test_circuit_breaker_probe_can_be_cancelled(mock_client):
+    mock_client.retry_policy = RetryPolicy(max_attempts=1)
+    mock_client.backend.latency_mean = 1.0
+    breaker = mock_client.circuit_breaker = CircuitBreaker(failure_rate=0.5, window=1, cooldown=0.01)
+
+    def reopen():
+        breaker.record_failure()
+        assert breaker.is_open
+        time.sleep(0.02)
+
+    # a cancelled async probe
+    reopen()
+    async def main():
+        call = asyncio.ensure_future(mock_client.send_message_async([{"role": "user", "content": "Cancelled probe"}]))
+        await asyncio.sleep(0.1)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+    asyncio.run(main())
+    mock_client.backend.latency_mean = 0.01
+    mock_client.send_message([{"role": "user", "content": "Next probe"}]) # a later call can probe the backend
+    assert not breaker.is_open
+
+    # a stream that its caller stops consuming
+    reopen()
+    def on_member(name, value):
+        raise RuntimeError("The caller gave up on the stream.")
+    with pytest.raises(RuntimeError):
+        mock_client.send_message_stream([{"role": "user", "content": "Abandoned probe"}], response_format=CognitiveActionModel, on_member=on_member)
+    mock_client.send_message([{"role": "user", "content": "Another probe"}])
+    assert not breaker.is_open
+    assert mock_client._limiter.in_flight == 0
+
+
+def test_client_coalesces_identical_requests(mock_client):
+    mock_client.coalesce_requests = True
+    mock_client.backend.latency_mean = 0.2
+    coalesced_before = mock_client.coalesced_requests()
+
+    async def main(temperature):
+        return await asyncio.gather(*[mock_client.send_message_async([{"role": "user", "content": "Same question"}], response_format=CognitiveActionModel,
+                                                                     temperature=temperature)
+                                      for _ in range(4)])
+
+    start = time.monotonic()
+    messages = asyncio.run(main(temperature=0))
+
+    assert time.monotonic() - start < 0.4
+    assert mock_client.coalesced_requests() - coalesced_before == 3
+    assert all(message == messages[0] for message in messages)
+    assert messages[0] is not messages[1] # each caller gets its own copy
+
+    # sampled requests are not coalesced, since each of them is meant to get its own response
+    asyncio.run(main(temperature=0.7))
+    assert mock_client.coalesced_requests() - coalesced_before == 3
+
+
+def test_client_hedges_slow_requests(mock_client):
+    calls = []
+    def generate(messages, response_format=None, generation_parameters=None, timeout=None, prefix=None):
+        calls.append(1)
+        time.sleep(2.0 if len(calls) == 1 else 0.01) # only the first call is a straggler
+        return LLMBackendResponse(f"response {len(calls)}")
+    mock_client.backend.generate = generate
+
+    openai_utils.force_request_hedging(True, hedge_percentile=90)
+    try:
+        for _ in range(20):
+            mock_client.latencies.record(0.02)
+        hedged_before = mock_client.hedged_requests
+
+        start = time.monotonic()
+        message = mock_client.send_message([{"role": "user", "content": "Hedge me"}])
+        assert time.monotonic() - start < 1.0
+        assert message["content"] == "response 2"
+        assert mock_client.hedged_requests - hedged_before == 1
+    finally:
+        openai_utils.force_request_hedging(False)
+
+
+def test_client_gives_back_hedge_slots(mock_client):
+    primary_may_end = None
+    async def generate_async(messages, response_format=None, generation_parameters=None, timeout=None, prefix=None):
+        if not primary_may_end.is_set():
+            await primary_may_end.wait() # the primary is a straggler until the hedge is scheduled
+            return LLMBackendResponse("primary")
+        await asyncio.sleep(1.0)
+        return LLMBackendResponse("hedge")
+    mock_client.backend.generate_async = generate_async
+
+    take_hedge_slot = mock_client._take_hedge_slot
+    def take_hedge_slot_and_end_primary(estimated_tokens):
+        taken = take_hedge_slot(estimated_tokens)
+        primary_may_end.set()
+        return taken
+    mock_client._take_hedge_slot = take_hedge_slot_and_end_primary
+
+    async def main(cancel_caller):
+        nonlocal primary_may_end
+        primary_may_end = asyncio.Event()
+        call = asyncio.ensure_future(mock_client.send_message_async([{"role": "user", "content": f"Hedge me (cancelled: {cancel_caller})"}]))
+        if not cancel_caller:
+            return await call
+
+        # the caller gives up right after the hedge is scheduled, before the hedge task ever runs
+        await primary_may_end.wait()
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    openai_utils.force_request_hedging(True, hedge_percentile=90)
+    try:
+        for _ in range(20):
+            mock_client.latencies.record(0.02)
+        hedged_before = mock_client.hedged_requests
+
+        message = asyncio.run(main(cancel_caller=False))
+        assert message["content"] == "primary"
+        assert mock_client._limiter.in_flight == 0
+
+        asyncio.run(main(cancel_caller=True))
+        assert mock_client.hedged_requests - hedged_before == 2
+        assert mock_client._limiter.in_flight == 0
+
+        # a backend call cancelled before its task ever runs still gives back its slot
+        async def cancelled_before_start():
+            assert mock_client._limiter.try_acquire()
+            call = mock_client._backend_task([{"role": "user", "content": "Never sent"}], None, {}, None, None)
+            call.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await call
+        asyncio.run(cancelled_before_start())
+        assert mock_client._limiter.in_flight == 0
+    finally:
+        del mock_client._take_hedge_slot
+        openai_utils.force_request_hedging(False)
+
+
+def test_client_telemetry(mock_client, tmp_path):
+    mock_client.telemetry.clear()
+
+    def extraction_step():
+        return mock_client.send_message([{"role": "user", "content": "Extract something"}], response_format={"type": "json_object"})
+
+    extraction_step()
+    with openai_utils.call_context(agent="Oscar", simulation_id="sim-1"):
+        mock_client.send_message([{"role": "user", "content": "Hello!"}], response_format=CognitiveActionModel)
+        with openai_utils.call_context(call_site="custom"):
+            mock_client.send_message([{"role": "user", "content": "Hi!"}])
+
+    with openai_utils.call_context(priority="background"):
+        extraction_step()
+    with pytest.raises(ValueError):
+        with openai_utils.call_context(priority="urgent"):
+            pass
+
+    records = mock_client.telemetry.records()
+    assert [record.priority for record in records] == ["interactive"] * 3 + ["background"]
+    records = records[:3]
+    assert [record.call_site for record in records] == [f"{__name__}.{openai_utils._code_qualname(extraction_step.__code__)}", 
+                                                        f"{__name__}.test_client_telemetry", "custom"]
+    assert records[0].agent is None and records[1].agent == "Oscar" and records[2].simulation_id == "sim-1"
+    assert all(record.attempts == 1 and record.cache == "miss" and record.latency >= 0 and record.input_tokens > 0 for record in records)
+
+    summary = mock_client.telemetry.summary(by="agent")
+    assert summary["Oscar"]["calls"] == 2 and summary["Oscar"]["errors"] == 0 and summary[None]["calls"] == 2
+
+    assert mock_client.telemetry.export_jsonl(tmp_path / "telemetry.jsonl", agent="Oscar") == 2
+    lines = [json.loads(line) for line in open(tmp_path / "telemetry.jsonl")]
+    assert [line["call_site"] for line in lines] == [f"{__name__}.test_client_telemetry", "custom"]
+
+
+def test_untagged_call_infers_call_site(mock_client):
+    mock_client.telemetry.clear()
+
+    def untagged_step():
+        return mock_client.send_message([{"role": "user", "content": "Untagged"}])
+
+    untagged_step()
+    assert mock_client.telemetry.records()[0].call_site.endswith("untagged_step")
+
+    # code objects have no qualified name before Python 3.11
+    assert openai_utils._code_qualname(types.SimpleNamespace(co_name="untagged_step")) == "untagged_step"
+    assert openai_utils._code_qualname(untagged_step.__code__) in ("untagged_step", untagged_step.__qualname__)
+
+
+def test_client_throughput_scales_with_pool(mock_backend):
+    openai_utils.register_backend("test-pool", lambda: PooledBackend([Endpoint(f"local-{i}", MockBackend(latency_mean=0.1), max_concurrent_requests=2) 
+                                                                      for i in range(4)]))
+    openai_utils.force_api_type("test-pool") # the fixture restores the client afterwards
+    client = openai_utils.client()
+    assert client._limiter.limit == 8
+
+    async def main():
+        return await asyncio.gather(*[client.send_message_async([{"role": "user", "content": f"Hello {i}!"}]) for i in range(16)])
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start < 0.6 # 2 rounds of 8 concurrent requests, rather than 8 rounds of 2
+    calls = [endpoint_stats["calls"] for endpoint_stats in client.backend.stats().values()]
+    assert sum(calls) == 16 and min(calls) >= 2
+
+
+def test_client_adapts_concurrency_to_backend_capacity(mock_client):
+    mock_client.backend = MockBackend(latency_mean=0.02, capacity=4)
+    mock_client.retry_policy = RetryPolicy(max_attempts=50, waiting_time=0.001, max_waiting_time=0.01)
+    mock_client.circuit_breaker = openai_utils.CircuitBreaker(failure_rate=0)
+    mock_client.set_max_concurrent_requests(16)
+    mock_client.telemetry.clear()
+    openai_utils.force_adaptive_concurrency(True)
+    try:
+        async def main():
+            return await asyncio.gather(*[mock_client.send_message_async([{"role": "user", "content": f"Hello {i}!"}]) for i in range(100)])
+        asyncio.run(main())
+
+        history = mock_client.telemetry.concurrency_limits()
+        assert history[0]["limit"] == 16 and history[0]["reason"] == "start"
+        assert any(change["reason"] == "MockThrottlingError" for change in history)
+        assert 2 <= mock_client._limiter.limit <= 8 # close to the backend's capacity of 4
+        assert min(record.concurrency_limit for record in mock_client.telemetry.records()) <= 8
+    finally:
+        openai_utils.force_adaptive_concurrency(False)
+
+
+def test_client_adapts_concurrency_to_streamed_calls(mock_client):
+    mock_client.backend = MockBackend(latency_mean=0.02, capacity=4)
+    mock_client.retry_policy = RetryPolicy(max_attempts=50, waiting_time=0.001, max_waiting_time=0.01)
+    mock_client.circuit_breaker = openai_utils.CircuitBreaker(failure_rate=0)
+    mock_client.set_max_concurrent_requests(16)
+    mock_client.telemetry.clear()
+    openai_utils.force_adaptive_concurrency(True)
+    try:
+        def stream(i):
+            return mock_client.send_message_stream([{"role": "user", "content": f"Hello {i}!"}], response_format=CognitiveActionModel,
+                                                   on_member=lambda name, value: None)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(stream, range(100)))
+
+        # streamed calls are throttled and timed like any others
+        history = mock_client.telemetry.concurrency_limits()
+        assert any(change["reason"] == "MockThrottlingError" for change in history)
+        assert mock_client._limiter.limit <= 8
+        assert mock_client.latencies.percentile(50) is not None
+    finally:
+        openai_utils.force_adaptive_concurrency(False)
+
+
+def test_client_streams_members_early(mock_client):
+    members = []
+    message = mock_client.send_message_stream([{"role": "user", "content": "Hello!"}], response_format=CognitiveActionModel,
+                                              on_member=lambda name, value: members.append((name, value)))
+
+    assert [name for name, _ in members] == ["action", "cognitive_state"]
+    assert dict(members) == json.loads(message["content"])
+
+    # the same response as without streaming
+    assert message == mock_client.send_message([{"role": "user", "content": "Hello!"}], response_format=CognitiveActionModel)
+
+
+def test_client_caches_stable_prompt_prefix(mock_client, monkeypatch):
+    mock_client.prefix_cache = openai_utils.PromptPrefixCache(min_tokens=10, ttl=600)
+
+    system_message = {"role": "system", "content": "You are a simulated person. " * 20}
+    for i in range(3):
+        messages = [system_message, {"role": "user", "content": f"Stimulus number {i}."}]
+        mock_client.send_message(messages, response_format=CognitiveActionModel, prefix_scope="Someone")
+
+    # the first call reveals nothing, the second detects the stable system message, and the third reuses it
+    stats = mock_client.prefix_cache_stats()
+    assert stats["prefixes_created"] == 1
+    assert stats["hits"] == 2
+    assert stats["saved_input_tokens"] == 2 * openai_utils.utils.num_tokens_from_messages([system_message])
+
+    # without a scope, nothing is cached
+    mock_client.send_message(messages, response_format=CognitiveActionModel)
+    assert mock_client.prefix_cache_stats()["hits"] == 2
+
+    # a prefix that is replaced is released on the backend side, rather than left there until it expires
+    system_message = {"role": "system", "content": "You are another simulated person. " * 20}
+    for i in range(3):
+        messages = [system_message, {"role": "user", "content": f"Stimulus number {i}."}]
+        mock_client.send_message(messages, response_format=CognitiveActionModel, prefix_scope="Someone")
+    assert mock_client.prefix_cache_stats()["prefixes_created"] == 2
+    assert len(mock_client.backend.cached_prefixes) == 1
+
+    # and so is one that is invalidated
+    prefix = mock_client.prefix_cache.prefix_for("Someone", messages, CognitiveActionModel, mock_client.backend)
+    mock_client.prefix_cache.invalidate(prefix, mock_client.backend)
+    assert len(mock_client.backend.cached_prefixes) == 0
+
+    # prompts below the backend's minimum (e.g., Gemini's) are not even hashed
+    hashed = []
+    monkeypatch.setattr(openai_utils.PromptPrefixCache, "_hashed_messages", staticmethod(lambda *args: hashed.append(1)))
+    monkeypatch.setattr(mock_client.backend, "min_cached_prefix_tokens", openai_utils.GeminiBackend.min_cached_prefix_tokens, raising=False)
+    assert mock_client.prefix_cache.prefix_for("Someone else", messages, CognitiveActionModel, mock_client.backend) is None
+    assert hashed == []
+
+
+def test_llm_session_sends_only_new_messages_with_prefix_caching(mock_client):
+    transmitted = []
+    generate = mock_client.backend.generate
+    def recording_generate(messages, response_format=None, generation_parameters=None, timeout=None, prefix=None):
+        transmitted.append(len(messages) - (len(prefix.messages) if prefix is not None else 0))
+        return generate(messages, response_format, generation_parameters, timeout, prefix)
+    mock_client.backend.generate = recording_generate
+
+    def converse(session):
+        transmitted.clear()
+        conversation = [{"role": "system", "content": "You are a simulated person. " * 20}]
+        for i in range(6):
+            conversation = conversation + [{"role": "user", "content": f"Stimulus number {i}."}]
+            session.update(conversation)
+            session.send([{"role": "user", "content": "Now act."}])
+        return list(transmitted)
+
+    # without prefix caching, the whole conversation is sent on every call
+    mock_client.prefix_cache = None
+    whole = converse(openai_utils.LLMSession("Someone"))
+    assert whole == [3, 4, 5, 6, 7, 8]
+
+    # with it, from the second call on, the system prompt and the first stimulus stay on the backend side
+    mock_client.prefix_cache = openai_utils.PromptPrefixCache(min_tokens=0, ttl=600)
+    sent = converse(openai_utils.LLMSession("Someone"))
+    assert sent == [3] + [count - 2 for count in whole[1:]]
+
+
+def test_prompt_prefix_cache_hashes_only_new_messages(monkeypatch):
+    backend = MockBackend()
+    prefix_cache = openai_utils.PromptPrefixCache(min_tokens=0, ttl=600)
+
+    hashed = []
+    sha256 = openai_utils.hashlib.sha256
+    monkeypatch.setattr(openai_utils.hashlib, "sha256", lambda data: hashed.append(data) or sha256(data))
+
+    # the same message objects are passed again, as agents do, so only the newest message is hashed on each call
+    messages = [{"role": "system", "content": "You are a simulated person."}]
+    for i in range(5):
+        messages = messages + [{"role": "user", "content": f"Stimulus number {i}."}]
+        prefix_cache.prefix_for("Someone", messages, None, backend)
+        hashed_by_cache = [data for data in hashed if data.startswith(b"system:") or data.startswith(b"user:")]
+        assert len(hashed_by_cache) == len(messages)
+
+    # a changed message is hashed again, even if it is the same object
+    messages[0]["content"] = "You are another simulated person."
+    prefix_cache.prefix_for("Someone", messages, None, backend)
+    assert [data for data in hashed if data.startswith(b"system:")][-1] == b"system:You are another simulated person."
+
+    # the backend's own minimum prefix size applies, whatever the configuration
+    backend.min_cached_prefix_tokens = 10**6
+    prefixes_created = prefix_cache.stats()["prefixes_created"]
+    assert prefix_cache.prefix_for("Someone else", messages, None, backend) is None
+    assert prefix_cache.prefix_for("Someone else", messages + [{"role": "user", "content": "Hi!"}], None, backend) is None
+    assert prefix_cache.stats()["prefixes_created"] == prefixes_created
+
+
+def test_compile_response_schema():
+    schema = compile_response_schema(CognitiveActionModel)
+
+    # references are inlined, and titles are dropped
+    assert schema["properties"]["action"]["properties"]["type"] == {"type": "string"}
+    assert schema["properties"]["cognitive_state"]["required"] == ["goals", "attention", "emotions"]
+    assert "title" not in json.dumps(schema)
+    assert compile_response_schema(CognitiveActionModel) is schema, "Schemas must be compiled only once."
+
+    class Answer(BaseModel):
+        text: str
+        confidence: Optional[float] = None
+
+    assert compile_response_schema(Answer)["properties"]["confidence"] == {"type": "number", "nullable": True}
+
+    # free-form objects can't be expressed
+    class FreeForm(BaseModel):
+        data: dict
+
+    assert compile_response_schema(FreeForm) is None
+
+    gemini_schema = GeminiBackend._response_schema(CognitiveActionModel)
+    assert set(gemini_schema.properties.keys()) == {"action", "cognitive_state"}
+
+
+def test_client_validates_response_schema(mock_client):
+    with pytest.raises(ValueError):
+        mock_client._process_response(LLMBackendResponse('{"action": {"type": "TALK"}}'), CognitiveActionModel)
+
+    text = '{"action": {"type": "TALK", "content": "Hi", "target": ""}, "cognitive_state": {"goals": "", "attention": "", "emotions": ""}}'
+    assert mock_client._process_response(LLMBackendResponse(text), CognitiveActionModel)["content"] == text
+
+    # malformed JSON is repaired locally, rather than rejected
+    malformed_text = "```json\n{'action': {'type': 'TALK', 'content': 'Hi', 'target': '',}, 'cognitive_state': {'goals': '', 'attention': '', 'emotions': ''}}\n```"
+    assert json.loads(mock_client._process_response(LLMBackendResponse(malformed_text), CognitiveActionModel)["content"]) == json.loads(text)
+
+
+def test_llm_request_typed_outputs(mock_client, monkeypatch):
+    sent = []
+    generate = mock_client.backend.generate
+    def recording_generate(messages, response_format, generation_parameters, *args):
+        sent.append((messages, generation_parameters))
+        return generate(messages, response_format, generation_parameters, *args)
+    monkeypatch.setattr(mock_client.backend, "generate", recording_generate)
+
+    class Mood(enum.Enum):
+        HAPPY = "happy"
+        SAD = "sad"
+
+    for output_type in (bool, int, float, Mood):
+        request = LLMRequest(system_prompt="""
+                                 Evaluate the claim.
+                                 """, 
+                             user_prompt=f"The claim number {output_type.__name__}.", output_type=output_type)
+        value = request()
+        assert isinstance(value, output_type)
+        assert request.response_justification is None and request.response_confidence is None
+
+        # verdicts are capped to a few tokens, and the indentation of the prompts is dropped
+        messages, generation_parameters = sent[-1]
+        if output_type is Mood:
+            assert LLMRequest.VERDICT_MAX_TOKENS < generation_parameters["max_tokens"] < 2 * LLMRequest.VERDICT_MAX_TOKENS
+        else:
+            assert generation_parameters["max_tokens"] == LLMRequest.VERDICT_MAX_TOKENS
+        assert messages[0]["content"].startswith("Evaluate the claim.\n\n")
+
+    request = LLMRequest(system_prompt="Evaluate the claim.", user_prompt="The claim.", output_type=bool, justify=True, max_tokens=500)
+    assert isinstance(request.call(), bool)
+    assert isinstance(request.response_justification, str) and 0.0 <= request.response_confidence <= 1.0
+    assert sent[-1][1]["max_tokens"] == 500
+
+    request = LLMRequest(system_prompt="Write a short bio.", user_prompt="Of Oscar.")
+    assert isinstance(request.call(), str) and request.response_value == request.response_raw
+    assert "response_format" not in sent[-1][1] and "max_tokens" not in sent[-1][1]
+
+    with pytest.raises(ValueError):
+        LLMRequest(system_prompt="Evaluate the claim.", output_type=list)
+    with pytest.raises(ValueError):
+        LLMRequest(user_prompt="The claim.")
+
+
+def test_client_batch_mode(mock_client, tmp_path):
+    def batcher():
+        return LLMBatcher(LocalBatchBackend(MockBackend(), directory=str(tmp_path)), directory=str(tmp_path), window=0.1, poll_interval=0.05)
+
+    mock_client.batcher = batcher()
+    mock_client.telemetry.clear()
+
+    def ask(i):
+        with openai_utils.batch_mode():
+            return mock_client.send_message([{"role": "user", "content": f"Question {i}"}], response_format=CognitiveActionModel)
+
+    # concurrent calls go to the same job
+    responses = utils.run_concurrently(ask, list(range(10)))
+    assert all(CognitiveActionModel.model_validate_json(response["content"]) for response in responses)
+    assert mock_client.batcher.submitted_jobs == 1
+    assert [record.mode for record in mock_client.telemetry.records()] == ["batch"] * 10
+
+    # async calls too, and calls outside of batch mode are sent right away
+    async def ask_async():
+        with openai_utils.batch_mode():
+            return await mock_client.send_message_async([{"role": "user", "content": "Question async"}])
+    assert len(asyncio.run(ask_async())["content"]) > 0
+    assert mock_client.batcher.submitted_jobs == 2
+    mock_client.send_message([{"role": "user", "content": "Question interactive"}])
+    assert mock_client.telemetry.records()[-1].mode == "blocking"
+
+    # after a restart, the calls already submitted get the results of their jobs, instead of being submitted again
+    mock_client.batcher = batcher()
+    assert utils.run_concurrently(ask, list(range(10))) == responses
+    assert mock_client.batcher.submitted_jobs == 0
+    assert len(list(tmp_path.glob("*.input.jsonl"))) == 2
+
+    # requests that fail in the job fail the call
+    failing_backend = LocalBatchBackend(MockBackend(error_rate=1.0), directory=str(tmp_path))
+    mock_client.batcher = LLMBatcher(failing_backend, directory=str(tmp_path), window=0.1, poll_interval=0.05)
+    with pytest.raises(LLMBatchError):
+        ask(100)
@@ -144,3 +144,274 @@ def test_programmatic_definitions(setup):
         agent.listen_and_act("Tell me a bit about your life.")
     
     
+
+
+def test_chat_session_sends_only_new_episodes(setup, mock_backend):
+    import json
+
+    client = mock_backend
+    sent_messages = []
+    generate = client.backend.generate
+    def recording_generate(messages, *args):
+        sent_messages.append(len(messages))
+        return generate(messages, *args)
+    client.backend.generate = recording_generate
+
+    agent = create_oscar_the_architect()
+    agent.episodic_memory.fixed_prefix_length = 2
+    agent.episodic_memory.lookback_length = 6
+    agent.enable_chat_session()
+
+    for i in range(5):
+        agent.listen_and_act(f"Tell me about the project number {i}.")
+
+    session = agent._chat_session
+    assert len(sent_messages) >= 10
+
+    # the window moved forward a few times, but most turns only serialized the newest episodes
+    assert 1 <= session.resyncs < len(sent_messages) / 2
+    assert session.serialized_messages < sum(sent_messages) / 2
+
+    # the session holds the same messages the agent would otherwise send, but for the final instruction
+    agent.reset_prompt()
+    session.update(agent.current_messages[:-1])
+    assert session._messages == [{"role": m["role"], "content": json.dumps(m["content"])} for m in agent.current_messages[:-1]]
+    assert agent.current_messages[1:3] == agent.episodic_memory.retrieve_first(2, include_omission_info=False)
+
+    # sessions are not part of the agent's state
+    assert "_chat_session" not in agent.encode_complete_state()
+
+def test_system_prompt_memoization(setup):
+    import chevron
+    import tinytroupe.utils as utils
+
+    agent = create_oscar_the_architect()
+
+    # the prompt is only rendered again after the persona or the mental faculties change
+    prompt = agent.generate_agent_system_prompt()
+    assert agent.generate_agent_system_prompt() is prompt
+
+    agent.define("favorite_color", "ultramarine blue")
+    new_prompt = agent.generate_agent_system_prompt()
+    assert new_prompt is not prompt
+    assert "ultramarine blue" in new_prompt
+    assert agent._init_system_message is new_prompt
+
+    agent.clear_relationships()
+    assert agent.generate_agent_system_prompt() is not new_prompt
+
+    assert "_system_prompt_memo" not in agent.encode_complete_state()
+
+    # compiled templates render exactly as the original template text
+    template_variables = {"name": "Oscar", "persona": "{}", "actions_definitions_prompt": "", "actions_constraints_prompt": ""}
+    with open(agent._prompt_template_path, "r") as f:
+        assert utils.render_template(agent._prompt_template_path, template_variables) == chevron.render(f.read(), template_variables)
+
+def test_messages_are_serialized_once(setup, mock_backend):
+    from tinytroupe.agent import TinyPerson
+
+    serialize_message = TinyPerson._serialize_message
+    serialized = []
+    def counting_serialize_message(message):
+        serialized.append(message)
+        return serialize_message(message)
+    TinyPerson._serialize_message = staticmethod(counting_serialize_message)
+    try:
+        agent = create_oscar_the_architect()
+        agent.listen_and_act("Tell me about your current project.")
+        before = len(serialized)
+        agent.listen_and_act("And what about the next one?")
+
+        # the second turn only serialized the episodes it added, since the system prompt and the instruction did not change
+        assert 0 < len(serialized) - before < agent.episodic_memory.count() - 1
+        assert agent._serialized_current_messages() == [serialize_message(msg) for msg in agent.current_messages]
+        assert len(agent._serialization_cache) <= 2 * len(agent.current_messages)
+    finally:
+        TinyPerson._serialize_message = staticmethod(serialize_message)
+
+def test_multiple_actions_per_call(setup, mock_backend):
+    client = mock_backend
+    calls = []
+    generate = client.backend.generate
+    def recording_generate(messages, response_format, *args):
+        calls.append(response_format.__name__)
+        return generate(messages, response_format, *args)
+    client.backend.generate = recording_generate
+
+    agent = create_oscar_the_architect()
+    agent.multiple_actions_per_call = True
+
+    actions = agent.listen_and_act("Tell me about your current project.", return_actions=True)
+
+    # the whole THINK, TALK, DONE sequence came from a single call, and each action was remembered on its own
+    assert calls == ["CognitiveActionsModel"]
+    assert [content["action"]["type"] for content in actions] == ["THINK", "TALK", "DONE"]
+    episodes = agent.episodic_memory.retrieve_last(3, include_omission_info=False)
+    assert [episode["content"]["action"]["type"] for episode in episodes] == ["THINK", "TALK", "DONE"]
+
+    # the actions share the cognitive state of their response, whose shape is left to the response format
+    assert all(episode["content"]["cognitive_state"] == actions[-1]["cognitive_state"] for episode in episodes)
+    assert "{" not in agent.current_messages[-1]["content"]
+
+    # the repetition guard also applies to the actions of a single response
+    repeated_action = {"type": "THINK", "content": "Hmm.", "target": ""}
+    agent._produce_message = lambda multiple_actions=False: ("assistant", {"actions": [repeated_action] * 10, 
+                                                                           "cognitive_state": {"goals": "", "attention": "", "emotions": ""}})
+    actions = agent.listen_and_act("Keep thinking.", return_actions=True)
+    assert len(actions) == 5
+
+def test_streamed_actions_are_dispatched_once(setup, mock_backend):
+    agent = create_oscar_the_architect()
+    world = TinyWorld("Streaming world", [agent])
+
+    dispatched = []
+    handle_actions = world._handle_actions
+    def recording_handle_actions(source, actions):
+        dispatched.extend(action["type"] for action in actions)
+        return handle_actions(source, actions)
+    world._handle_actions = recording_handle_actions
+
+    displayed_lengths = []
+    display_communication = agent._display_communication
+    def recording_display_communication(**kwargs):
+        if kwargs["kind"] == "action":
+            displayed_lengths.append(kwargs.get("max_content_length"))
+        return display_communication(**kwargs)
+    agent._display_communication = recording_display_communication
+
+    # the first response turns out to be invalid only after it was streamed in full, so it is produced again
+    store_in_memory = agent.store_in_memory
+    failed = []
+    def failing_store_in_memory(value):
+        if value["type"] == "action" and len(failed) == 0:
+            failed.append(value)
+            raise KeyError("cognitive_state")
+        return store_in_memory(value)
+    agent.store_in_memory = failing_store_in_memory
+
+    openai_utils.force_stream_responses(True)
+    try:
+        actions = agent.listen_and_act("Tell me about your current project.", return_actions=True, max_content_length=42)
+    finally:
+        openai_utils.force_stream_responses(False)
+
+    assert [content["action"]["type"] for content in actions] == ["THINK", "TALK", "DONE"]
+    assert len(failed) == 1
+
+    # each action reached the environment once, and only once it was stored
+    assert dispatched == ["THINK", "TALK", "DONE"]
+    assert agent.pop_latest_actions() == []
+
+    # streamed actions are displayed as the caller asked
+    assert len(displayed_lengths) == 4 and set(displayed_lengths) == {42}
+
+def test_relevant_memories_memoization_and_prefetch(setup, mock_backend):
+    import copy
+    import threading
+
+    agent = create_oscar_the_architect()
+
+    # nothing to retrieve from an empty semantic memory
+    assert agent.semantic_memory.version() == 0
+    assert agent.retrieve_relevant_memories_for_current_context() == []
+
+    # the semantic memory is not actually indexed here, since that requires an embedding model
+    retrievals = []
+    def fake_retrieve_relevant_memories(relevance_target, top_k=20):
+        retrievals.append(threading.current_thread().name)
+        return [f"Memory {len(retrievals)}"]
+    agent.retrieve_relevant_memories = fake_retrieve_relevant_memories
+    agent.semantic_memory.version = lambda: 1
+
+    # retrievals are skipped until something they depend on changes
+    assert agent.retrieve_relevant_memories_for_current_context() == ["Memory 1"]
+    assert agent.retrieve_relevant_memories_for_current_context() == ["Memory 1"]
+    agent._mental_state["goals"] = "Finish the new building design."
+    assert agent.retrieve_relevant_memories_for_current_context() == ["Memory 2"]
+    assert len(retrievals) == 2
+
+    # consecutive actions that leave the recent episodes and the cognitive state reading the same need no new retrieval
+    same_thought = {"action": {"type": "THINK", "content": "Hmm.", "target": ""}, 
+                    "cognitive_state": {"goals": "Finish the new building design.", "attention": "", "emotions": ""}}
+    agent._produce_message = lambda multiple_actions=False: ("assistant", copy.deepcopy(same_thought))
+    agent.act(until_done=False, n=10) # the relevance target reads the last 10 episodes, which are now all the same
+    retrievals_before = len(retrievals)
+    agent.act(until_done=False, n=2)
+    assert len(retrievals) == retrievals_before
+    del agent._produce_message
+
+    # with prefetching, they run in the background, and the memory context is up to date once the agent is done
+    agent.prefetch_relevant_memories = True
+    agent.listen_and_act("Tell me about your current project.")
+    assert len(retrievals) > retrievals_before
+    assert all(name.startswith("tinytroupe-memory") for name in retrievals[retrievals_before:])
+    assert agent._relevant_memories_prefetch is None
+    assert agent._mental_state["memory_context"] == [f"Memory {len(retrievals)}"]
+
+def test_episode_records(setup, mock_backend):
+    import copy
+    import json
+    import pickle
+    from tinytroupe.agent import Episode, EpisodicMemory
+
+    action = {'role': 'assistant', 
+              'content': {'action': {'type': 'TALK', 'content': 'Hello!', 'target': 'Lisa Carter'}, 
+                          'cognitive_state': {'goals': 'Greet Lisa.', 'attention': 'Lisa.', 'emotions': 'Happy.'}},
+              'type': 'action', 'simulation_timestamp': '2024-01-01T10:00:00'}
+    stimulus = {'role': 'user', 
+                'content': {'stimuli': [{'type': 'CONVERSATION', 'content': 'Hi!', 'source': 'Lisa Carter'}]},
+                'type': 'stimulus', 'simulation_timestamp': '2024-01-01T10:00:00'}
+
+    memory = EpisodicMemory()
+    memory.store_all([action, stimulus])
+
+    # episodes are stored as compact records, which still read (and serialize) as the original dicts
+    for original, episode in zip([action, stimulus], memory.retrieve_all()):
+        assert isinstance(episode, Episode)
+        assert episode == original and dict(episode) == original
+        assert json.dumps(episode["content"]) == json.dumps(original["content"])
+        assert copy.deepcopy(episode) == original and type(copy.deepcopy(episode)) is dict
+        assert pickle.loads(pickle.dumps(episode)) == original
+
+    # they cannot be changed, not even through the contents they hand out
+    episode = memory.retrieve_all()[0]
+    episode["content"]["action"]["content"] = "Changed."
+    assert episode["content"]["action"]["content"] == "Hello!"
+    with pytest.raises(AttributeError):
+        episode.role = "user"
+
+    # they are serialized as plain dicts, and loaded back as records
+    memory_json = json.loads(json.dumps(memory.to_json()))
+    assert memory_json["memory"] == [action, stimulus]
+    loaded_memory = EpisodicMemory.from_json(memory_json)
+    assert all(isinstance(episode, Episode) for episode in loaded_memory.retrieve_all())
+    assert loaded_memory.retrieve_all() == memory.retrieve_all()
+
+    # contents of other shapes are kept as they are
+    other = {'role': 'user', 'content': {'note': ['something', 'else']}, 'type': 'note', 'simulation_timestamp': None}
+    assert Episode.compact(other) == other
+
+    # their fields can be read without rebuilding their content, and the same way from plain dicts
+    action_record, stimulus_record = memory.retrieve_all()
+    content = Episode.content
+    Episode.content = None
+    try:
+        assert Episode.action_of(action_record) == ("TALK", "Hello!", "Lisa Carter")
+        assert Episode.stimuli_of(stimulus_record) == (("CONVERSATION", "Hi!", "Lisa Carter"),)
+    finally:
+        Episode.content = content
+    assert Episode.action_of(action) == Episode.action_of(action_record)
+    assert Episode.stimuli_of(stimulus) == Episode.stimuli_of(stimulus_record)
+    assert Episode.action_of(stimulus_record) is None and Episode.action_of(Episode.compact(other)) is None
+
+    agent = create_oscar_the_architect()
+    agent.listen_and_act("Tell me about your current project.")
+    assert all(isinstance(episode, Episode) for episode in agent.episodic_memory.retrieve_all())
+    assert agent.pretty_current_interactions() != ""
+
+    episodes = agent.episodic_memory.retrieve_all()
+    state = json.loads(json.dumps(agent.encode_complete_state()))
+    agent.decode_complete_state(state)
+    assert all(isinstance(episode, Episode) for episode in agent.episodic_memory.retrieve_all())
+    assert agent.episodic_memory.retrieve_all() == episodes
+    assert json.loads(json.dumps(agent.encode_complete_state())) == state
@@ -76,3 +76,42 @@ def test_decode_complete_state(setup, focus_group_world):
     assert len(world_2.agents) == n_agents_1, "The world should have the same number of agents."
 
 
+
+def test_run_agents_in_parallel(setup, focus_group_world, mock_backend):
+    import threading
+    import time
+
+    client = mock_backend
+    in_flight = []
+    max_in_flight = [0]
+    lock = threading.Lock()
+    generate = client.backend.generate
+    def slow_generate(*args):
+        with lock:
+            in_flight.append(1)
+            max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.pop()
+        return generate(*args)
+    client.backend.generate = slow_generate
+
+    world = focus_group_world
+    world.parallel_agent_actions = True
+    world.broadcast("Discuss ideas for a new AI product you'd love to have.")
+
+    handled = []
+    handle_actions = world._handle_actions
+    def recording_handle_actions(source, actions):
+        handled.append(source.name)
+        return handle_actions(source, actions)
+    world._handle_actions = recording_handle_actions
+
+    agents_actions = world._step()
+
+    # the agents acted at the same time, but their actions were handled in their order, once all of them were done
+    assert max_in_flight[0] > 1
+    assert handled == [agent.name for agent in world.agents]
+    assert list(agents_actions.keys()) == [agent.name for agent in world.agents]
+    assert all(len(actions) >= 1 for actions in agents_actions.values())
+    assert not world._deferring_actions
@@ -7,7 +7,7 @@ sys.path.append('../../')
 sys.path.append('..')
 
 
-from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error
+from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error, IncrementalJSONParser, num_tokens_from_messages, max_tokens_from_messages, truncate_messages_to_max_tokens
 from testing_utils import *
 from tinytroupe.utils.llm import llm
 
@@ -27,8 +27,15 @@ def test_extract_json():
     result = extract_json(text)
     assert result == {"key": "'value'"}
 
-    # Test with invalid JSON
+    # Test with a trailing comma, which is repaired
     text = 'Some text before {"key": "value",} some text after'
+    repairs = []
+    result = extract_json(text, repairs)
+    assert result == {"key": "value"}
+    assert repairs == ["trailing_commas"]
+
+    # Test with invalid JSON
+    text = 'Some text before {"key": value} some text after'
     result = extract_json(text)
     assert result == {}
 
@@ -37,6 +44,72 @@ def test_extract_json():
     result = extract_json(text)
     assert result == {}
 
+def test_extract_json_repairs():
+    def repaired(text):
+        repairs = []
+        return extract_json(text, repairs), repairs
+
+    assert repaired("```json\n{'type': 'TALK', 'done': True, 'target': None,}\n```") == \
+           ({"type": "TALK", "done": True, "target": None}, ["single_quotes", "python_literals", "trailing_commas"])
+
+    assert repaired('{"content": "He said "hi"\nand left", "n": 1}') == \
+           ({"content": 'He said "hi"\nand left', "n": 1}, ["unescaped_quotes", "unescaped_control_characters"])
+
+    # truncated objects are closed, and keys without a value are kept as null
+    assert repaired('{"action": {"type": "TALK", "content": "Hel') == ({"action": {"type": "TALK", "content": "Hel"}}, ["truncated"])
+    assert repaired('{"action": {"type": "DONE"}, "cognitive_state": {"goals"') == \
+           ({"action": {"type": "DONE"}, "cognitive_state": {"goals": None}}, ["truncated"])
+
+    # well-formed JSON needs no repair
+    assert repaired('{"a": [1, 2]}') == ({"a": [1, 2]}, [])
+
+def test_truncate_messages_to_max_tokens():
+    messages = [{"role": "system", "content": "You are a simulated person. " * 10}] + \
+               [{"role": "user", "content": f"Message number {i} with some extra words in it."} for i in range(20)]
+
+    # nothing to do if the messages fit
+    assert truncate_messages_to_max_tokens(messages, max_tokens=num_tokens_from_messages(messages)) == messages
+
+    # otherwise, the system message and the latest messages are kept
+    max_tokens = num_tokens_from_messages(messages[:1] + messages[-5:])
+    truncated = truncate_messages_to_max_tokens(messages, max_tokens=max_tokens)
+    assert truncated == messages[:1] + messages[-5:]
+    assert num_tokens_from_messages(truncated) <= max_tokens
+
+    # if not even the latest message fits, the end of its content is kept
+    long_messages = messages[:1] + [{"role": "user", "content": "word " * 1000 + "END"}]
+    max_tokens = num_tokens_from_messages(messages[:1]) + 50
+    truncated = truncate_messages_to_max_tokens(long_messages, max_tokens=max_tokens)
+    assert truncated[-1]["content"].endswith("END")
+    assert num_tokens_from_messages(truncated) <= max_tokens
+    assert long_messages[-1]["content"].startswith("word"), "The original messages must not be modified."
+
+def test_max_tokens_from_messages():
+    messages = [{"role": "system", "content": "You are a simulated person. " * 10},
+                {"role": "user", "content": "Olá! Você já experimentou 寿司? 🍣"},
+                {"role": "assistant", "content": {"action": {"type": "TALK", "content": "", "target": ""}}},
+                {"role": "user", "content": ""}]
+
+    # a bound, never below the actual number of tokens
+    for i in range(len(messages)):
+        assert max_tokens_from_messages(messages[i:i + 1]) >= num_tokens_from_messages(messages[i:i + 1])
+    assert max_tokens_from_messages(messages) >= num_tokens_from_messages(messages)
+
+def test_incremental_json_parser():
+    text = '```json\n{"action": {"type": "TALK", "content": "Hi, {there} [\\"you\\"]", "target": ""}, "cognitive_state": {"goals": "g"}, "n": 3}\n```'
+
+    parser = IncrementalJSONParser()
+    completed = []
+    for i in range(0, len(text), 5):
+        completed.extend(parser.feed(text[i:i+5]).keys())
+
+        # the action is available before the cognitive state is complete
+        if "action" in parser.members and "cognitive_state" not in parser.members:
+            assert parser.members["action"]["content"] == 'Hi, {there} ["you"]'
+
+    assert completed == ["action", "cognitive_state", "n"]
+    assert parser.members == extract_json(text)
+
 
 def test_name_or_empty():
     class MockEntity:
@@ -235,3 +308,60 @@ def test_llm_decorator():
     response = lucky_number()
     print("Lucky number response:", response)
     assert isinstance(response, int)
+
+
+def test_llm_decorator_memoization_and_batch(mock_backend):
+    client = mock_backend
+    client.telemetry.clear()
+
+    @llm()
+    def sentiment(text) -> bool:
+        """Tells whether the text expresses a positive sentiment."""
+
+    first = sentiment("I love it!")
+    assert isinstance(first, bool)
+    assert sentiment(text="I love it!") == first # memoized, even if passed differently
+    assert len(client.telemetry.records()) == 1
+    assert client.telemetry.records()[0].call_site == f"{sentiment.__module__}.{sentiment.__qualname__}"
+
+    # a small batch is packed into a single call (or falls back to one call per input), reusing memoized results
+    texts = ["I love it!", "I hate it.", "It is fine.", "I hate it."]
+    results = sentiment.batch([{"text": text} for text in texts])
+    assert len(results) == 4 and all(isinstance(result, bool) for result in results)
+    assert results[0] == first and results[1] == results[3]
+    assert len(client.telemetry.records()) in (2, 4)
+
+    # a large batch runs as concurrent calls, one per input
+    sentiment.cache_clear()
+    client.telemetry.clear()
+    results = sentiment.batch([{"text": f"Review {i}"} for i in range(20)])
+    assert len(results) == 20
+    assert len(client.telemetry.records()) == 20
+    assert sentiment.batch([{"text": f"Review {i}"} for i in range(20)]) == results
+    assert len(client.telemetry.records()) == 20
+
+    # if the packed call fails (here, with a malformed response), the inputs are computed one by one
+    client.retry_policy = openai_utils.RetryPolicy(max_attempts=1)
+    generate = client.backend.generate
+    def malformed_packed_generate(messages, response_format, *args):
+        if response_format.__name__.endswith("_results"):
+            return openai_utils.LLMBackendResponse('{"results": "not a list"}')
+        return generate(messages, response_format, *args)
+    client.backend.generate = malformed_packed_generate
+
+    sentiment.cache_clear()
+    client.telemetry.clear()
+    results = sentiment.batch([{"text": text} for text in texts])
+    assert len(results) == 4 and all(isinstance(result, bool) for result in results)
+    assert len(client.telemetry.records()) == 4
+    client.telemetry.clear()
+    client.backend.generate = generate
+
+    @llm(memoize=False)
+    def rephrase(sentence, style="formal") -> str:
+        """Rephrases the sentence in the given style."""
+        return "Keep it short."
+
+    assert isinstance(rephrase("hey there"), str)
+    rephrase("hey there")
+    assert len(client.telemetry.records()) == 2
@@ -46,15 +46,20 @@ class CognitiveActionModel(BaseModel):
     action: Action
     cognitive_state: CognitiveState
 
+class CognitiveActionsModel(BaseModel):
+    actions: list[Action]
+    # the cognitive state after all of the actions, which they share
+    cognitive_state: CognitiveState
+
 
 ###########################################################################
 # Exposed API
 ###########################################################################
 # from. grounding ... ---> not exposing this, clients should not need to know about detailed grounding mechanisms
-from .memory import SemanticMemory, EpisodicMemory
+from .memory import SemanticMemory, EpisodicMemory, Episode
 from .mental_faculty import CustomMentalFaculty, RecallFaculty, FilesAndWebGroundingFaculty, TinyToolUse
 from .tiny_person import TinyPerson
 
-__all__ = ["SemanticMemory", "EpisodicMemory", 
+__all__ = ["SemanticMemory", "EpisodicMemory", "Episode", 
            "CustomMentalFaculty", "RecallFaculty", "FilesAndWebGroundingFaculty", "TinyToolUse",
            "TinyPerson"]
\ No newline at end of file
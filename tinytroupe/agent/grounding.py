@@ -57,6 +57,9 @@ class BaseSemanticGroundingConnector(GroundingConnector):
         """
         self.index = None
 
+        # how many times documents were indexed, so that retrievals can be memoized
+        self.version = 0
+
         if not hasattr(self, 'documents') or self.documents is None:
             self.documents = []
         
@@ -149,6 +152,8 @@ class BaseSemanticGroundingConnector(GroundingConnector):
                 self.index = VectorStoreIndex.from_documents(self.documents)
             else:
                 self.index.refresh(self.documents)
+            
+            self.version += 1
     
     
 
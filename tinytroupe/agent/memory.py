@@ -4,7 +4,9 @@ import tinytroupe.utils as utils
 
 from llama_index.core import Document
 from typing import Any
+from collections.abc import Mapping
 import copy
+import sys
 
 #######################################################################################################################
 # Memory mechanisms 
@@ -75,6 +77,147 @@ class TinyMemory(TinyMentalFaculty):
         raise NotImplementedError("Subclasses must implement this method.")
 
 
+class Episode(Mapping):
+    """
+    A compact, immutable record of an episode (i.e., an action or stimuli) in episodic memory. It behaves as the read-only dict
+    it stands for, `{'role': ..., 'content': ..., 'type': ..., 'simulation_timestamp': ...}`, whose content is rebuilt when 
+    accessed. Code that goes through many episodes can read their fields without that (see `action_of` and `stimuli_of`).
+    Actions and stimuli are kept as tuples, and the strings that repeat across episodes and agents (roles, kinds, 
+    action and stimulus types, agent names, timestamps) are interned. Contents of any other shape are kept as they are.
+
+    Deep copies of an episode are plain, mutable dicts, so that serialization and code that edits copies of episodes keep working.
+    """
+
+    __slots__ = ("role", "kind", "simulation_timestamp", "_action", "_cognitive_state", "_stimuli", "_content")
+
+    KEYS = ("role", "content", "type", "simulation_timestamp")
+    ACTION_KEYS = ("type", "content", "target")
+    COGNITIVE_STATE_KEYS = ("goals", "attention", "emotions")
+    STIMULUS_KEYS = ("type", "content", "source")
+
+    def __init__(self, role:str, kind:str, simulation_timestamp:str, content:Any) -> None:
+        action = cognitive_state = stimuli = None
+
+        if Episode._is_record(content, ("action", "cognitive_state"), leaves=False) and \
+           Episode._is_record(content["action"], Episode.ACTION_KEYS) and \
+           Episode._is_record(content["cognitive_state"], Episode.COGNITIVE_STATE_KEYS):
+            a = content["action"]
+            action = (Episode._intern(a["type"]), a["content"], Episode._intern(a["target"]))
+            cognitive_state = tuple(content["cognitive_state"].values())
+            content = None
+
+        elif Episode._is_record(content, ("stimuli",), leaves=False) and isinstance(content["stimuli"], list) and \
+             all(Episode._is_record(s, Episode.STIMULUS_KEYS) for s in content["stimuli"]):
+            stimuli = tuple((Episode._intern(s["type"]), s["content"], Episode._intern(s["source"])) for s in content["stimuli"])
+            content = None
+
+        else:
+            content = copy.deepcopy(content)
+
+        for name, value in (("role", Episode._intern(role)), ("kind", Episode._intern(kind)), 
+                            ("simulation_timestamp", Episode._intern(simulation_timestamp)), ("_action", action), 
+                            ("_cognitive_state", cognitive_state), ("_stimuli", stimuli), ("_content", content)):
+            object.__setattr__(self, name, value)
+
+    @staticmethod
+    def from_dict(value:dict) -> "Episode":
+        return Episode(value["role"], value["type"], value["simulation_timestamp"], value["content"])
+
+    @staticmethod
+    def compact(value:Any) -> Any:
+        """
+        Returns the episode record for the given value, if it is an episode dict, or the value itself otherwise.
+        """
+        if isinstance(value, dict) and len(value) == len(Episode.KEYS) and all(key in value for key in Episode.KEYS):
+            return Episode.from_dict(value)
+        return value
+
+    def content(self) -> Any:
+        """
+        Returns a new copy of the content of the episode.
+        """
+        if self._action is not None:
+            return {"action": dict(zip(Episode.ACTION_KEYS, self._action)),
+                    "cognitive_state": dict(zip(Episode.COGNITIVE_STATE_KEYS, self._cognitive_state))}
+        elif self._stimuli is not None:
+            return {"stimuli": [dict(zip(Episode.STIMULUS_KEYS, stimulus)) for stimulus in self._stimuli]}
+        else:
+            return copy.deepcopy(self._content)
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content(), "type": self.kind, "simulation_timestamp": self.simulation_timestamp}
+
+    @staticmethod
+    def action_of(episode) -> tuple:
+        """
+        Returns the type, content and target of the action of an episode, either a record or a dict, or None if it has no 
+        action. The fields of records are read as stored, without rebuilding their content.
+        """
+        if isinstance(episode, Episode) and episode._action is not None:
+            return episode._action
+
+        content = episode["content"]
+        if isinstance(content, dict) and "action" in content:
+            return tuple(content["action"][key] for key in Episode.ACTION_KEYS)
+        return None
+
+    @staticmethod
+    def stimuli_of(episode) -> tuple:
+        """
+        Returns the type, content and source of each of the stimuli of an episode, either a record or a dict. The fields
+        of records are read as stored, without rebuilding their content.
+        """
+        if isinstance(episode, Episode) and episode._stimuli is not None:
+            return episode._stimuli
+
+        return tuple(tuple(stimulus[key] for key in Episode.STIMULUS_KEYS) for stimulus in episode["content"]["stimuli"])
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        elif key == "content":
+            return self.content()
+        elif key == "type":
+            return self.kind
+        elif key == "simulation_timestamp":
+            return self.simulation_timestamp
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(Episode.KEYS)
+
+    def __len__(self) -> int:
+        return len(Episode.KEYS)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Episodes are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Episodes are immutable.")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self.to_dict()
+
+    def __reduce__(self):
+        return (Episode.from_dict, (self.to_dict(),))
+
+    def __repr__(self) -> str:
+        return f"Episode({self.to_dict()!r})"
+
+    @staticmethod
+    def _is_record(value, keys:tuple, leaves:bool=True) -> bool:
+        # the keys must also be in the same order, so that rebuilt contents are serialized exactly as the original ones
+        return isinstance(value, dict) and tuple(value.keys()) == keys and \
+               (not leaves or all(v is None or isinstance(v, str) for v in value.values()))
+
+    @staticmethod
+    def _intern(value):
+        return sys.intern(value) if type(value) is str else value
+
+
 class EpisodicMemory(TinyMemory):
     """
     Provides episodic memory capabilities to an agent. Cognitively, episodic memory is the ability to remember specific events,
@@ -86,6 +229,9 @@ class EpisodicMemory(TinyMemory):
 
     MEMORY_BLOCK_OMISSION_INFO = {'role': 'assistant', 'content': "Info: there were other messages here, but they were omitted for brevity.", 'simulation_timestamp': None}
 
+    # episodes are serialized as plain dicts (see Episode), and turned back into records when loaded
+    custom_serialization_initializers = {"memory": lambda values: [Episode.compact(value) for value in values]}
+
     def __init__(
         self, fixed_prefix_length: int = 100, lookback_length: int = 100
     ) -> None:
@@ -101,6 +247,12 @@ class EpisodicMemory(TinyMemory):
 
         self.memory = []
 
+    def _preprocess_value_for_storage(self, value: Any) -> Any:
+        """
+        Stores episodes as compact, immutable records (see Episode).
+        """
+        return Episode.compact(value)
+
     def _store(self, value: Any) -> None:
         """
         Stores a value in memory.
@@ -159,6 +311,18 @@ class EpisodicMemory(TinyMemory):
         else:
             return fixed_prefix + self.memory[-remaining_lookback:]
 
+    def retrieve_recent_since(self, start:int, include_omission_info:bool=True) -> list:
+        """
+        Like `retrieve_recent`, but the lookback values are all those from the given position on, however many they are.
+        Hence, as long as the position stays the same, the result only grows by appending.
+        """
+        fixed_prefix = self.memory[: self.fixed_prefix_length]
+        start = max(start, len(fixed_prefix))
+
+        omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info and start > len(fixed_prefix) else []
+
+        return fixed_prefix + omisssion_info + self.memory[start:]
+
     def retrieve_all(self) -> list:
         """
         Retrieves all values from memory.
@@ -243,6 +407,12 @@ class SemanticMemory(TinyMemory):
         """
         return self.semantic_grounding_connector.retrieve_relevant(relevance_target, top_k)
 
+    def version(self) -> int:
+        """
+        Returns how many times the memory changed. It is 0 while the memory is empty.
+        """
+        return self.semantic_grounding_connector.version
+
     #####################################
     # Auxiliary compatibility methods
     #####################################
@@ -1,5 +1,5 @@
-from tinytroupe.agent import logger, default, Self, AgentOrWorld, CognitiveActionModel
-from tinytroupe.agent.memory import EpisodicMemory, SemanticMemory
+from tinytroupe.agent import logger, default, Self, AgentOrWorld, CognitiveActionModel, CognitiveActionsModel
+from tinytroupe.agent.memory import EpisodicMemory, SemanticMemory, Episode
 import tinytroupe.openai_utils as openai_utils
 from tinytroupe.utils import JsonSerializableRegistry, repeat_on_error, name_or_empty
 import tinytroupe.utils as utils
@@ -9,8 +9,10 @@ from tinytroupe.control import transactional, current_simulation
 import os
 import json
 import copy
+import threading
+import contextvars
+import concurrent.futures
 import textwrap  # to dedent strings
-import chevron  # to parse Mustache templates
 from typing import Any
 from rich import print
 
@@ -42,6 +44,28 @@ class TinyPerson(JsonSerializableRegistry):
     # Whether to display the communication or not. True is for interactive applications, when we want to see simulation
     # outputs as they are produced.
     communication_display:bool=True
+
+    # Whether new agents keep a chat session with the model (see enable_chat_session), so that each turn only serializes the
+    # episodes appended since the previous one, instead of the whole prompt (and, with prefix caching, only sends those).
+    chat_sessions:bool=False
+
+    # Whether agents acting until DONE produce their whole sequence of actions, up to and including DONE, in a single model
+    # call, instead of one call per action. The actions of such a call share the cognitive state the agent has after all of
+    # them, which is also the one stored with each of them in memory. Can also be set for specific agents.
+    multiple_actions_per_call:bool=False
+
+    # Whether the memories relevant to the agent's current context are retrieved in the background while it goes on acting
+    # (and calling the model), instead of right after each change of its cognitive state. Can also be set for specific agents.
+    prefetch_relevant_memories:bool=False
+
+    # The threads used to retrieve relevant memories in the background, shared by all agents (see _background_executor).
+    MAX_BACKGROUND_RETRIEVALS = 8
+    _background_executor_instance = None
+    _background_executor_lock = threading.Lock()
+
+    # In chat-session mode, how far beyond its lookback length (as a fraction of it) the window of recent episodes may grow
+    # before it moves forward, which requires resynchronizing the session.
+    SESSION_WINDOW_SLACK = 0.5
     
 
     def __init__(self, name:str=None, 
@@ -96,10 +120,28 @@ class TinyPerson(JsonSerializableRegistry):
         # consumed by the environment yet.
         self._actions_buffer = []
 
+        # The action of the response being produced, if it was already displayed while the response was streamed 
+        # (see _produce_message), and how much of its content is displayed.
+        self._streamed_action = None
+        self._streamed_display_length = default["max_content_display_length"]
+
         # The list of agents that this agent can currently interact with.
         # This can change over time, as agents move around the world.
         self._accessible_agents = []
 
+        # The chat session with the model, if any (see enable_chat_session), and the position in the episodic memory
+        # where its window of recent episodes starts.
+        self._chat_session = None
+        self._session_window_start = None
+
+        # The wire-format serialization of the messages sent to the model, by the identity of their content (see _serialized).
+        self._serialization_cache = {}
+
+        # The latest memories retrieved as relevant to the current context, along with the inputs they were retrieved for, 
+        # and the retrieval still running in the background, if any (see retrieve_relevant_memories_for_current_context).
+        self._relevant_memories_memo = None
+        self._relevant_memories_prefetch = None
+
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
@@ -158,6 +200,11 @@ class TinyPerson(JsonSerializableRegistry):
         )
         self._init_system_message = None  # initialized later
 
+        # The rendered system prompt only depends on the persona and on the mental faculties, so it is memoized
+        # against a version counter that is bumped whenever these change (see _persona_changed).
+        self._persona_version = 0
+        self._system_prompt_memo = None
+
 
         ############################################################
         # Special mechanisms used during deserialization
@@ -185,6 +232,9 @@ class TinyPerson(JsonSerializableRegistry):
             # register the agent in the global list of agents
             TinyPerson.add_agent(self)
 
+        if TinyPerson.chat_sessions:
+            self.enable_chat_session()
+
         # start with a clean slate
         self.reset_prompt()
 
@@ -198,11 +248,18 @@ class TinyPerson(JsonSerializableRegistry):
     def _rename(self, new_name:str):    
         self.name = new_name
         self._persona["name"] = self.name
+        self._persona_changed()
+
+    def _persona_changed(self):
+        """
+        Invalidates the memoized system prompt. Must be called whenever the persona or the mental faculties change.
+        """
+        self._persona_version += 1
 
 
     def generate_agent_system_prompt(self):
-        with open(self._prompt_template_path, "r") as f:
-            agent_prompt_template = f.read()
+        if self._system_prompt_memo is not None and self._system_prompt_memo[0] == self._persona_version:
+            return self._system_prompt_memo[1]
 
         # let's operate on top of a copy of the configuration, because we'll need to add more variables, etc.
         template_variables = self._persona.copy()    
@@ -223,9 +280,12 @@ class TinyPerson(JsonSerializableRegistry):
         # RAI prompt components, if requested
         template_variables = utils.add_rai_template_variables_if_enabled(template_variables)
 
-        return chevron.render(agent_prompt_template, template_variables)
+        system_prompt = utils.render_template(self._prompt_template_path, template_variables)
+        self._system_prompt_memo = (self._persona_version, system_prompt)
 
-    def reset_prompt(self):
+        return system_prompt
+
+    def reset_prompt(self, multiple_actions:bool=False):
 
         # render the template with the current configuration
         self._init_system_message = self.generate_agent_system_prompt()
@@ -238,16 +298,72 @@ class TinyPerson(JsonSerializableRegistry):
         ]
 
         # sets up the actual interaction messages to use for prompting
-        self.current_messages += self.retrieve_recent_memories()
+        if self._chat_session is None:
+            self.current_messages += self.retrieve_recent_memories()
+        else:
+            self.current_messages += self._retrieve_session_memories()
 
         # add a final user message, which is neither stimuli or action, to instigate the agent to act properly
-        self.current_messages.append({"role": "user", 
-                                      "content": "Now you **must** generate a sequence of actions following your interaction directives, " +\
-                                                 "and complying with **all** instructions and contraints related to the action you use." +\
-                                                 "DO NOT repeat the exact same action more than once in a row!" +\
-                                                 "DO NOT keep saying or doing very similar things, but instead try to adapt and make the interactions look natural." +\
-                                                 "These actions **MUST** be rendered following the JSON specification perfectly, including all required keys (even if their value is empty), **ALWAYS**."
-                                     })
+        if not multiple_actions:
+            self.current_messages.append({"role": "user", 
+                                          "content": "Now you **must** generate a sequence of actions following your interaction directives, " +\
+                                                     "and complying with **all** instructions and contraints related to the action you use." +\
+                                                     "DO NOT repeat the exact same action more than once in a row!" +\
+                                                     "DO NOT keep saying or doing very similar things, but instead try to adapt and make the interactions look natural." +\
+                                                     "These actions **MUST** be rendered following the JSON specification perfectly, including all required keys (even if their value is empty), **ALWAYS**."
+                                         })
+        else:
+            self.current_messages.append({"role": "user", 
+                                          "content": "Now you **must** generate the whole sequence of actions you will perform next, in order and up to and including DONE, " +\
+                                                     "following your interaction directives and complying with **all** instructions and contraints related to the actions you use. " +\
+                                                     "Your cognitive state is the one you will have after performing **all** of these actions. " +\
+                                                     "DO NOT repeat the exact same action more than once in a row!" +\
+                                                     "DO NOT keep saying or doing very similar things, but instead try to adapt and make the interactions look natural." +\
+                                                     "These actions **MUST** be rendered following the JSON specification perfectly, including all required keys (even if their value is empty), **ALWAYS**."
+                                         })
+
+        # forget the serializations of messages that left the prompt
+        if len(self._serialization_cache) > 2 * len(self.current_messages):
+            keys = [id(TinyPerson._serialization_key(msg)) for msg in self.current_messages]
+            self._serialization_cache = {key: self._serialization_cache[key] for key in keys if key in self._serialization_cache}
+
+    def enable_chat_session(self, enabled:bool=True):
+        """
+        Enables or disables the chat-session mode of the agent. In this mode, the agent's conversation with the model is kept
+        across turns (see `openai_utils.LLMSession`): each turn only serializes the episodes appended since the previous one
+        and, if the backend caches the conversation as a prompt prefix, only sends those. The whole conversation is only 
+        serialized (and cached) again when the window of recent episodes moves forward, which happens once every 
+        SESSION_WINDOW_SLACK times its lookback length. Hence, the window may hold somewhat more episodes than without a session.
+        """
+        if enabled:
+            self._chat_session = openai_utils.LLMSession(self.name, serialize=self._serialized)
+        else:
+            self._chat_session = None
+        self._session_window_start = None
+
+    @staticmethod
+    def _serialize_message(message:dict) -> dict:
+        return {"role": message["role"], "content": json.dumps(message["content"])}
+
+    def _serialized(self, message:dict) -> dict:
+        """
+        Like `_serialize_message`, but each message is only serialized once. Episodes never change once stored in memory, and
+        neither do the system prompt (while the persona does not change) nor the final instruction, so they (or their content
+        objects) identify them across turns. The serialized messages are shared, hence must not be modified.
+        """
+        key = TinyPerson._serialization_key(message)
+        entry = self._serialization_cache.get(id(key))
+        if entry is None or entry[0] is not key or entry[1]["role"] != message["role"]:
+            # the key is kept in the entry, so that its id cannot be reused while the entry exists
+            entry = (key, TinyPerson._serialize_message(message))
+            self._serialization_cache[id(key)] = entry
+
+        return entry[1]
+
+    @staticmethod
+    def _serialization_key(message) -> Any:
+        # the content of episode records is rebuilt on each access, but the records themselves are immutable
+        return message if isinstance(message, Episode) else message["content"]
 
     def get(self, key):
         """
@@ -283,6 +399,7 @@ class TinyPerson(JsonSerializableRegistry):
         """
 
         self._persona = utils.merge_dicts(self._persona, additional_definitions)
+        self._persona_changed()
 
         # must reset prompt after adding to configuration
         self.reset_prompt()
@@ -320,6 +437,7 @@ class TinyPerson(JsonSerializableRegistry):
         else:
             raise ValueError(f"The key '{key}' already exists in the persona configuration and overwrite_scalars is set to False.")
 
+        self._persona_changed()
             
         # must reset prompt after adding to configuration
         self.reset_prompt()
@@ -353,6 +471,8 @@ class TinyPerson(JsonSerializableRegistry):
 
         else:
             raise Exception("Invalid arguments for define_relationships.")
+        
+        self._persona_changed()
 
     @transactional
     def clear_relationships(self):
@@ -360,6 +480,7 @@ class TinyPerson(JsonSerializableRegistry):
         Clears the TinyPerson's relationships.
         """
         self._persona['relationships'] = []  
+        self._persona_changed()
 
         return self      
     
@@ -399,6 +520,7 @@ class TinyPerson(JsonSerializableRegistry):
         # check if the faculty is already there or not
         if faculty not in self._mental_faculties:
             self._mental_faculties.append(faculty)
+            self._persona_changed()
         else:
             raise Exception(f"The mental faculty {faculty} is already present in the agent.")
         
@@ -439,10 +561,13 @@ class TinyPerson(JsonSerializableRegistry):
             pass # self.think("I will now think, reflect and act a bit, and then issue DONE.")        
 
         # Aux function to perform exactly one action.
-        # Occasionally, the model will return JSON missing important keys, so we just ask it to try again
+        # Responses are validated against CognitiveActionModel by the client, which retries those that do not conform. 
+        # Should one still be missing important keys, we just ask it to try again
         # Sometimes `content` contains EpisodicMemory's MEMORY_BLOCK_OMISSION_INFO message, which raises a TypeError on line 443
         @repeat_on_error(retries=5, exceptions=[KeyError, TypeError])
         def aux_act_once():
+            self._streamed_action = None
+            self._streamed_display_length = max_content_length
             role, content = self._produce_message()
 
             cognitive_state = content["cognitive_state"]
@@ -459,13 +584,18 @@ class TinyPerson(JsonSerializableRegistry):
                                   'type': 'action', 
                                   'simulation_timestamp': self.iso_datetime()})
 
-            self._actions_buffer.append(action)
+            # a streamed action is handed to the environment right away, now that the response is complete and stored, 
+            # so that it is dispatched exactly once even if an incomplete response is retried
+            if self._streamed_action is not None and self._dispatches_streamed_actions():
+                self.environment._handle_actions(self, [action])
+            else:
+                self._actions_buffer.append(action)
             self._update_cognitive_state(goals=cognitive_state['goals'],
                                         attention=cognitive_state['attention'],
                                         emotions=cognitive_state['emotions'])
             
             contents.append(content)          
-            if TinyPerson.communication_display:
+            if TinyPerson.communication_display and self._streamed_action is None:
                 self._display_communication(role=role, content=content, kind='action', simplified=True, max_content_length=max_content_length)
             
             #
@@ -473,6 +603,56 @@ class TinyPerson(JsonSerializableRegistry):
             #
             for faculty in self._mental_faculties:
                 faculty.process_action(self, action)             
+
+        # Aux function to perform a sequence of actions, up to and including DONE, produced by a single model call 
+        # (see multiple_actions_per_call). The usual guards apply to each of these actions as well.
+        @repeat_on_error(retries=5, exceptions=[KeyError, TypeError])
+        def aux_act_many():
+            self._streamed_action = None
+            role, content = self._produce_message(multiple_actions=True)
+
+            cognitive_state = content["cognitive_state"]
+            actions = content["actions"]
+
+            goals = cognitive_state['goals']
+            attention = cognitive_state['attention']
+            emotions = cognitive_state['emotions']
+            logger.debug(f"{self.name}'s actions: {actions}")
+
+            for action in actions:
+                action_type = action["type"]
+                if len(contents) > 0 and aux_should_stop() is not None:
+                    break
+
+                # each action is remembered as if it had been produced on its own. The response carries a single cognitive state, 
+                # the one after all of its actions, so that is the state every one of them is stored with
+                action_content = {"action": action, "cognitive_state": cognitive_state}
+                self.store_in_memory({'role': role, 'content': action_content, 
+                                      'type': 'action', 
+                                      'simulation_timestamp': self.iso_datetime()})
+                self._actions_buffer.append(action)
+
+                contents.append(action_content)
+                if TinyPerson.communication_display:
+                    self._display_communication(role=role, content=action_content, kind='action', simplified=True, max_content_length=max_content_length)
+
+                # the following actions were produced without the effects of those handled by a mental faculty (e.g., what was recalled), 
+                # so they are dropped and the agent acts again
+                handled_by_faculty = [faculty.process_action(self, action) for faculty in self._mental_faculties]
+                if action_type == "DONE" or any(handled_by_faculty):
+                    break
+
+            self._update_cognitive_state(goals=goals, attention=attention, emotions=emotions)
+
+        # Aux function to check whether the agent should stop acting before DONE. Returns the reason, if so.
+        def aux_should_stop():
+            if len(contents) > TinyPerson.MAX_ACTIONS_BEFORE_DONE:
+                return f"Agent {self.name} is acting without ever stopping. This may be a bug. Let's stop it here anyway."
+            if len(contents) > 4: # just some minimum number of actions to check for repetition, could be anything >= 3
+                # if the last three actions were the same, then we are probably in a loop
+                if contents[-1]['action'] == contents[-2]['action'] == contents[-3]['action']:
+                    return f"Agent {self.name} is acting in a loop. This may be a bug. Let's stop it here anyway."
+            return None
             
 
         #
@@ -492,18 +672,19 @@ class TinyPerson(JsonSerializableRegistry):
             ):
 
 
-                # check if the agent is acting without ever stopping
-                if len(contents) > TinyPerson.MAX_ACTIONS_BEFORE_DONE:
-                    logger.warning(f"[{self.name}] Agent {self.name} is acting without ever stopping. This may be a bug. Let's stop it here anyway.")
+                # check if the agent is acting without ever stopping, or in a loop
+                reason_to_stop = aux_should_stop()
+                if reason_to_stop is not None:
+                    logger.warning(f"[{self.name}] {reason_to_stop}")
                     break
-                if len(contents) > 4: # just some minimum number of actions to check for repetition, could be anything >= 3
-                    # if the last three actions were the same, then we are probably in a loop
-                    if contents[-1]['action'] == contents[-2]['action'] == contents[-3]['action']:
-                        logger.warning(f"[{self.name}] Agent {self.name} is acting in a loop. This may be a bug. Let's stop it here anyway.")
-                        break
 
                 aux_pre_act()
-                aux_act_once()
+                if self.multiple_actions_per_call:
+                    aux_act_many()
+                else:
+                    aux_act_once()
+
+        self._resolve_relevant_memories_prefetch()
 
         if return_actions:
             return contents
@@ -770,26 +951,63 @@ class TinyPerson(JsonSerializableRegistry):
         self._mental_state["accessible_agents"] = []
 
     @transactional
-    def _produce_message(self):
+    def _produce_message(self, multiple_actions:bool=False):
         # logger.debug(f"Current messages: {self.current_messages}")
 
         # ensure we have the latest prompt (initial system message + selected messages from memory)
-        self.reset_prompt()
-
-        messages = [
-            {"role": msg["role"], "content": json.dumps(msg["content"])}
-            for msg in self.current_messages
-        ]
+        self.reset_prompt(multiple_actions=multiple_actions)
+        response_format = CognitiveActionsModel if multiple_actions else CognitiveActionModel
 
         logger.debug(f"[{self.name}] Sending messages to OpenAI API")
-        logger.debug(f"[{self.name}] Last interaction: {messages[-1]}")
-
-        next_message = openai_utils.client().send_message(messages, response_format=CognitiveActionModel)
+        logger.debug(f"[{self.name}] Last interaction: {self.current_messages[-1]}")
+
+        client = openai_utils.client()
+        with openai_utils.call_context(agent=self.name, simulation_id=self.simulation_id):
+            if self._chat_session is not None:
+                # only the episodes appended since the previous turn are serialized; the final instruction is not kept in the session
+                self._chat_session.update(self.current_messages[:-1])
+                next_message = self._chat_session.send(self.current_messages[-1:], response_format=response_format,
+                                                       stream=client.stream_responses, on_member=self._handle_streamed_member)
+
+            elif client.stream_responses:
+                messages = self._serialized_current_messages()
+                # the action is displayed as soon as it is complete, while the cognitive state is still being generated
+                next_message = client.send_message_stream(messages, response_format=response_format, prefix_scope=self.name,
+                                                          on_member=self._handle_streamed_member)
+            else:
+                messages = self._serialized_current_messages()
+                next_message = client.send_message(messages, response_format=response_format, prefix_scope=self.name)
 
         logger.debug(f"[{self.name}] Received message: {next_message}")
 
         return next_message["role"], utils.extract_json(next_message["content"])
 
+    def _serialized_current_messages(self) -> list:
+        messages = [self._serialized(msg) for msg in self.current_messages]
+
+        # long simulations can outgrow the context window, in which case the oldest interactions are left out
+        return utils.truncate_messages_to_max_tokens(messages)
+
+    def _handle_streamed_member(self, name, value):
+        """
+        Handles a member of a response that is still being streamed. The action is only displayed here: it is handed to 
+        the environment once the whole response was parsed and stored (see act), since the response may still turn out to be 
+        invalid and be produced again.
+        """
+        if name != "action":
+            return
+
+        logger.debug(f"[{self.name}] Streamed action: {value}")
+        self._streamed_action = value
+
+        if TinyPerson.communication_display:
+            self._display_communication(role="assistant", content={"action": value}, kind='action', simplified=True, 
+                                        max_content_length=self._streamed_display_length)
+
+    def _dispatches_streamed_actions(self) -> bool:
+        # while the agents of the environment act in parallel, their actions are only handled at the end of the step
+        return self.environment is not None and not self.environment._deferring_actions
+
     ###########################################################
     # Internal cognitive state changes
     ###########################################################
@@ -822,8 +1040,11 @@ class TinyPerson(JsonSerializableRegistry):
             self._mental_state["emotions"] = emotions
         
         # update relevant memories for the current situation
-        current_memory_context = self.retrieve_relevant_memories_for_current_context()
-        self._mental_state["memory_context"] = current_memory_context
+        if self.prefetch_relevant_memories:
+            self._prefetch_relevant_memories_for_current_context()
+        else:
+            current_memory_context = self.retrieve_relevant_memories_for_current_context()
+            self._mental_state["memory_context"] = current_memory_context
 
         self.reset_prompt()
         
@@ -857,12 +1078,94 @@ class TinyPerson(JsonSerializableRegistry):
 
         return episodes
 
+    def _retrieve_session_memories(self) -> list:
+        """
+        The recent memories used in chat-session mode. Unlike in `retrieve_recent_memories`, the window of recent episodes only
+        moves forward once it grew SESSION_WINDOW_SLACK beyond its lookback length, so that in between the messages only grow
+        by appending, and the chat session needs no resynchronization.
+        """
+        memory = self.episodic_memory
+        if self._session_window_start is None or \
+           memory.count() - self._session_window_start > memory.lookback_length * (1 + TinyPerson.SESSION_WINDOW_SLACK):
+            self._session_window_start = max(memory.fixed_prefix_length, memory.count() - memory.lookback_length)
+
+        return memory.retrieve_recent_since(self._session_window_start)
+
     def retrieve_relevant_memories(self, relevance_target:str, top_k=20) -> list:
         relevant = self.semantic_memory.retrieve_relevant(relevance_target, top_k=top_k)
 
         return relevant
 
     def retrieve_relevant_memories_for_current_context(self, top_k=7) -> list:
+        """
+        Retrieves the memories relevant to the current context. The result is memoized, so the retrieval is skipped
+        until the cognitive state, the episodic memory or the semantic memory change.
+        """
+        key = self._relevance_key(top_k)
+        if key is None:
+            return []
+        if self._relevant_memories_memo is not None and self._relevant_memories_memo[0] == key:
+            return list(self._relevant_memories_memo[1])
+
+        semantic_memory_version, top_k, relevance_target = key
+        relevant = self.retrieve_relevant_memories(relevance_target, top_k=top_k)
+        self._relevant_memories_memo = (key, relevant)
+
+        return list(relevant)
+
+    def _relevance_key(self, top_k:int):
+        """
+        What the retrieval of relevant memories for the current context depends on, or None if there is nothing to retrieve.
+        The relevance target itself is part of it, so the retrieval is only repeated if the recent episodes or the mental 
+        state it is made of actually read differently, not merely because more episodes were stored.
+        """
+        semantic_memory_version = self.semantic_memory.version()
+        if semantic_memory_version == 0:
+            return None
+
+        return (semantic_memory_version, top_k, self._relevance_target())
+
+    def _prefetch_relevant_memories_for_current_context(self, top_k=7):
+        """
+        Starts retrieving the memories relevant to the current context in the background. The memory context of the mental 
+        state is updated once the retrieval is resolved (see _resolve_relevant_memories_prefetch).
+        """
+        self._resolve_relevant_memories_prefetch()
+
+        key = self._relevance_key(top_k)
+        if key is None or (self._relevant_memories_memo is not None and self._relevant_memories_memo[0] == key):
+            # nothing to wait for
+            self._mental_state["memory_context"] = self.retrieve_relevant_memories_for_current_context(top_k=top_k)
+            return
+
+        semantic_memory_version, top_k, relevance_target = key
+        future = TinyPerson._background_executor().submit(contextvars.copy_context().run, 
+                                                           self.retrieve_relevant_memories, relevance_target, top_k)
+        self._relevant_memories_prefetch = (key, future)
+
+    def _resolve_relevant_memories_prefetch(self):
+        """
+        Waits for the retrieval of relevant memories running in the background, if any, and updates the memory context with it.
+        """
+        if self._relevant_memories_prefetch is None:
+            return
+
+        key, future = self._relevant_memories_prefetch
+        self._relevant_memories_prefetch = None
+
+        relevant = future.result()
+        self._relevant_memories_memo = (key, relevant)
+        self._mental_state["memory_context"] = list(relevant)
+
+    @staticmethod
+    def _background_executor() -> concurrent.futures.ThreadPoolExecutor:
+        with TinyPerson._background_executor_lock:
+            if TinyPerson._background_executor_instance is None:
+                TinyPerson._background_executor_instance = concurrent.futures.ThreadPoolExecutor(max_workers=TinyPerson.MAX_BACKGROUND_RETRIEVALS,
+                                                                                                 thread_name_prefix="tinytroupe-memory")
+            return TinyPerson._background_executor_instance
+
+    def _relevance_target(self) -> str:
         # current context is composed of th recent memories, plus context, goals, attention, and emotions
         context = self._mental_state["context"]
         goals = self._mental_state["goals"]
@@ -882,7 +1185,7 @@ class TinyPerson(JsonSerializableRegistry):
 
         logger.debug(f"Retrieving relevant memories for contextual target: {target}")
 
-        return self.retrieve_relevant_memories(target, top_k=top_k)
+        return target
 
 
     ###########################################################
@@ -1016,7 +1319,7 @@ class TinyPerson(JsonSerializableRegistry):
 
         if self._extended_agent_summary is None and extended:
             logger.debug(f"Generating extended agent summary for {self.name}.")
-            self._extended_agent_summary = openai_utils.LLMRequest(
+            summary_request = openai_utils.LLMRequest(
                                                 system_prompt="""
                                                 You are given a short biography of an agent, as well as a detailed specification of his or her other characteristics
                                                 You must then produce a short paragraph (3 or 4 sentences) that **complements** the short biography, adding details about
@@ -1029,7 +1332,9 @@ class TinyPerson(JsonSerializableRegistry):
                                                 **Short biography:** {base_biography}
 
                                                 **Detailed specification:** {self._persona}
-                                                """).call()
+                                                """)
+            with openai_utils.call_context(agent=self.name, simulation_id=self.simulation_id):
+                self._extended_agent_summary = summary_request.call()
 
         if extended:
             biography = f"{base_biography} {self._extended_agent_summary}"
@@ -1219,6 +1524,9 @@ class TinyPerson(JsonSerializableRegistry):
         
         suppress_attributes = []
 
+        # the memory context must be up to date
+        self._resolve_relevant_memories_prefetch()
+
         # should we include the memory?
         if not include_memory:
             suppress_attributes.append("episodic_memory")
@@ -1264,11 +1572,18 @@ class TinyPerson(JsonSerializableRegistry):
         Encodes the complete state of the TinyPerson, including the current messages, accessible agents, etc.
         This is meant for serialization and caching purposes, not for exporting the state to the user.
         """
+        self._resolve_relevant_memories_prefetch()
+
         to_copy = copy.copy(self.__dict__)
 
         # delete the logger and other attributes that cannot be serialized
         del to_copy["environment"]
         del to_copy["_mental_faculties"]
+        del to_copy["_chat_session"]
+        del to_copy["_system_prompt_memo"]
+        del to_copy["_serialization_cache"]
+        del to_copy["_relevant_memories_memo"]
+        del to_copy["_relevant_memories_prefetch"]
 
         to_copy["_accessible_agents"] = [agent.name for agent in self._accessible_agents]
         to_copy['episodic_memory'] = self.episodic_memory.to_json()
@@ -1301,6 +1616,9 @@ class TinyPerson(JsonSerializableRegistry):
 
         # restore other fields
         self.__dict__.update(state)
+        self._system_prompt_memo = None
+        self._relevant_memories_memo = None
+        self._relevant_memories_prefetch = None
 
 
         return self
@@ -1319,6 +1637,7 @@ class TinyPerson(JsonSerializableRegistry):
         new_persona['name'] = new_name
 
         new_agent._persona = new_persona
+        new_agent._persona_changed()
 
         return new_agent
         
@@ -24,7 +24,8 @@ class TinyEnricher(JsonSerializableRegistry):
                                                                      base_module_folder = "enrichment",
                                                                      rendering_configs=rendering_configs)
         
-        next_message = openai_utils.client().send_message(messages, temperature=1.0, frequency_penalty=0.0, presence_penalty=0.0)
+        with openai_utils.call_context(priority="background"):
+            next_message = openai_utils.client().send_message(messages, temperature=1.0, frequency_penalty=0.0, presence_penalty=0.0)
         
         debug_msg = f"Enrichment result message: {next_message}"
         logger.debug(debug_msg)
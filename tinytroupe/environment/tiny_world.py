@@ -30,7 +30,8 @@ class TinyWorld:
                  initial_datetime=datetime.now(),
                  interventions=[],
                  broadcast_if_no_target=True,
-                 max_additional_targets_to_display=3):
+                 max_additional_targets_to_display=3,
+                 parallel_agent_actions=None):
         """
         Initializes an environment.
 
@@ -43,11 +44,14 @@ class TinyWorld:
             broadcast_if_no_target (bool): If True, broadcast actions if the target of an action is not found.
             max_additional_targets_to_display (int): The maximum number of additional targets to display in a communication. If None, 
                 all additional targets are displayed.
+            parallel_agent_actions (bool): If True, agents act concurrently in each step (see _step). If None, PARALLEL_AGENT_ACTIONS
+                from the configuration is used.
         """
 
         self.name = name
         self.current_datetime = initial_datetime
         self.broadcast_if_no_target = broadcast_if_no_target
+        self.parallel_agent_actions = parallel_agent_actions if parallel_agent_actions is not None else default["parallel_agent_actions"]
         self.simulation_id = None # will be reset later if the agent is used within a specific simulation scope
         
         self.agents = []
@@ -55,6 +59,9 @@ class TinyWorld:
 
         self._interventions = interventions
 
+        # whether the actions of the agents are currently being held back until the end of the step (see _step)
+        self._deferring_actions = False
+
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
@@ -80,6 +87,10 @@ class TinyWorld:
         simply calls makes all agents in the environment act and properly
         handle the resulting actions. Subclasses might override this method to implement 
         different policies.
+
+        If parallel_agent_actions is set, the agents act concurrently, so that the step takes about as long as its slowest agent.
+        They all act on what they perceived up to the step, and their actions are only handled once all of them are done, in the 
+        order of the agents, so that the outcome does not depend on which agent happens to finish first.
         """
         # increase current datetime if timedelta is given. This must happen before
         # any other simulation updates, to make sure that the agents are acting
@@ -96,6 +107,9 @@ class TinyWorld:
                 
                 logger.debug(f"[{self.name}] Intervention '{intervention.name}' was applied.")
 
+        if self.parallel_agent_actions and len(self.agents) > 1:
+            return self._step_agents_in_parallel()
+
         # agents can act
         agents_actions = {}
         for agent in self.agents:
@@ -103,9 +117,29 @@ class TinyWorld:
             actions = agent.act(return_actions=True)
             agents_actions[agent.name] = actions
 
+            # if responses are streamed, the agent already handed each action to the environment as soon as its response 
+            # was complete (see TinyPerson.act), so only the remaining ones are handled here
             self._handle_actions(agent, agent.pop_latest_actions())
         
         return agents_actions
+
+    def _step_agents_in_parallel(self):
+        def aux_act(agent):
+            logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
+            return agent.act(return_actions=True)
+
+        self._deferring_actions = True
+        try:
+            actions = utils.run_concurrently(aux_act, self.agents, max_workers=default["max_parallel_agents"])
+        finally:
+            self._deferring_actions = False
+
+        agents_actions = {}
+        for agent, agent_actions in zip(self.agents, actions):
+            agents_actions[agent.name] = agent_actions
+            self._handle_actions(agent, agent.pop_latest_actions())
+
+        return agents_actions
         
 
     def _advance_datetime(self, timedelta):
@@ -32,10 +32,21 @@ class Proposition:
         self.justification = None
         self.confidence = None
     
-    def __call__(self, additional_context=None):
-        return self.check(additional_context=additional_context)
+    def __call__(self, additional_context=None, justify:bool=False):
+        return self.check(additional_context=additional_context, justify=justify)
 
-    def check(self, additional_context="No additional context available."):
+    def check(self, additional_context="No additional context available.", justify:bool=False):
+        """
+        Checks whether the proposition holds.
+
+        Args:
+            additional_context (str): additional context to provide to the LLM
+            justify (bool): whether to also obtain a justification and a confidence for the verdict, which are stored in 
+              `justification` and `confidence`. Without them, the check takes only a few tokens.
+
+        Returns:
+            bool: whether the proposition holds
+        """
 
         context = ""
 
@@ -57,12 +68,6 @@ class Proposition:
                                     The context you receive can contain one or more of the following:
                                     - the trajectory of a simulation of one or more agents. This means what agents said, did, thought, or perceived at different times.
                                     - the state of the environment at a given time.
-                                
-                                    Your output **must**:
-                                      - necessarily start with the word "True" or "False";
-                                      - optionally be followed by a justification.
-                                 
-                                    For example, the output could be of the form: "True, because <REASON HERE>." or merely "True" if no justification is needed.
                                     """, 
 
                                     user_prompt=f"""
@@ -84,7 +89,8 @@ class Proposition:
                                     {additional_context}   
                                     """,
 
-                                    output_type=bool)
+                                    output_type=bool,
+                                    justify=justify)
         
 
         self.value = llm_request()
@@ -37,7 +37,8 @@ class Normalizer:
                                                                      base_module_folder="extraction",
                                                                      rendering_configs=rendering_configs)
         
-        next_message = openai_utils.client().send_message(messages, temperature=0.1)
+        with openai_utils.call_context(priority="background"):
+            next_message = openai_utils.client().send_message(messages, temperature=0.1)
         
         debug_msg = f"Normalization result message: {next_message}"
         logger.debug(debug_msg)
@@ -93,7 +94,8 @@ class Normalizer:
                                                                      base_module_folder="extraction",
                                                                      rendering_configs=rendering_configs)
             
-            next_message = openai_utils.client().send_message(messages, temperature=0.1)
+            with openai_utils.call_context(priority="background"):
+                next_message = openai_utils.client().send_message(messages, temperature=0.1)
             
             debug_msg = f"Normalization result message: {next_message}"
             logger.debug(debug_msg)
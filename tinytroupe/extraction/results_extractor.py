@@ -1,6 +1,5 @@
 import os
 import json
-import chevron
 import pandas as pd
 from typing import Union, List
 
@@ -107,9 +106,7 @@ class ResultsExtractor:
             rendering_configs["fields_hints"] = list(fields_hints.items())
         
         messages.append({"role": "system", 
-                         "content": chevron.render(
-                             open(self._extraction_prompt_template_path).read(), 
-                             rendering_configs)})
+                         "content": utils.render_template(self._extraction_prompt_template_path, rendering_configs)})
 
 
         interaction_history = tinyperson.pretty_current_interactions(max_content_length=None)
@@ -133,7 +130,8 @@ performed.
 """
         messages.append({"role": "user", "content": extraction_request_prompt})
 
-        next_message = openai_utils.client().send_message(messages, temperature=0.0, frequency_penalty=0.0, presence_penalty=0.0)
+        with openai_utils.call_context(agent=tinyperson.name, priority="background"):
+            next_message = openai_utils.client().send_message(messages, temperature=0.0, frequency_penalty=0.0, presence_penalty=0.0)
         
         debug_msg = f"Extraction raw result message: {next_message}"
         logger.debug(debug_msg)
@@ -184,9 +182,7 @@ performed.
             rendering_configs["fields_hints"] = list(fields_hints.items())
         
         messages.append({"role": "system", 
-                         "content": chevron.render(
-                             open(self._extraction_prompt_template_path).read(), 
-                             rendering_configs)})
+                         "content": utils.render_template(self._extraction_prompt_template_path, rendering_configs)})
 
         # TODO: either summarize first or break up into multiple tasks
         interaction_history = tinyworld.pretty_current_interactions(max_content_length=None)
@@ -210,7 +206,8 @@ Each interaction history includes stimuli the corresponding agent received as we
 """
         messages.append({"role": "user", "content": extraction_request_prompt})
 
-        next_message = openai_utils.client().send_message(messages, temperature=0.0)
+        with openai_utils.call_context(priority="background"):
+            next_message = openai_utils.client().send_message(messages, temperature=0.0)
         
         debug_msg = f"Extraction raw result message: {next_message}"
         logger.debug(debug_msg)
@@ -1,7 +1,7 @@
 import pandas as pd
 
 from tinytroupe.extraction import logger
-from tinytroupe.agent import TinyPerson
+from tinytroupe.agent import TinyPerson, Episode
 
 
 class ResultsReducer:
@@ -25,9 +25,7 @@ class ResultsReducer:
 
             elif message['role'] == 'user':
                 # User role is related to stimuli only
-                stimulus_type = message['content']['stimuli'][0]['type']
-                stimulus_content = message['content']['stimuli'][0]['content']
-                stimulus_source = message['content']['stimuli'][0]['source']
+                stimulus_type, stimulus_content, stimulus_source = Episode.stimuli_of(message)[0]
                 stimulus_timestamp = message['simulation_timestamp']
 
                 if stimulus_type in self.rules:
@@ -37,10 +35,9 @@ class ResultsReducer:
 
             elif message['role'] == 'assistant':
                 # Assistant role is related to actions only
-                if 'action' in message['content']: 
-                    action_type = message['content']['action']['type']
-                    action_content = message['content']['action']['content']
-                    action_target = message['content']['action']['target']
+                action = Episode.action_of(message)
+                if action is not None: 
+                    action_type, action_content, action_target = action
                     action_timestamp = message['simulation_timestamp']
                     
                     if action_type in self.rules:
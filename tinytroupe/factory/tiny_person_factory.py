@@ -85,39 +85,11 @@ class TinyPersonFactory(TinyFactory):
 
         logger.info(f"Starting the person generation based on that context: {self.context_text}")
 
-    
-        # read example specs from files. 
-        example_1 = json.load(open(os.path.join(os.path.dirname(__file__), '../examples/agents/Friedrich_Wolf.agent.json')))
-        example_2 = json.load(open(os.path.join(os.path.dirname(__file__), '../examples/agents/Sophie_Lefevre.agent.json')))
-
-        # We must include all agent names generated in the whole of the simulation, not only the ones generated by this factory,
-        # since they all share the same name space.
-        #
-        # For the minibios, we only need to keep track of the ones generated by this factory, since they are unique to each factory
-        # and are used to guide the sampling process.
-        prompt = chevron.render(open(self.person_prompt_template_path).read(), {
-            "context": self.context_text,
-            "agent_particularities": agent_particularities,
-            
-            #Note that we need to dump them to JSON strings, to ensure we get double quotes,
-            # and other formatting issues are avoided.
-            "example_1": json.dumps(example_1["persona"], indent=4),
-            "example_2": json.dumps(example_2["persona"], indent=4),
-
-            "already_generated_minibios": self.generated_minibios,
-            "already_generated_names": TinyPerson.all_agents_names()
-        })
+        prompt = self._person_generation_prompt(agent_particularities)
 
         def aux_generate(attempt):
 
-            messages = []
-            messages += [{"role": "system", "content": "You are a system that generates specifications for realistic simulations of people. You follow the generation rules and constraints carefully."},
-                        {"role": "user", "content": prompt}]
-            
-            if attempt > 1:
-                # we failed once already due to repetition, so we try to further reinforce the message to avoid repetition.
-                messages.append({"role": "user", "content": "IMPORTANT: Please ensure you **do not** generate the same name again. Agent names **must** be unique."+ \
-                                                            "Read the list of already generated names to avoid repetition. If necessary, generate a longer name to ensure it is new."})
+            messages = TinyPersonFactory._person_generation_messages(prompt, attempt)
 
             # due to a technicality, we need to call an auxiliary method to be able to use the transactional decorator.
             message = self._aux_model_call(messages=messages, 
@@ -179,6 +151,15 @@ class TinyPersonFactory(TinyFactory):
         Returns:
             list: A list of TinyPerson instances generated using the LLM.
         """
+        if openai_utils.batch_mode_enabled():
+            # one at a time, each model call would wait for a whole batch job
+            return self._generate_people_in_rounds(number_of_people, agent_particularities=agent_particularities,
+                                                   temperature=temperature,
+                                                   frequency_penalty=frequency_penalty,
+                                                   presence_penalty=presence_penalty,
+                                                   rounds=attepmpts,
+                                                   verbose=verbose)
+
         people = []
         for i in range(number_of_people):
             person = self.generate_person(agent_particularities=agent_particularities, 
@@ -196,6 +177,101 @@ class TinyPersonFactory(TinyFactory):
                 logger.error(f"Could not generate person {i+1}/{number_of_people}.")
 
         return people
+
+    def _generate_people_in_rounds(self, number_of_people:int, 
+                                   agent_particularities:str=None, 
+                                   temperature:float=1.5, 
+                                   frequency_penalty:float=0.0,
+                                   presence_penalty:float=0.0,
+                                   rounds:int=10, 
+                                   verbose:bool=False) -> list:
+        """
+        Generates people in rounds, for batch mode (see `openai_utils.batch_mode`). In each round, the specifications of all
+        the people still missing are requested at once, and then their extended minibios, so that each round takes two
+        batch jobs, regardless of how many people it generates. Specifications with names already generated are discarded,
+        and requested again in the next round.
+        """
+        people = []
+        round_number = 0
+        while len(people) < number_of_people and round_number < rounds:
+            round_number += 1
+            missing = number_of_people - len(people)
+            prompt = self._person_generation_prompt(agent_particularities)
+
+            # the calls of a round would otherwise be identical, and hence get the same response
+            list_of_messages = [TinyPersonFactory._person_generation_messages(prompt, round_number) + \
+                                [{"role": "user", "content": f"This is specification {i+1} of {missing} being generated at the same time. Make it clearly different from the others."}]
+                                for i in range(missing)]
+            messages = self._aux_model_calls(list_of_messages=list_of_messages, 
+                                             temperature=temperature,
+                                             frequency_penalty=frequency_penalty,
+                                             presence_penalty=presence_penalty)
+
+            new_people = []
+            for message in messages:
+                try:
+                    agent_spec = utils.extract_json(message["content"]) if message is not None else None
+                    if agent_spec is None or agent_spec["name"].lower() in self.generated_names:
+                        logger.info(f"Discarding a generated person specification, since it is missing or its name was already generated.")
+                        continue
+
+                    person = TinyPerson(agent_spec["name"])
+                    self._setup_agent(person, agent_spec)
+                    self.generated_names.append(person.get("name").lower())
+                    new_people.append(person)
+                except Exception as e:
+                    logger.error(f"Error while generating agent specification: {e}")
+
+            for person, minibio in zip(new_people, self._aux_minibios(new_people)):
+                self.generated_minibios.append(minibio)
+                people.append(person)
+                info_msg = f"Generated person {len(people)}/{number_of_people}: {minibio}"
+                logger.info(info_msg)
+                if verbose:
+                    print(info_msg)
+
+        if len(people) < number_of_people:
+            logger.error(f"Could only generate {len(people)} of {number_of_people} people after {round_number} rounds.")
+
+        return people
+
+    def _person_generation_prompt(self, agent_particularities:str=None) -> str:
+        """
+        Renders the prompt that asks for the specification of a new person.
+        """
+        # read example specs from files. 
+        example_1 = json.load(open(os.path.join(os.path.dirname(__file__), '../examples/agents/Friedrich_Wolf.agent.json')))
+        example_2 = json.load(open(os.path.join(os.path.dirname(__file__), '../examples/agents/Sophie_Lefevre.agent.json')))
+
+        # We must include all agent names generated in the whole of the simulation, not only the ones generated by this factory,
+        # since they all share the same name space.
+        #
+        # For the minibios, we only need to keep track of the ones generated by this factory, since they are unique to each factory
+        # and are used to guide the sampling process.
+        return utils.render_template(self.person_prompt_template_path, {
+            "context": self.context_text,
+            "agent_particularities": agent_particularities,
+            
+            #Note that we need to dump them to JSON strings, to ensure we get double quotes,
+            # and other formatting issues are avoided.
+            "example_1": json.dumps(example_1["persona"], indent=4),
+            "example_2": json.dumps(example_2["persona"], indent=4),
+
+            "already_generated_minibios": self.generated_minibios,
+            "already_generated_names": TinyPerson.all_agents_names()
+        })
+
+    @staticmethod
+    def _person_generation_messages(prompt:str, attempt:int) -> list:
+        messages = []
+        messages += [{"role": "system", "content": "You are a system that generates specifications for realistic simulations of people. You follow the generation rules and constraints carefully."},
+                    {"role": "user", "content": prompt}]
+        
+        if attempt > 1:
+            # we failed once already due to repetition, so we try to further reinforce the message to avoid repetition.
+            messages.append({"role": "user", "content": "IMPORTANT: Please ensure you **do not** generate the same name again. Agent names **must** be unique."+ \
+                                                        "Read the list of already generated names to avoid repetition. If necessary, generate a longer name to ensure it is new."})
+        return messages
     
     @transactional
     def _aux_model_call(self, messages, temperature, frequency_penalty, presence_penalty):
@@ -210,6 +286,31 @@ class TinyPersonFactory(TinyFactory):
                                                   presence_penalty=presence_penalty,
                                                   response_format={"type": "json_object"})
     
+    @transactional
+    def _aux_model_calls(self, list_of_messages, temperature, frequency_penalty, presence_penalty):
+        """
+        Like `_aux_model_call`, but for several calls, which are made concurrently, so that in batch mode they go to the same 
+        batch job. Failed calls give None.
+        """
+        def call(messages):
+            try:
+                return self._aux_model_call(messages=messages, 
+                                            temperature=temperature, 
+                                            frequency_penalty=frequency_penalty, 
+                                            presence_penalty=presence_penalty)
+            except Exception as e:
+                logger.error(f"Error while generating agent specification: {e}")
+                return None
+
+        return utils.run_concurrently(call, list_of_messages)
+
+    @transactional
+    def _aux_minibios(self, people):
+        """
+        Generates the extended minibios of the given people concurrently, so that in batch mode they go to the same batch job.
+        """
+        return utils.run_concurrently(lambda person: person.minibio(), people)
+
     @transactional
     def _setup_agent(self, agent, configuration):
         """
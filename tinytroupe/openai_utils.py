@@ -1,8 +1,30 @@
 import os
+import sys
+import enum
 import json
+import math
+import time
+import uuid
+import random
+import inspect
+import textwrap
+import sqlite3
+import hashlib
+import asyncio
+import datetime
 import logging
+import threading
+import functools
+import contextlib
+import contextvars
+import collections
+import concurrent.futures
 import google.generativeai as genai
-from pydantic import BaseModel # TinyTroupe'un Pydantic modellerini kullanabilmesi için
+from pydantic import BaseModel, Field, ValidationError, create_model # TinyTroupe'un Pydantic modellerini kullanabilmesi için
+
+import tinytroupe.utils as utils
+
+logger = logging.getLogger("tinytroupe")
 
 # Bu, TinyTroupe'un varsayılan olarak kullandığı Pydantic modeli olabilir.
 # Eğer kütüphanede farklı bir import yolu varsa, onu kullanın.
@@ -20,18 +42,1316 @@ except ImportError:
         args: dict = {}
 
 
-class LLMProvider:
-    _instance = None
-    _retries = 5  # Hata durumunda tekrar deneme sayısı
-    _retry_delay = 1.0 # Tekrar deneme gecikmesi
+# We'll use various configuration elements below
+config = utils.read_config_file()
 
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._setup_from_config()
-        return cls._instance
+###########################################################################
+# Default parameter values
+###########################################################################
+default = {}
+default["api_type"] = config["OpenAI"].get("API_TYPE", "gemini")
+default["timeout"] = float(config["OpenAI"].get("TIMEOUT", "60"))
+default["stream_responses"] = config["OpenAI"].getboolean("STREAM_RESPONSES", False)
+default["max_concurrent_requests"] = int(config["OpenAI"].get("MAX_CONCURRENT_REQUESTS", "16"))
+default["coalesce_requests"] = config["OpenAI"].getboolean("COALESCE_REQUESTS", False)
+default["adaptive_concurrency"] = config["OpenAI"].getboolean("ADAPTIVE_CONCURRENCY", False)
+default["min_concurrent_requests"] = int(config["OpenAI"].get("MIN_CONCURRENT_REQUESTS", "1"))
+default["max_adaptive_concurrent_requests"] = int(config["OpenAI"].get("MAX_ADAPTIVE_CONCURRENT_REQUESTS", "64"))
 
-    def _setup_from_config(self):
+default["max_attempts"] = int(config["OpenAI"].get("MAX_ATTEMPTS", "5"))
+default["waiting_time"] = float(config["OpenAI"].get("WAITING_TIME", "1"))
+default["exponential_backoff_factor"] = float(config["OpenAI"].get("EXPONENTIAL_BACKOFF_FACTOR", "5"))
+default["max_waiting_time"] = float(config["OpenAI"].get("MAX_WAITING_TIME", "60"))
+default["requests_per_minute"] = float(config["OpenAI"].get("REQUESTS_PER_MINUTE", "0"))
+default["tokens_per_minute"] = float(config["OpenAI"].get("TOKENS_PER_MINUTE", "0"))
+
+default["hedge_requests"] = config["OpenAI"].getboolean("HEDGE_REQUESTS", False)
+default["hedge_percentile"] = float(config["OpenAI"].get("HEDGE_PERCENTILE", "95"))
+default["circuit_breaker_failure_rate"] = float(config["OpenAI"].get("CIRCUIT_BREAKER_FAILURE_RATE", "0.5"))
+default["circuit_breaker_window"] = int(config["OpenAI"].get("CIRCUIT_BREAKER_WINDOW", "20"))
+default["circuit_breaker_cooldown"] = float(config["OpenAI"].get("CIRCUIT_BREAKER_COOLDOWN", "30"))
+
+default["prefix_caching"] = config["OpenAI"].getboolean("PREFIX_CACHING", False)
+default["prefix_cache_min_tokens"] = int(config["OpenAI"].get("PREFIX_CACHE_MIN_TOKENS", "0"))
+default["prefix_cache_ttl"] = float(config["OpenAI"].get("PREFIX_CACHE_TTL", "900"))
+
+default["cache_api_calls"] = config["OpenAI"].getboolean("CACHE_API_CALLS", False)
+default["cache_file_name"] = config["OpenAI"].get("CACHE_FILE_NAME", "llm_api_cache.sqlite")
+default["cache_max_entries"] = int(config["OpenAI"].get("CACHE_MAX_ENTRIES", "0"))
+default["cache_max_size_mb"] = float(config["OpenAI"].get("CACHE_MAX_SIZE_MB", "0"))
+default["cache_max_age_days"] = float(config["OpenAI"].get("CACHE_MAX_AGE_DAYS", "0"))
+
+default["telemetry_max_records"] = int(config["OpenAI"].get("TELEMETRY_MAX_RECORDS", "100000"))
+
+mock_config = config["Mock"] if config.has_section("Mock") else {}
+default["mock_latency_distribution"] = mock_config.get("LATENCY_DISTRIBUTION", "constant")
+default["mock_latency_mean"] = float(mock_config.get("LATENCY_MEAN", "0"))
+default["mock_latency_stddev"] = float(mock_config.get("LATENCY_STDDEV", "0"))
+default["mock_error_rate"] = float(mock_config.get("ERROR_RATE", "0"))
+default["mock_seed"] = int(mock_config.get("SEED", "42"))
+default["mock_capacity"] = int(mock_config.get("CAPACITY", "0"))
+
+pool_config = config["Pool"] if config.has_section("Pool") else {}
+default["pool_endpoints"] = [name.strip() for name in pool_config.get("ENDPOINTS", "").split(",") if name.strip() != ""]
+default["pool_failures_to_eject"] = int(pool_config.get("FAILURES_TO_EJECT", "3"))
+default["pool_ejection_time"] = float(pool_config.get("EJECTION_TIME", "30"))
+
+batch_config = config["Batch"] if config.has_section("Batch") else {}
+default["batch_directory"] = batch_config.get("DIRECTORY", "llm_batches")
+default["batch_max_requests"] = int(batch_config.get("MAX_REQUESTS", "1000"))
+default["batch_window"] = float(batch_config.get("WINDOW", "2"))
+default["batch_poll_interval"] = float(batch_config.get("POLL_INTERVAL", "30"))
+
+
+###########################################################################
+# Concurrency control
+###########################################################################
+# Request priorities, from the most to the least urgent. Interactive requests (e.g., agents' turns) are served before
+# background ones (e.g., extraction and enrichment), which only use the capacity left over.
+PRIORITIES = {"interactive": 0, "background": 1}
+
+def _priority_level(priority:str) -> int:
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{priority}'. Options: {list(PRIORITIES.keys())}.")
+    return PRIORITIES[priority]
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the number of LLM requests that are in flight at the same time. The same limiter is shared by
+    blocking callers (threads) and asyncio tasks, possibly running on different event loops, so that the
+    cap holds for the whole process regardless of how requests are issued. Free slots go to the waiting 
+    requests of the highest priority (see `PRIORITIES`) first.
+    """
+
+    def __init__(self, limit:int):
+        if limit < 1:
+            raise ValueError(f"The concurrency limit must be at least 1, but {limit} was given.")
+
+        self._limit = limit
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+        # how many threads wait for a slot, by priority level
+        self._waiting_threads = collections.Counter()
+
+        # asyncio tasks waiting for a slot, as (loop, future) pairs in arrival order, by priority level
+        self._async_waiters = {level: collections.deque() for level in PRIORITIES.values()}
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def set_limit(self, limit:int):
+        """
+        Changes the concurrency limit. Requests already in flight are not affected, but no new request
+        is admitted while the number of requests in flight is above the new limit.
+        """
+        if limit < 1:
+            raise ValueError(f"The concurrency limit must be at least 1, but {limit} was given.")
+
+        with self._condition:
+            self._limit = limit
+            self._wake_up_waiters()
+
+    def acquire(self, priority:str="interactive"):
+        """
+        Blocks the current thread until a request slot is available, and takes it.
+        """
+        level = _priority_level(priority)
+        with self._condition:
+            self._waiting_threads[level] += 1
+            try:
+                self._condition.wait_for(lambda: self._in_flight < self._limit and not self._waiters_before(level))
+            finally:
+                self._waiting_threads[level] -= 1
+            self._in_flight += 1
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a request slot if one is available right away, without waiting, and no request waits for one. 
+        Returns whether a slot was taken.
+        """
+        with self._condition:
+            if self._in_flight < self._limit and not self._waiters_before(len(PRIORITIES)):
+                self._in_flight += 1
+                return True
+            return False
+
+    async def acquire_async(self, priority:str="interactive"):
+        """
+        Waits, without blocking the event loop, until a request slot is available, and takes it.
+        """
+        level = _priority_level(priority)
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if self._in_flight < self._limit and not self._waiters_before(level) and len(self._async_waiters[level]) == 0:
+                self._in_flight += 1
+                return
+
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._async_waiters[level].append(waiter)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._condition:
+                if waiter in self._async_waiters[level]:
+                    # never got a slot, so there's nothing to give back
+                    self._async_waiters[level].remove(waiter)
+                elif future.done() and not future.cancelled():
+                    # got a slot, but the task was cancelled before it could use it
+                    self._in_flight -= 1
+                    self._wake_up_waiters()
+                # otherwise, the slot was granted but not yet delivered, and _deliver_slot will give it back
+            raise
+
+    def release(self):
+        """
+        Gives back a request slot, possibly waking up a waiting thread or task.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._wake_up_waiters()
+
+    def _waiters_before(self, level:int) -> bool:
+        """
+        Whether any thread or task of a higher priority than the given level waits for a slot.
+        """
+        return any(self._waiting_threads[higher_level] > 0 or len(self._async_waiters[higher_level]) > 0 
+                   for higher_level in range(level))
+
+    def _wake_up_waiters(self):
+        # must be called while holding the condition's lock
+        for level in sorted(self._async_waiters.keys()):
+            if any(self._waiting_threads[higher_level] > 0 for higher_level in range(level)):
+                break # threads of a higher priority go first
+
+            waiters = self._async_waiters[level]
+            while self._in_flight < self._limit and len(waiters) > 0:
+                loop, future = waiters.popleft()
+                self._in_flight += 1
+                try:
+                    loop.call_soon_threadsafe(self._deliver_slot, future)
+                except RuntimeError:
+                    # the waiter's loop is already closed, so the slot goes to the next one
+                    self._in_flight -= 1
+
+        self._condition.notify_all()
+
+    def _deliver_slot(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class AdaptiveConcurrency:
+    """
+    Adapts the limit of a `ConcurrencyLimiter` to what the backend can sustain, by additive increase and multiplicative 
+    decrease (AIMD): while calls succeed and the limit is fully used, the limit grows by about one per round of calls; when 
+    calls are throttled or fail, or their latency grows well above the lowest observed, it is cut by DECREASE_FACTOR. Cuts
+    happen at most once per typical call latency, so that a burst of failures of requests sent together counts as one signal.
+    """
+
+    DECREASE_FACTOR = 0.5
+
+    # the minimum time, in seconds, between two cuts, for when calls are fast (or no call succeeded yet)
+    MIN_DECREASE_INTERVAL = 0.1
+
+    # how much the latest latency weighs in the smoothed latency
+    LATENCY_SMOOTHING = 0.1
+
+    def __init__(self, limiter:ConcurrencyLimiter, min_limit:int=default["min_concurrent_requests"],
+                 max_limit:int=default["max_adaptive_concurrent_requests"], latency_tolerance:float=2.0, on_change=None):
+        """
+        Args:
+            limiter (ConcurrencyLimiter): The limiter whose limit is adapted. Its current limit is the starting point.
+            min_limit (int), max_limit (int): The bounds of the limit.
+            latency_tolerance (float): How many times the lowest observed latency the smoothed latency can reach before 
+              the limit is cut.
+            on_change (callable, optional): Called as on_change(limit, reason) whenever the limit changes.
+        """
+        self.limiter = limiter
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.on_change = on_change
+
+        self._increase_credit = 0.0
+        self._latency = None
+        self._baseline_latency = None
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+        self.limiter.set_limit(min(self.max_limit, max(self.min_limit, limiter.limit)))
+
+    @property
+    def limit(self) -> int:
+        return self.limiter.limit
+
+    def record_success(self, latency:float, in_flight:int):
+        """
+        Records a successful call, given its latency and how many calls were in flight when it started (including itself).
+        """
+        with self._lock:
+            self._latency = latency if self._latency is None else \
+                            (1 - AdaptiveConcurrency.LATENCY_SMOOTHING) * self._latency + AdaptiveConcurrency.LATENCY_SMOOTHING * latency
+            self._baseline_latency = self._latency if self._baseline_latency is None else min(self._baseline_latency, self._latency)
+
+            if self._latency > self.latency_tolerance * self._baseline_latency:
+                self._decrease("latency")
+            elif in_flight >= self.limiter.limit:
+                # the limit was a bottleneck, so there may be room for more
+                self._increase_credit += 1 / self.limiter.limit
+                if self._increase_credit >= 1:
+                    self._increase_credit = 0.0
+                    self._set_limit(self.limiter.limit + 1, "increase")
+
+    def record_failure(self, error:Exception):
+        """
+        Records a failed call. Errors that retrying can't fix say nothing about the backend's load, and are ignored.
+        """
+        if type(error).__name__ in RetryPolicy.NON_RETRYABLE_ERROR_NAMES:
+            return
+        with self._lock:
+            self._decrease(type(error).__name__)
+
+    def _decrease(self, reason:str):
+        # must be called while holding the lock
+        now = time.monotonic()
+        if now - self._last_decrease < max(AdaptiveConcurrency.MIN_DECREASE_INTERVAL, self._latency or 0.0):
+            return
+        self._last_decrease = now
+        self._increase_credit = 0.0
+        if reason == "latency":
+            # the lower limit should bring the latency down, so it's measured anew
+            self._latency = self._baseline_latency
+        self._set_limit(math.floor(self.limiter.limit * AdaptiveConcurrency.DECREASE_FACTOR), reason)
+
+    def _set_limit(self, limit:int, reason:str):
+        limit = min(self.max_limit, max(self.min_limit, limit))
+        if limit != self.limiter.limit:
+            self.limiter.set_limit(limit)
+            logger.debug(f"Concurrency limit set to {limit} ({reason}).")
+            if self.on_change is not None:
+                self.on_change(limit, reason)
+
+
+class _Flight:
+    """
+    A call in flight, whose outcome is shared by all the callers that asked for it.
+    """
+
+    def __init__(self):
+        self.leader_thread = threading.get_ident()
+        self.landed = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False # the leader was interrupted, so there is no outcome to share
+        self.followers = 0
+
+        # asyncio tasks waiting for the outcome, as (loop, future) pairs
+        self.async_waiters = []
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller (the leader) makes the call, and the others 
+    (the followers), which arrive while it is in flight, wait for its outcome instead of repeating it. Leaders and
+    followers may be threads or asyncio tasks, possibly running on different event loops. Errors are shared as well,
+    except for interruptions of the leader (e.g., task cancellations), after which the followers try again themselves.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced_calls = 0
+
+    def do(self, key, function):
+        """
+        Returns function(), unless a call with the same key is already in flight, in which case its outcome is returned instead.
+        """
+        while True:
+            flight, leader = self._join(key, blocking=True)
+            if flight is None:
+                # the flight is led from this very thread (e.g., by a task of its event loop), so waiting for it would never end
+                return function()
+            if leader:
+                return self._lead(key, flight, function)
+
+            flight.landed.wait()
+            if not flight.abandoned:
+                return self._outcome(flight)
+
+    async def do_async(self, key, coroutine_function):
+        """
+        Async counterpart of `do`, where the call is made by awaiting coroutine_function().
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            flight, leader = self._join(key, blocking=False)
+            if leader:
+                return await self._lead_async(key, flight, coroutine_function)
+
+            with self._lock:
+                if flight.landed.is_set():
+                    future = None
+                else:
+                    future = loop.create_future()
+                    waiter = (loop, future)
+                    flight.async_waiters.append(waiter)
+
+            if future is not None:
+                try:
+                    await future
+                except asyncio.CancelledError:
+                    with self._lock:
+                        if waiter in flight.async_waiters:
+                            flight.async_waiters.remove(waiter)
+                    raise
+
+            if not flight.abandoned:
+                return self._outcome(flight)
+
+    def in_flight(self) -> int:
+        """
+        How many distinct calls are in flight.
+        """
+        return len(self._flights)
+
+    def _join(self, key, blocking:bool):
+        """
+        Returns the flight for the key and whether the caller leads it, or (None, False) if a blocking caller would have 
+        to wait for a flight led from its own thread.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                return flight, True
+
+            if blocking and flight.leader_thread == threading.get_ident():
+                return None, False
+
+            flight.followers += 1
+            self.coalesced_calls += 1
+            return flight, False
+
+    def _lead(self, key, flight:_Flight, function):
+        try:
+            result = function()
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            self._land(key, flight, abandoned=True)
+            raise
+
+        self._land(key, flight, result=result)
+        return result
+
+    async def _lead_async(self, key, flight:_Flight, coroutine_function):
+        try:
+            result = await coroutine_function()
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            self._land(key, flight, abandoned=True)
+            raise
+
+        self._land(key, flight, result=result)
+        return result
+
+    def _land(self, key, flight:_Flight, result=None, error:Exception=None, abandoned:bool=False):
+        with self._lock:
+            del self._flights[key]
+            flight.result = result
+            flight.error = error
+            flight.abandoned = abandoned
+            flight.landed.set()
+
+            for loop, future in flight.async_waiters:
+                try:
+                    loop.call_soon_threadsafe(SingleFlight._wake_up, future)
+                except RuntimeError:
+                    pass # the waiter's loop is already closed
+            flight.async_waiters = []
+
+    @staticmethod
+    def _wake_up(future):
+        if not future.done():
+            future.set_result(None)
+
+    @staticmethod
+    def _outcome(flight:_Flight):
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+
+###########################################################################
+# Retries and rate limiting
+###########################################################################
+class RetryPolicy:
+    """
+    The single retry policy of the LLM client: failed calls are retried up to a maximum number of attempts, waiting an
+    exponentially growing, jittered, amount of time between them. Errors that cannot be fixed by trying again 
+    (e.g., invalid arguments or authentication problems) are not retried.
+    """
+
+    # gRPC/HTTP errors raised by the Google client libraries that will fail again if retried
+    NON_RETRYABLE_ERROR_NAMES = {"InvalidArgument", "BadRequest", "PermissionDenied", "Unauthenticated", "Unauthorized", 
+                                 "Forbidden", "NotFound", "MethodNotImplemented", "FailedPrecondition"}
+
+    def __init__(self, max_attempts:int=default["max_attempts"], 
+                 waiting_time:float=default["waiting_time"],
+                 exponential_backoff_factor:float=default["exponential_backoff_factor"],
+                 max_waiting_time:float=default["max_waiting_time"]):
+        """
+        Args:
+            max_attempts (int): The maximum number of attempts, including the first one.
+            waiting_time (float): The base waiting time, in seconds, before the first retry.
+            exponential_backoff_factor (float): The factor by which the waiting time grows after each failed retry.
+            max_waiting_time (float): The maximum waiting time, in seconds, between two attempts.
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.waiting_time = waiting_time
+        self.exponential_backoff_factor = exponential_backoff_factor
+        self.max_waiting_time = max_waiting_time
+
+    def should_retry(self, error:Exception, attempt:int) -> bool:
+        """
+        Whether a call that failed with the given error at the given attempt (starting at 1) should be tried again.
+        """
+        if attempt >= self.max_attempts:
+            return False
+
+        return type(error).__name__ not in RetryPolicy.NON_RETRYABLE_ERROR_NAMES
+
+    def waiting_time_before_retry(self, attempt:int) -> float:
+        """
+        How long to wait after the given failed attempt (starting at 1). The result is drawn uniformly from the upper half 
+        of the exponential backoff value, so that many clients failing at the same time do not retry in lockstep.
+        """
+        backoff = self.waiting_time * (self.exponential_backoff_factor ** (attempt - 1))
+        backoff = min(backoff, self.max_waiting_time)
+        return random.uniform(backoff / 2, backoff)
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at a given rate per minute. Takers reserve what they need and, if the bucket
+    does not have enough, wait until the deficit is refilled; reservations are served in arrival order, so the 
+    long-term rate never exceeds the configured one.
+    """
+
+    def __init__(self, rate_per_minute:float, capacity:float=None):
+        """
+        Args:
+            rate_per_minute (float): How many tokens are added to the bucket per minute.
+            capacity (float, optional): The maximum number of tokens the bucket can hold, i.e., the largest burst allowed. 
+              Defaults to the rate per minute.
+        """
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount:float) -> float:
+        """
+        Takes the given amount from the bucket, possibly going into debt, and returns how long the
+        taker must wait before the debt is paid.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate_per_second)
+            self._last_refill = now
+
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            else:
+                return -self._tokens / self.rate_per_second
+
+    def acquire(self, amount:float=1, priority:str="interactive"):
+        """
+        Takes the given amount of tokens, blocking the current thread while they are not available. Interactive takers reserve
+        their tokens right away, in arrival order; background takers only take tokens that are left over, without ever
+        delaying interactive ones.
+        """
+        if _priority_level(priority) == 0:
+            waiting_time = self._reserve(amount)
+            if waiting_time > 0:
+                time.sleep(waiting_time)
+        else:
+            while not self.try_acquire(min(amount, self.capacity)):
+                time.sleep(self._waiting_time_for(amount))
+            self.adjust(min(amount, self.capacity) - amount)
+
+    async def acquire_async(self, amount:float=1, priority:str="interactive"):
+        """
+        Takes the given amount of tokens, waiting without blocking the event loop while they are not available.
+        Priorities are as in `acquire`.
+        """
+        if _priority_level(priority) == 0:
+            waiting_time = self._reserve(amount)
+            if waiting_time > 0:
+                await asyncio.sleep(waiting_time)
+        else:
+            while not self.try_acquire(min(amount, self.capacity)):
+                await asyncio.sleep(self._waiting_time_for(amount))
+            self.adjust(min(amount, self.capacity) - amount)
+
+    def _waiting_time_for(self, amount:float) -> float:
+        """
+        How long until the bucket holds the given amount, if nobody else takes from it. Never less than 10ms, so that 
+        background takers do not spin.
+        """
+        with self._lock:
+            deficit = min(amount, self.capacity) - self._tokens
+        return max(0.01, deficit / self.rate_per_second)
+
+    def try_acquire(self, amount:float=1) -> bool:
+        """
+        Takes the given amount of tokens if they are available right away, without waiting. Returns whether they were taken.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate_per_second)
+            self._last_refill = now
+
+            if self._tokens < amount:
+                return False
+            self._tokens -= amount
+            return True
+
+    def adjust(self, amount:float):
+        """
+        Gives back (if positive) or takes (if negative) tokens without waiting. Useful to correct a reservation 
+        once the actual amount used is known.
+        """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class RateLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute limits, shared by all callers of the LLM client. A rate of 0 (or None)
+    disables the corresponding limit.
+    """
+
+    def __init__(self, requests_per_minute:float=None, tokens_per_minute:float=None):
+        self.requests_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, estimated_tokens:int, priority:str="interactive"):
+        """
+        Blocks until one more request, with the estimated number of tokens, fits in the limits. Background requests 
+        only use the budget that interactive ones leave over.
+        """
+        if self.requests_bucket is not None:
+            self.requests_bucket.acquire(1, priority)
+        if self.tokens_bucket is not None:
+            self.tokens_bucket.acquire(estimated_tokens, priority)
+
+    async def acquire_async(self, estimated_tokens:int, priority:str="interactive"):
+        """
+        Async counterpart of `acquire`.
+        """
+        if self.requests_bucket is not None:
+            await self.requests_bucket.acquire_async(1, priority)
+        if self.tokens_bucket is not None:
+            await self.tokens_bucket.acquire_async(estimated_tokens, priority)
+
+    def try_acquire(self, estimated_tokens:int) -> bool:
+        """
+        Takes one more request, with the estimated number of tokens, only if it fits in the limits right away.
+        """
+        if self.requests_bucket is not None and not self.requests_bucket.try_acquire(1):
+            return False
+        if self.tokens_bucket is not None and not self.tokens_bucket.try_acquire(estimated_tokens):
+            if self.requests_bucket is not None:
+                self.requests_bucket.adjust(1)
+            return False
+        return True
+
+    def record_usage(self, estimated_tokens:int, actual_tokens:int):
+        """
+        Corrects the tokens-per-minute budget once the actual token usage of a request is known.
+        """
+        if self.tokens_bucket is not None and actual_tokens is not None:
+            self.tokens_bucket.adjust(estimated_tokens - actual_tokens)
+
+
+###########################################################################
+# Tail latency control
+###########################################################################
+class LatencyTracker:
+    """
+    Keeps the latencies of the latest successful calls, to tell how long a call usually takes.
+    """
+
+    def __init__(self, window:int=200, min_samples:int=20):
+        """
+        Args:
+            window (int): How many of the latest latencies are kept.
+            min_samples (int): How many latencies are needed before percentiles are given.
+        """
+        self.min_samples = min_samples
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency:float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile:float) -> float:
+        """
+        Returns the given percentile (from 0 to 100) of the latest latencies, or None if there are not enough of them yet.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised, without calling the backend, while the circuit breaker is open.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a backend that is failing. When the share of failed calls among the latest ones reaches a threshold, the
+    circuit opens: calls fail right away with `CircuitOpenError` (which the retry policy then backs off from) instead of
+    piling up on the backend. After a cooldown, a single probe call is let through; if it succeeds the circuit closes,
+    otherwise it opens again for twice as long, up to 8 times the initial cooldown.
+    """
+
+    def __init__(self, failure_rate:float=default["circuit_breaker_failure_rate"],
+                 window:int=default["circuit_breaker_window"],
+                 cooldown:float=default["circuit_breaker_cooldown"]):
+        """
+        Args:
+            failure_rate (float): The share of failed calls, from 0 to 1, that opens the circuit. 0 disables the breaker.
+            window (int): How many of the latest calls are considered. The circuit never opens before that many calls were made.
+            cooldown (float): How long, in seconds, the circuit stays open before a probe call is let through.
+        """
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+
+        self._outcomes = collections.deque(maxlen=max(1, window)) # True for failures
+        self._opened_at = None
+        self._current_cooldown = cooldown
+        self._probing = False
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self):
+        """
+        Raises `CircuitOpenError` if the call must not be made.
+
+        Returns:
+            int: Identifies the call if it is the probe, None otherwise. A probe that ends without its outcome being recorded
+              must be given to `abandon_probe`, or the circuit would stay open.
+        """
+        if self.failure_rate <= 0:
+            return None
+
+        with self._lock:
+            if self._opened_at is None:
+                return None
+
+            remaining = self._opened_at + self._current_cooldown - time.monotonic()
+            if remaining > 0 or self._probing:
+                raise CircuitOpenError(f"The backend is failing too often; calls are suspended for {max(0, remaining):.1f} more seconds.")
+
+            # the cooldown is over, so this call probes whether the backend recovered
+            self._probing = True
+            self._probes += 1
+            return self._probes
+
+    def abandon_probe(self, probe:int):
+        """
+        Lets a later call probe the backend, if the given probe ended (e.g., was cancelled) before its outcome was recorded.
+        """
+        if probe is None:
+            return
+        with self._lock:
+            if self._probing and self._probes == probe:
+                self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("The backend recovered; closing the circuit breaker.")
+                self._opened_at = None
+                self._current_cooldown = self.cooldown
+                self._probing = False
+                self._outcomes.clear()
+            else:
+                self._outcomes.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self._opened_at is not None:
+                if self._probing:
+                    self._probing = False
+                    self._current_cooldown = min(2 * self._current_cooldown, 8 * self.cooldown)
+                    self._opened_at = time.monotonic()
+                    logger.warning(f"The backend is still failing; keeping the circuit breaker open for {self._current_cooldown:.1f} seconds.")
+                return
+
+            self._outcomes.append(True)
+            if self.failure_rate > 0 and len(self._outcomes) == self._outcomes.maxlen and \
+               sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                self._opened_at = time.monotonic()
+                logger.warning(f"{sum(self._outcomes)} of the latest {len(self._outcomes)} backend calls failed; "
+                               f"opening the circuit breaker for {self._current_cooldown:.1f} seconds.")
+
+
+###########################################################################
+# Response caching
+###########################################################################
+class LLMResponseCache:
+    """
+    A persistent, content-addressed cache of model responses, stored in a SQLite database. Entries are keyed by a stable
+    hash of everything that determines the response (see `compute_key`), so identical calls issued by a later run
+    are answered locally. Several processes may share the same cache file.
+
+    Eviction is controlled by a maximum number of entries, a maximum total size and a maximum age. A value of 0 (or None)
+    disables the corresponding limit. When there are too many entries or too much data, the least recently used ones go first.
+    """
+
+    # how many insertions between two automatic eviction passes
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, file_name:str, max_entries:int=None, max_size_mb:float=None, max_age_days:float=None):
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age_seconds = max_age_days * 24 * 60 * 60 if max_age_days else None
+
+        self.hits = 0
+        self.misses = 0
+        self._insertions_since_eviction = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_name, timeout=30, check_same_thread=False, isolation_level=None)
+        # WAL lets readers in other processes proceed while one process writes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed_at REAL NOT NULL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_accessed_at ON responses (last_accessed_at)")
+
+        self.evict()
+
+    @staticmethod
+    def compute_key(messages:list, model:str, generation_parameters:dict, response_schema) -> str:
+        """
+        Computes a stable key for a model call. Dicts are serialized with sorted keys, so the key does not depend on
+        the order in which parameters were given.
+        """
+        contents = {"messages": messages,
+                    "model": model,
+                    "generation_parameters": {k: v for k, v in generation_parameters.items() if v is not None},
+                    "response_schema": response_schema}
+
+        serialized = json.dumps(contents, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key:str):
+        """
+        Returns the cached response for the given key, or None if there is none (or if it has expired).
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is not None and self.max_age_seconds is not None and row[1] < now - self.max_age_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET last_accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, key:str, response):
+        """
+        Stores a (JSON-serializable) response under the given key.
+        """
+        serialized = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO responses (key, response, size, created_at, last_accessed_at) VALUES (?, ?, ?, ?, ?)",
+                                     (key, serialized, len(serialized.encode("utf-8")), now, now))
+            self._insertions_since_eviction += 1
+            should_evict = self._insertions_since_eviction >= LLMResponseCache.EVICTION_INTERVAL
+
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired entries, and then the least recently used ones until the size limits are respected.
+        """
+        with self._lock:
+            self._insertions_since_eviction = 0
+
+            if self.max_age_seconds is not None:
+                self._connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+
+            if self.max_entries:
+                self._connection.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY last_accessed_at DESC LIMIT -1 OFFSET ?
+                    )""", (self.max_entries,))
+
+            if self.max_size_bytes:
+                # keep the most recently used entries whose cumulative size fits in the budget
+                self._connection.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_accessed_at DESC, key) AS cumulative_size FROM responses
+                        ) WHERE cumulative_size > ?
+                    )""", (self.max_size_bytes,))
+
+    def clear(self):
+        """
+        Removes all entries and resets the counters.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters of this process, together with the current size of the cache.
+        """
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "entries": entries,
+                "size_bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+
+
+###########################################################################
+# Response schemas
+###########################################################################
+class UnsupportedSchemaError(Exception):
+    """
+    Raised when a response schema cannot be expressed in the subset of JSON schema that native structured output accepts.
+    """
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def response_json_schema(response_format) -> dict:
+    """
+    Returns the JSON schema of a Pydantic response format. It is computed once per model, and must not be modified.
+    """
+    return response_format.model_json_schema()
+
+@functools.lru_cache(maxsize=None)
+def compile_response_schema(response_format) -> dict:
+    """
+    Compiles the JSON schema of a Pydantic response format into the self-contained subset that native structured output
+    accepts: references are inlined, optional values become nullable, and annotations such APIs reject (titles, defaults,
+    additional properties) are dropped. It is computed once per model, and must not be modified.
+
+    Returns:
+        dict: The compiled schema, or None if the schema cannot be expressed in that subset (e.g., it has free-form objects).
+    """
+    schema = response_json_schema(response_format)
+    try:
+        return _compile_schema_node(schema, schema.get("$defs", {}), ())
+    except UnsupportedSchemaError as e:
+        logger.debug(f"The schema of {response_format.__name__} can't be used for native structured output: {e}")
+        return None
+
+def _compile_schema_node(node:dict, definitions:dict, references:tuple) -> dict:
+    if "$ref" in node:
+        name = node["$ref"].split("/")[-1]
+        if name in references:
+            raise UnsupportedSchemaError(f"recursive reference to {name}")
+        return _compile_schema_node(definitions[name], definitions, references + (name,))
+
+    if "anyOf" in node or "oneOf" in node:
+        options = node.get("anyOf", node.get("oneOf"))
+        non_null_options = [option for option in options if option.get("type") != "null"]
+        if len(non_null_options) != 1:
+            raise UnsupportedSchemaError("unions of several types")
+        compiled = dict(_compile_schema_node(non_null_options[0], definitions, references))
+        if len(non_null_options) < len(options):
+            compiled["nullable"] = True
+        if "description" in node:
+            compiled["description"] = node["description"]
+        return compiled
+
+    if "allOf" in node:
+        if len(node["allOf"]) != 1:
+            raise UnsupportedSchemaError("intersections of several schemas")
+        return _compile_schema_node(node["allOf"][0], definitions, references)
+
+    compiled = {key: node[key] for key in ("type", "format", "description", "enum") if key in node}
+    if "const" in node:
+        compiled["enum"] = [node["const"]]
+        compiled.setdefault("type", "string")
+
+    if compiled.get("type") == "object":
+        if not node.get("properties"):
+            raise UnsupportedSchemaError("objects without declared properties")
+        compiled["properties"] = {name: _compile_schema_node(property_node, definitions, references)
+                                  for name, property_node in node["properties"].items()}
+        compiled["required"] = list(node.get("required", []))
+    elif compiled.get("type") == "array":
+        if "items" not in node:
+            raise UnsupportedSchemaError("arrays without an item schema")
+        compiled["items"] = _compile_schema_node(node["items"], definitions, references)
+    elif "type" not in compiled:
+        raise UnsupportedSchemaError("values of any type")
+
+    return compiled
+
+
+###########################################################################
+# Prompt prefix caching
+###########################################################################
+class PromptPrefix:
+    """
+    The leading messages of a prompt, which the backend keeps cached on its side so that they need not be sent and 
+    processed again on every call. The handle is whatever the backend needs to refer to its cache.
+    """
+
+    def __init__(self, messages:list, message_hashes:list, tokens:int, handle, expires_at:float):
+        self.messages = messages
+        self.message_hashes = message_hashes
+        self.tokens = tokens
+        self.handle = handle
+        self.expires_at = expires_at
+
+    def is_prefix_of(self, message_hashes:list) -> bool:
+        # something must be left to send after the prefix
+        return len(message_hashes) > len(self.message_hashes) and message_hashes[:len(self.message_hashes)] == self.message_hashes
+
+
+class PromptPrefixCache:
+    """
+    Detects, for each scope (e.g., an agent), the leading messages that stay the same from one call to the next (e.g., the 
+    agent's system prompt and the oldest part of its episodic window), and asks the backend to cache them. Later calls whose messages
+    start with a cached prefix refer to it instead of resending it. Prefixes smaller than a minimum number of tokens are not worth
+    caching (or cannot be cached at all by the backend), and are ignored. A prefix that is replaced or invalidated is released
+    on the backend side right away, rather than being kept (and possibly billed) until it expires.
+    """
+
+    # how long before expiration a prefix stops being used, so that it does not expire in the middle of a call
+    EXPIRATION_MARGIN = 30
+
+    def __init__(self, min_tokens:int=default["prefix_cache_min_tokens"], ttl:float=default["prefix_cache_ttl"]):
+        """
+        Args:
+            min_tokens (int): The minimum size, in tokens, of a prefix worth caching. Smaller values are raised to the minimum the 
+              backend can cache (see `LLMBackend.min_cached_prefix_tokens`), so 0 means that minimum.
+            ttl (float): How long, in seconds, the backend keeps each prefix cached.
+        """
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+
+        self.prefixes_created = 0
+        self.hits = 0
+        self.saved_input_tokens = 0
+
+        self._last_messages = {} # scope -> (message, content, hash) for each message of the latest call
+        self._prefixes = {} # scope -> PromptPrefix, or None while caching is not possible for the scope
+        self._lock = threading.Lock()
+
+    def prefix_for(self, scope, messages:list, response_format, backend) -> PromptPrefix:
+        """
+        Returns the cached prefix to use for the given call, possibly creating it, or None if there is none.
+        """
+        if scope is None or not backend.supports_prefix_caching:
+            return None
+
+        # prompts that cannot hold a prefix worth caching are neither hashed nor tokenized
+        min_tokens = max(self.min_tokens, backend.min_cached_prefix_tokens)
+        if utils.max_tokens_from_messages(messages) < min_tokens:
+            return None
+
+        # the response format is part of what the backend caches (e.g., a schema instruction), so it is part of the scope
+        scope = (scope, getattr(response_format, "__name__", json.dumps(response_format, sort_keys=True, default=str)))
+        now = time.time()
+
+        with self._lock:
+            previous_messages = self._last_messages.get(scope)
+            hashed_messages = PromptPrefixCache._hashed_messages(messages, previous_messages)
+            self._last_messages[scope] = hashed_messages
+            message_hashes = [message_hash for _, _, message_hash in hashed_messages]
+            previous_hashes = [message_hash for _, _, message_hash in previous_messages] if previous_messages is not None else None
+
+            if scope in self._prefixes and now < self._prefixes[scope].expires_at - PromptPrefixCache.EXPIRATION_MARGIN:
+                prefix = self._prefixes[scope]
+                if prefix.handle is None:
+                    return None # creating the cache failed recently
+                elif prefix.is_prefix_of(message_hashes):
+                    return prefix
+
+            if previous_hashes is None:
+                return None
+
+            # the messages that did not change since the latest call, leaving out the last one, which must be sent anyway
+            stable_length = 0
+            while stable_length < min(len(previous_hashes), len(message_hashes) - 1) and \
+                  previous_hashes[stable_length] == message_hashes[stable_length]:
+                stable_length += 1
+
+        if stable_length == 0:
+            return None
+
+        tokens = utils.num_tokens_from_messages(messages[:stable_length])
+        if tokens < min_tokens:
+            return None
+
+        try:
+            handle = backend.cache_prefix(messages[:stable_length], response_format, self.ttl)
+        except Exception as e:
+            # e.g., the prefix is too small for this model; don't insist until the TTL expires
+            logger.warning(f"Could not cache a prompt prefix of {tokens} tokens: {type(e).__name__} - {e}")
+            handle = None
+
+        prefix = PromptPrefix(messages[:stable_length], message_hashes[:stable_length], tokens, handle, now + self.ttl)
+        with self._lock:
+            replaced_prefix = self._prefixes.get(scope)
+            self._prefixes[scope] = prefix
+            if handle is not None:
+                self.prefixes_created += 1
+
+        if replaced_prefix is not None and replaced_prefix is not prefix:
+            PromptPrefixCache._release(replaced_prefix, backend)
+
+        return prefix if handle is not None else None
+
+    def invalidate(self, prefix:PromptPrefix, backend):
+        """
+        Stops using the given prefix, e.g., because the backend no longer has it, and releases it on the backend side.
+        """
+        with self._lock:
+            scopes = [scope for scope, scope_prefix in self._prefixes.items() if scope_prefix is prefix]
+            for scope in scopes:
+                del self._prefixes[scope]
+
+        if len(scopes) > 0:
+            PromptPrefixCache._release(prefix, backend)
+
+    def record_usage(self, cached_input_tokens:int):
+        """
+        Records a call that was served with a cached prefix, which saved the given number of input tokens.
+        """
+        with self._lock:
+            self.hits += 1
+            self.saved_input_tokens += cached_input_tokens or 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"prefixes_created": self.prefixes_created,
+                    "hits": self.hits,
+                    "saved_input_tokens": self.saved_input_tokens}
+
+    @staticmethod
+    def _hashed_messages(messages:list, previous_messages:list) -> list:
+        """
+        Pairs each message with its hash. Callers that keep their serialized messages between calls (e.g., agents do) pass 
+        the same objects again, so the hashes of the latest call are reused for them, and only the new messages are hashed.
+        """
+        previous_hashes = {id(message): (message, content, message_hash) for message, content, message_hash in (previous_messages or [])}
+
+        hashed_messages = []
+        for message in messages:
+            previous_message, previous_content, message_hash = previous_hashes.get(id(message), (None, None, None))
+            if previous_message is not message or previous_content is not message["content"]:
+                message_hash = hashlib.sha256(f"{message['role']}:{message['content']}".encode("utf-8")).hexdigest()
+            hashed_messages.append((message, message["content"], message_hash))
+        return hashed_messages
+
+    @staticmethod
+    def _release(prefix:PromptPrefix, backend):
+        # an expired prefix is already gone from the backend
+        if prefix.handle is None or time.time() >= prefix.expires_at:
+            return
+        try:
+            backend.release_prefix(prefix.handle)
+        except Exception as e:
+            logger.warning(f"Could not release a cached prompt prefix of {prefix.tokens} tokens: {type(e).__name__} - {e}")
+
+
+###########################################################################
+# Model backends
+###########################################################################
+class LLMBackendResponse:
+    """
+    The result of one backend call: the generated text and, when the backend reports them, the token counts. Input tokens 
+    that were served from a cached prompt prefix are also counted in `cached_input_tokens`.
+    """
+
+    def __init__(self, text:str, input_tokens:int=None, output_tokens:int=None, cached_input_tokens:int=None):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cached_input_tokens = cached_input_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        if self.input_tokens is None and self.output_tokens is None:
+            return None
+        return (self.input_tokens or 0) + (self.output_tokens or 0)
+
+
+class LLMBackend:
+    """
+    A model backend turns one request into one response. Concurrency and rate limits, retries and caching are
+    not the backend's business: `LLMProvider` applies them in the same way to every backend.
+
+    Requests are given as:
+      - messages: a list of dicts with "role" and "content", in the OpenAI format.
+      - response_format: None, a dict in the OpenAI style (e.g., {"type": "json_object"}), or a Pydantic model.
+      - generation_parameters: the OpenAI-style generation parameters that were set (temperature, top_p, max_tokens, stop,
+        frequency_penalty, presence_penalty). Backends may ignore those they do not support.
+      - timeout: the maximum time, in seconds, the call may take.
+      - prefix: a `PromptPrefix` previously created by `cache_prefix`, with which the messages start, or None. Only given
+        to backends that support prefix caching.
+    """
+
+    # identifies the model, e.g. in response cache keys
+    model_name = None
+
+    # whether the backend implements `cache_prefix`
+    supports_prefix_caching = False
+
+    # the smallest prefix, in tokens, that the backend can cache
+    min_cached_prefix_tokens = 0
+
+    # how many requests the backend can serve at the same time, if it knows better than the MAX_CONCURRENT_REQUESTS configuration
+    max_concurrent_requests = None
+
+    def generate(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    async def generate_async(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        """
+        Async counterpart of `generate`. By default, runs `generate` in a worker thread; backends with a native
+        async API should override this.
+        """
+        return await asyncio.to_thread(self.generate, messages, response_format, generation_parameters, timeout, prefix)
+
+    def generate_stream(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None):
+        """
+        Streaming counterpart of `generate`: yields the response text in chunks, as they are produced. By default, 
+        the whole response is yielded as a single chunk; backends that can stream should override this.
+        """
+        yield self.generate(messages, response_format, generation_parameters, timeout, prefix).text
+
+    def cache_prefix(self, messages:list, response_format, ttl:float):
+        """
+        Caches the given leading messages on the backend side, for the given number of seconds, and returns a handle
+        that later calls can use to refer to them.
+        """
+        raise NotImplementedError("This backend does not support prefix caching.")
+
+    def release_prefix(self, handle):
+        """
+        Drops a prefix cached by `cache_prefix` before it expires, once it is no longer used.
+        """
+        pass
+
+    # whether the backend implements `submit_batch`, `batch_status` and `batch_results`
+    supports_batches = False
+
+    def submit_batch(self, requests:list) -> str:
+        """
+        Submits requests to be run offline, as a batch job, and returns the id of the job. Each request is a dict with a 
+        "custom_id" and the "messages", "response_format" and "generation_parameters" of the call. Since jobs outlive the
+        process, response formats are given in a serializable form: Pydantic models become OpenAI-style JSON schema formats, 
+        i.e., {"type": "json_schema", "json_schema": {"name": ..., "schema": ...}}.
+        """
+        raise NotImplementedError("This backend does not support batch jobs.")
+
+    def batch_status(self, batch_id:str) -> str:
+        """
+        Returns the status of a batch job: "in_progress", "completed" or "failed".
+        """
+        raise NotImplementedError("This backend does not support batch jobs.")
+
+    def batch_results(self, batch_id:str) -> dict:
+        """
+        Returns the results of a completed batch job, by custom id: an `LLMBackendResponse`, or an `LLMBatchError` for the 
+        requests that failed.
+        """
+        raise NotImplementedError("This backend does not support batch jobs.")
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Google Gemini, through the `google.generativeai` library. Requires the GOOGLE_API_KEY environment variable.
+    """
+
+    # prefixes are cached with context caching, which rejects contents smaller than this
+    supports_prefix_caching = True
+    min_cached_prefix_tokens = 32768
+
+    # Gemini API'sinden gelen olası içerik engellemelerini azaltmak için güvenlik ayarlarını düşür.
+    # Dikkat: Bu, daha az güvenli yanıtlar almanıza neden olabilir.
+    _safety_settings = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ]
+
+    # OpenAI-style generation parameters and their Gemini names
+    _generation_parameter_names = {"temperature": "temperature", "top_p": "top_p", "max_tokens": "max_output_tokens",
+                                   "stop": "stop_sequences", "frequency_penalty": "frequency_penalty", 
+                                   "presence_penalty": "presence_penalty"}
+
+    def __init__(self, model_name:str="gemini-1.5-flash"):
         # Gemini API anahtarını GOOGLE_API_KEY ortam değişkeninden al
         # Not: Kodunuz GEMINI_API_KEY olarak ayarlıyor, bunu GOOGLE_API_KEY olarak değiştirmelisiniz.
         api_key = os.getenv("GOOGLE_API_KEY") # Ya da GEMINI_API_KEY
@@ -40,10 +1360,70 @@ class LLMProvider:
         genai.configure(api_key=api_key)
         # Gemini modeli olarak gemini-1.5-flash kullanıyoruz.
         # İhtiyacınıza göre gemini-pro veya daha yeni bir model seçebilirsiniz.
-        self.model = genai.GenerativeModel("gemini-1.5-flash")
-        logging.info(f"Gemini model '{self.model.model_name}' başarıyla ayarlandı.")
+        self.model = genai.GenerativeModel(model_name)
+        self.model_name = self.model.model_name
+        self._cached_contents = {} # name -> CachedContent, for the prefixes cached with `cache_prefix`
+        self._cached_contents_lock = threading.Lock()
+        logging.info(f"Gemini model '{self.model_name}' başarıyla ayarlandı.")
 
-    def send_message(self, messages, response_format=None):
+    def generate(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        model, gemini_messages, generation_config = self._prepare_request(messages, response_format, generation_parameters or {}, prefix)
+        response = model.generate_content(
+            gemini_messages,
+            generation_config=generation_config,
+            safety_settings=self._safety_settings,
+            request_options={'timeout': timeout}
+        )
+        return self._process_response(response)
+
+    async def generate_async(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        model, gemini_messages, generation_config = self._prepare_request(messages, response_format, generation_parameters or {}, prefix)
+        response = await asyncio.wait_for(
+            model.generate_content_async(
+                gemini_messages,
+                generation_config=generation_config,
+                safety_settings=self._safety_settings,
+                request_options={'timeout': timeout}
+            ),
+            timeout=timeout)
+        return self._process_response(response)
+
+    def generate_stream(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None):
+        model, gemini_messages, generation_config = self._prepare_request(messages, response_format, generation_parameters or {}, prefix)
+        response = model.generate_content(
+            gemini_messages,
+            generation_config=generation_config,
+            safety_settings=self._safety_settings,
+            request_options={'timeout': timeout},
+            stream=True
+        )
+        for chunk in response:
+            yield self._process_response(chunk).text
+
+    def cache_prefix(self, messages:list, response_format, ttl:float):
+        # the messages are converted as they would be in a full request, so that the cached ones are exactly those that would be sent
+        _, gemini_messages, _ = self._prepare_request(messages, response_format, {})
+        cached_content = genai.caching.CachedContent.create(model=self.model_name,
+                                                            contents=gemini_messages,
+                                                            ttl=datetime.timedelta(seconds=ttl))
+
+        # the handle is a model bound to the cached contents
+        handle = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        with self._cached_contents_lock:
+            self._cached_contents[handle.cached_content] = cached_content
+        return handle
+
+    def release_prefix(self, handle):
+        with self._cached_contents_lock:
+            cached_content = self._cached_contents.pop(handle.cached_content, None)
+        if cached_content is not None:
+            cached_content.delete()
+
+    def _prepare_request(self, messages, response_format, generation_parameters, prefix=None):
+        """
+        Converts OpenAI-style messages into the Gemini format, and builds the corresponding generation configuration.
+        If a cached prefix is given, returns the model bound to it, and only the messages that follow it.
+        """
         # OpenAI mesaj formatını Gemini formatına dönüştür
         gemini_messages = []
         for msg in messages:
@@ -53,81 +1433,2252 @@ class LLMProvider:
             role_map = {"user": "user", "assistant": "model", "system": "user"}
             gemini_messages.append({"role": role_map.get(msg["role"], "user"), "parts": [{"text": msg["content"]}]})
 
-        generation_config = {}
-        if response_format:
+        generation_config = {GeminiBackend._generation_parameter_names[key]: value 
+                             for key, value in generation_parameters.items() 
+                             if key in GeminiBackend._generation_parameter_names}
+
+        if isinstance(response_format, dict):
+            # OpenAI-style JSON mode (e.g., {"type": "json_object"}), without a schema
+            if response_format.get("type") == "json_object":
+                generation_config["response_mime_type"] = "application/json"
+
+            # OpenAI-style JSON schema, as in batch jobs; the schema is given as an instruction
+            elif response_format.get("type") == "json_schema":
+                generation_config["response_mime_type"] = "application/json"
+                schema_json = json.dumps(response_format["json_schema"]["schema"])
+                if gemini_messages:
+                    first_msg_content = gemini_messages[0]["parts"][0]["text"]
+                    gemini_messages[0]["parts"][0]["text"] = f"Your response MUST be a JSON object conforming to this schema: {schema_json}\n\n{first_msg_content}"
+
+        elif response_format:
             # TinyTroupe'un Pydantic modeli beklediğini varsayarak JSON modunu etkinleştir.
             generation_config["response_mime_type"] = "application/json"
-            
-            # Gemini'ye JSON formatında yanıt vermesi gerektiğini belirten bir talimat ekle.
-            # Bu talimatı sohbetin ilk mesajına eklemek en etkili yöntemdir.
-            schema_json = json.dumps(response_format.model_json_schema())
-            if gemini_messages:
-                # İlk mesajın içeriğini al ve başına JSON talimatını ekle
-                first_msg_content = gemini_messages[0]["parts"][0]["text"]
-                gemini_messages[0]["parts"][0]["text"] = (
-                    f"Your response MUST be a JSON object conforming to this schema: {schema_json}\n\n"
-                    f"{first_msg_content}"
-                )
-            else:
-                # Konuşma boşsa, sadece talimatı içeren bir kullanıcı mesajı ekle
-                gemini_messages.append({"role": "user", "parts": [{"text": f"Your response MUST be a JSON object conforming to this schema: {schema_json}"}]})
-
-        # Gemini API'sinden gelen olası içerik engellemelerini azaltmak için güvenlik ayarlarını düşür.
-        # Dikkat: Bu, daha az güvenli yanıtlar almanıza neden olabilir.
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
 
-        attempt = 0
-        while attempt < self._retries:
-            try:
-                logging.info(f"Gemini API'ye istek gönderiliyor (Deneme {attempt + 1}/{self._retries})...")
-                response = self.model.generate_content(
-                    gemini_messages,
-                    generation_config=generation_config,
-                    safety_settings=safety_settings,
-                    request_options={'timeout': 120} # İstek zaman aşımını artır
-                )
-
-                # Prompt veya yanıtın engellenip engellenmediğini kontrol et
-                if response._result.prompt_feedback and response._result.prompt_feedback.block_reason:
-                    logging.error(f"Gemini API promptu engelledi: {response._result.prompt_feedback.block_reason}")
-                    raise Exception(f"Gemini API promptu engelledi: {response._result.prompt_feedback.block_reason}")
-                
-                if response._result.candidates:
-                    for candidate in response._result.candidates:
-                        if candidate.finish_reason == 4: # SAFETY (4), OTHER (5)
-                            logging.warning(f"Gemini API yanıtı güvenlik nedeniyle engelledi: {candidate.safety_ratings}")
-                            # Engellenen yanıtı atla ve tekrar dene veya hata fırlat
-                            raise Exception(f"Gemini API yanıtı güvenlik nedeniyle engelledi: {candidate.safety_ratings}")
-                
-                # Eğer JSON formatı isteniyorsa, yanıtı JSON olarak ayrıştır
-                if response_format and generation_config.get("response_mime_type") == "application/json":
-                    try:
-                        # Gemini'den gelen yanıtın sadece metin kısmını al ve JSON olarak yükle
-                        return json.loads(response.text)
-                    except json.JSONDecodeError as json_e:
-                        logging.error(f"Gemini'den gelen JSON yanıtı ayrıştırılamadı: {response.text} - Hata: {json_e}")
-                        raise ValueError(f"Geçersiz JSON yanıtı: {response.text[:200]}...") from json_e
-                else:
-                    return response.text # Metin yanıtı dön
+            # the decoding itself is constrained to the schema, whenever Gemini can express it
+            response_schema = GeminiBackend._response_schema(response_format)
+            if response_schema is not None:
+                generation_config["response_schema"] = response_schema
 
-            except Exception as e:
-                logging.error(f"Gemini API çağrısında hata: {type(e).__name__} - {e}")
-                attempt += 1
-                if attempt < self._retries:
-                    import time
-                    time.sleep(self._retry_delay)
+            else:
+                # Gemini'ye JSON formatında yanıt vermesi gerektiğini belirten bir talimat ekle.
+                # Bu talimatı sohbetin ilk mesajına eklemek en etkili yöntemdir.
+                schema_json = json.dumps(response_json_schema(response_format))
+                if gemini_messages:
+                    # İlk mesajın içeriğini al ve başına JSON talimatını ekle
+                    first_msg_content = gemini_messages[0]["parts"][0]["text"]
+                    gemini_messages[0]["parts"][0]["text"] = (
+                        f"Your response MUST be a JSON object conforming to this schema: {schema_json}\n\n"
+                        f"{first_msg_content}"
+                    )
                 else:
-                    raise # Tüm denemeler başarısız olursa hatayı fırlat
+                    # Konuşma boşsa, sadece talimatı içeren bir kullanıcı mesajı ekle
+                    gemini_messages.append({"role": "user", "parts": [{"text": f"Your response MUST be a JSON object conforming to this schema: {schema_json}"}]})
 
-# Global istemci örneği
-_llm_provider_instance = None
-def client():
-    global _llm_provider_instance
-    if _llm_provider_instance is None:
-        _llm_provider_instance = LLMProvider()
-    return _llm_provider_instance
+        if prefix is not None:
+            return prefix.handle, gemini_messages[len(prefix.messages):], generation_config
+        else:
+            return self.model, gemini_messages, generation_config
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _response_schema(response_format):
+        """
+        Returns the Gemini schema of a Pydantic response format, or None if Gemini cannot express it. It is built once per model.
+        """
+        compiled_schema = compile_response_schema(response_format)
+        if compiled_schema is None:
+            return None
+        return genai.protos.Schema(GeminiBackend._gemini_schema_fields(compiled_schema))
+
+    @staticmethod
+    def _gemini_schema_fields(compiled_schema:dict) -> dict:
+        # Gemini names some fields differently, and only knows a few formats
+        fields = {"type_": compiled_schema["type"].upper()}
+        for key in ("description", "enum", "nullable", "required"):
+            if key in compiled_schema:
+                fields[key] = compiled_schema[key]
+        if compiled_schema.get("format") in ("date-time", "enum"):
+            fields["format_"] = compiled_schema["format"]
+        if "properties" in compiled_schema:
+            fields["properties"] = {name: GeminiBackend._gemini_schema_fields(property_schema) 
+                                    for name, property_schema in compiled_schema["properties"].items()}
+        if "items" in compiled_schema:
+            fields["items"] = GeminiBackend._gemini_schema_fields(compiled_schema["items"])
+        return fields
+
+    def _process_response(self, response) -> LLMBackendResponse:
+        """
+        Checks the Gemini response for blocked content, and extracts its text and token usage.
+        """
+        # Prompt veya yanıtın engellenip engellenmediğini kontrol et
+        if response._result.prompt_feedback and response._result.prompt_feedback.block_reason:
+            logging.error(f"Gemini API promptu engelledi: {response._result.prompt_feedback.block_reason}")
+            raise Exception(f"Gemini API promptu engelledi: {response._result.prompt_feedback.block_reason}")
+
+        if response._result.candidates:
+            for candidate in response._result.candidates:
+                if candidate.finish_reason == 4: # SAFETY (4), OTHER (5)
+                    logging.warning(f"Gemini API yanıtı güvenlik nedeniyle engelledi: {candidate.safety_ratings}")
+                    # Engellenen yanıtı atla ve tekrar dene veya hata fırlat
+                    raise Exception(f"Gemini API yanıtı güvenlik nedeniyle engelledi: {candidate.safety_ratings}")
+
+        usage_metadata = getattr(response, "usage_metadata", None)
+        return LLMBackendResponse(response.text,
+                                  input_tokens=getattr(usage_metadata, "prompt_token_count", None),
+                                  output_tokens=getattr(usage_metadata, "candidates_token_count", None),
+                                  cached_input_tokens=getattr(usage_metadata, "cached_content_token_count", None))
+
+
+class MockBackendError(Exception):
+    """
+    A simulated transient failure of the mock backend. It is retried like any other transient error.
+    """
+    pass
+
+
+class MockThrottlingError(MockBackendError):
+    """
+    A simulated throttling (e.g., HTTP 429) of the mock backend, raised when more calls than its capacity are in flight.
+    """
+    pass
+
+
+class MockBackend(LLMBackend):
+    """
+    A local stand-in for the model, which needs neither network nor API keys. It makes it possible to measure the
+    framework's own overhead (memory, transactions, rendering) in isolation, and to run scale tests offline.
+
+    Responses are deterministic for a given request and seed. When a Pydantic model is requested, the response is valid 
+    JSON for its schema. In particular, `CognitiveActionModel` responses follow a THINK, TALK, DONE script after each new 
+    stimulus, and `CognitiveActionsModel` responses carry the rest of that script at once, so that agents' `act` loops 
+    terminate as they would with a real model. Latencies are drawn from a configurable distribution, and a configurable 
+    fraction of the calls fails with `MockBackendError`.
+    """
+
+    model_name = "mock"
+
+    # cached prefixes are emulated: they are checked, and the input tokens they save are reported
+    supports_prefix_caching = True
+
+    LATENCY_DISTRIBUTIONS = ("constant", "uniform", "normal", "lognormal", "exponential")
+
+    # the actions produced in reply to a stimulus, in order; the last one is repeated if the agent keeps acting
+    ACTION_SCRIPT = ("THINK", "TALK", "DONE")
+
+    # how many characters each streamed chunk carries
+    STREAM_CHUNK_SIZE = 16
+
+    def __init__(self, latency_distribution:str=default["mock_latency_distribution"],
+                 latency_mean:float=default["mock_latency_mean"],
+                 latency_stddev:float=default["mock_latency_stddev"],
+                 error_rate:float=default["mock_error_rate"],
+                 seed:int=default["mock_seed"],
+                 capacity:int=default["mock_capacity"]):
+        """
+        Args:
+            latency_distribution (str): One of "constant", "uniform", "normal", "lognormal" or "exponential".
+            latency_mean (float): The mean latency, in seconds.
+            latency_stddev (float): The standard deviation of the latency, in seconds. Ignored by the "constant" and
+              "exponential" distributions.
+            error_rate (float): The fraction of calls, between 0 and 1, that fail.
+            seed (int): The seed of both the latency/error draws and the generated content.
+            capacity (int): How many calls can be in flight at the same time; further calls are throttled right away. 0 means no limit.
+        """
+        if latency_distribution not in MockBackend.LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{latency_distribution}'. Options: {MockBackend.LATENCY_DISTRIBUTIONS}.")
+
+        self.latency_distribution = latency_distribution
+        self.latency_mean = max(0.0, latency_mean)
+        self.latency_stddev = max(0.0, latency_stddev)
+        self.error_rate = error_rate
+        self.seed = seed
+        self.capacity = capacity
+        self._in_flight = 0
+        self.cached_prefixes = {} # handle -> hash of the cached messages, until they are released
+
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+        # response generators for specific schemas, by schema title; other schemas get a generic instance
+        self.response_generators = {"CognitiveActionModel": self._generate_cognitive_action,
+                                    "CognitiveActionsModel": self._generate_cognitive_actions}
+
+    def generate(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        with self._occupied():
+            latency, fails = self._draw_call_outcome()
+            time.sleep(min(latency, timeout) if timeout is not None else latency)
+            return self._respond(messages, response_format, latency, fails, timeout, prefix)
+
+    async def generate_async(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        with self._occupied():
+            latency, fails = self._draw_call_outcome()
+            await asyncio.sleep(min(latency, timeout) if timeout is not None else latency)
+            return self._respond(messages, response_format, latency, fails, timeout, prefix)
+
+    @contextlib.contextmanager
+    def _occupied(self):
+        """
+        Counts a call as in flight while it runs, throttling it if the backend is at capacity.
+        """
+        with self._random_lock:
+            if self.capacity > 0 and self._in_flight >= self.capacity:
+                raise MockThrottlingError(f"The mock backend is at its capacity of {self.capacity} concurrent calls.")
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._random_lock:
+                self._in_flight -= 1
+
+    def generate_stream(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None):
+        with self._occupied():
+            latency, fails = self._draw_call_outcome()
+            if fails or (timeout is not None and latency > timeout):
+                time.sleep(min(latency, timeout) if timeout is not None else latency)
+                self._respond(messages, response_format, latency, fails, timeout, prefix) # raises
+
+            # the latency is spread over the chunks, as if the response was being generated
+            text = self._respond(messages, response_format, latency, fails, timeout, prefix).text
+            chunks = [text[i:i + MockBackend.STREAM_CHUNK_SIZE] for i in range(0, len(text), MockBackend.STREAM_CHUNK_SIZE)]
+            for chunk in chunks:
+                time.sleep(latency / len(chunks))
+                yield chunk
+
+    def cache_prefix(self, messages:list, response_format, ttl:float):
+        with self._random_lock:
+            handle = f"mock-prefix-{uuid.uuid4().hex}"
+            self.cached_prefixes[handle] = MockBackend._prefix_hash(messages)
+        return handle
+
+    def release_prefix(self, handle):
+        with self._random_lock:
+            del self.cached_prefixes[handle]
+
+    @staticmethod
+    def _prefix_hash(messages:list) -> str:
+        return hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _draw_call_outcome(self):
+        """
+        Draws the latency and whether the call fails. Draws are serialized, so that a sequence of calls 
+        is reproducible for a given seed.
+        """
+        with self._random_lock:
+            mean, stddev = self.latency_mean, self.latency_stddev
+
+            if self.latency_distribution == "constant" or mean == 0:
+                latency = mean
+            elif self.latency_distribution == "uniform":
+                latency = self._random.uniform(mean - stddev, mean + stddev)
+            elif self.latency_distribution == "normal":
+                latency = self._random.gauss(mean, stddev)
+            elif self.latency_distribution == "lognormal":
+                # parameters of the underlying normal distribution, so that the latency has the given mean and stddev
+                sigma_squared = math.log(1 + (stddev / mean) ** 2)
+                latency = self._random.lognormvariate(math.log(mean) - sigma_squared / 2, math.sqrt(sigma_squared))
+            else: # exponential
+                latency = self._random.expovariate(1 / mean)
+
+            fails = self._random.random() < self.error_rate
+
+        return max(0.0, latency), fails
+
+    def _respond(self, messages, response_format, latency, fails, timeout, prefix=None) -> LLMBackendResponse:
+        if timeout is not None and latency > timeout:
+            raise TimeoutError(f"Mock backend call timed out after {timeout} seconds.")
+        if fails:
+            raise MockBackendError("Simulated transient failure of the mock backend.")
+        if prefix is not None:
+            with self._random_lock:
+                prefix_hash = self.cached_prefixes.get(prefix.handle)
+            if prefix_hash is None:
+                raise ValueError("The cached prefix does not exist (anymore).")
+            if prefix_hash != MockBackend._prefix_hash(messages[:len(prefix.messages)]):
+                raise ValueError("The messages do not start with the given cached prefix.")
+
+        digest = hashlib.sha256(f"{self.seed}:{json.dumps(messages, sort_keys=True)}".encode("utf-8")).hexdigest()
+        content_random = random.Random(digest)
+
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            response = self._instance(response_json_schema(response_format), messages, content_random)
+
+            # never hand out something the caller could not parse
+            text = response_format.model_validate(response).model_dump_json()
+
+        elif isinstance(response_format, dict) and response_format.get("type") == "json_schema":
+            text = json.dumps(self._instance(response_format["json_schema"]["schema"], messages, content_random))
+
+        elif isinstance(response_format, dict):
+            text = json.dumps({"response": MockBackend._sentence(content_random)})
+
+        else:
+            text = MockBackend._sentence(content_random)
+
+        return LLMBackendResponse(text,
+                                  input_tokens=utils.num_tokens_from_messages(messages),
+                                  output_tokens=len(text) // 4 + 1,
+                                  cached_input_tokens=prefix.tokens if prefix is not None else None)
+
+    def _instance(self, schema:dict, messages:list, content_random:random.Random):
+        generator = self.response_generators.get(schema.get("title"))
+        if generator is not None:
+            return generator(messages, content_random)
+        return self._instance_of_schema(schema, schema.get("$defs", {}), content_random)
+
+    def _generate_cognitive_action(self, messages:list, content_random:random.Random) -> dict:
+        action_type = MockBackend.ACTION_SCRIPT[min(MockBackend._actions_since_stimuli(messages), len(MockBackend.ACTION_SCRIPT) - 1)]
+
+        return {"action": MockBackend._scripted_action(action_type, content_random),
+                "cognitive_state": MockBackend._scripted_cognitive_state()}
+
+    def _generate_cognitive_actions(self, messages:list, content_random:random.Random) -> dict:
+        # the rest of the script, all at once
+        script = MockBackend.ACTION_SCRIPT[min(MockBackend._actions_since_stimuli(messages), len(MockBackend.ACTION_SCRIPT) - 1):]
+
+        return {"actions": [MockBackend._scripted_action(action_type, content_random) for action_type in script],
+                "cognitive_state": MockBackend._scripted_cognitive_state()}
+
+    @staticmethod
+    def _actions_since_stimuli(messages:list) -> int:
+        """
+        How many actions the agent already produced since the latest stimuli.
+        """
+        actions_since_stimuli = 0
+        for message in reversed(messages):
+            content = MockBackend._json_content(message)
+            if message["role"] == "assistant" and "action" in content:
+                actions_since_stimuli += 1
+            elif message["role"] == "user" and ("stimuli" in content or "stimulus" in content):
+                break
+
+        return actions_since_stimuli
+
+    @staticmethod
+    def _scripted_action(action_type:str, content_random:random.Random) -> dict:
+        return {"type": action_type,
+                "content": MockBackend._sentence(content_random) if action_type != "DONE" else "",
+                "target": ""}
+
+    @staticmethod
+    def _scripted_cognitive_state() -> dict:
+        return {"goals": "Take part in the simulation.",
+                "attention": "The latest stimuli.",
+                "emotions": "Calm."}
+
+    def _instance_of_schema(self, schema:dict, definitions:dict, content_random:random.Random):
+        """
+        Builds a value that conforms to the given JSON schema, as produced by Pydantic.
+        """
+        if "$ref" in schema:
+            return self._instance_of_schema(definitions[schema["$ref"].split("/")[-1]], definitions, content_random)
+        if "const" in schema:
+            return schema["const"]
+        if "enum" in schema:
+            return content_random.choice(schema["enum"])
+        if "default" in schema:
+            return schema["default"]
+        for combinator in ("anyOf", "oneOf", "allOf"):
+            if combinator in schema:
+                return self._instance_of_schema(schema[combinator][0], definitions, content_random)
+
+        schema_type = schema.get("type", "string")
+        if schema_type == "object":
+            return {name: self._instance_of_schema(property_schema, definitions, content_random)
+                    for name, property_schema in schema.get("properties", {}).items()}
+        elif schema_type == "array":
+            return [self._instance_of_schema(schema.get("items", {}), definitions, content_random)
+                    for _ in range(max(1, schema.get("minItems", 1)))]
+        elif schema_type == "integer":
+            return content_random.randint(0, 100)
+        elif schema_type == "number":
+            return round(content_random.uniform(0, 1), 4)
+        elif schema_type == "boolean":
+            return content_random.random() < 0.5
+        elif schema_type == "null":
+            return None
+        else:
+            return MockBackend._sentence(content_random)
+
+    @staticmethod
+    def _json_content(message:dict) -> dict:
+        try:
+            content = json.loads(message["content"])
+        except (TypeError, ValueError):
+            return {}
+        return content if isinstance(content, dict) else {}
+
+    @staticmethod
+    def _sentence(content_random:random.Random) -> str:
+        words = ["mock", "simulated", "response", "agent", "idea", "plan", "market", "product", "today", "maybe", "really", "good"]
+        return " ".join(content_random.choice(words) for _ in range(content_random.randint(4, 12))).capitalize() + "."
+
+
+class NoHealthyEndpointError(Exception):
+    """
+    Raised by `PooledBackend` when all of its endpoints are ejected. It is retried like any other transient error.
+    """
+    pass
+
+
+class Endpoint:
+    """
+    One of the equivalent deployments of a `PooledBackend`, with its routing statistics.
+    """
+
+    def __init__(self, name:str, backend:LLMBackend, weight:float=1.0, max_concurrent_requests:int=default["max_concurrent_requests"]):
+        """
+        Args:
+            name (str): Identifies the endpoint, e.g. in logs.
+            backend (LLMBackend): The backend that serves the endpoint's requests.
+            weight (float): The endpoint's relative capacity. An endpoint with twice the weight of another is given about twice
+              as many requests when both are equally fast.
+            max_concurrent_requests (int): How many requests the endpoint can serve at the same time.
+        """
+        if weight <= 0:
+            raise ValueError(f"The weight of endpoint '{name}' must be positive, but {weight} was given.")
+
+        self.name = name
+        self.backend = backend
+        self.weight = weight
+        self.max_concurrent_requests = max_concurrent_requests
+
+        self.outstanding = 0
+        self.latency = None # smoothed latency of successful calls, in seconds
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {"weight": self.weight, "outstanding": self.outstanding, "latency": self.latency, "calls": self.calls, 
+                "failures": self.failures, "ejected": self.ejected_until is not None}
+
+
+class PooledBackend(LLMBackend):
+    """
+    Spreads requests over a pool of equivalent endpoints (e.g., several deployments of the same model, or local proxies),
+    each backed by any registered backend. Each request goes to the endpoint with the lowest expected wait, that is, its
+    outstanding requests times its recent latency, divided by its weight; endpoints at their own concurrency limit are
+    avoided while others have room. A failed request fails over to the next best endpoint. Endpoints that fail several 
+    times in a row are ejected from the pool for a while, after which a single request checks whether they recovered.
+
+    Since prefix handles are specific to one endpoint, pooled requests do not use prefix caching.
+    """
+
+    # how much the latest latency weighs in an endpoint's smoothed latency
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, endpoints:list, failures_to_eject:int=default["pool_failures_to_eject"], ejection_time:float=default["pool_ejection_time"]):
+        """
+        Args:
+            endpoints (list): The `Endpoint`s of the pool.
+            failures_to_eject (int): After how many consecutive failures an endpoint is ejected.
+            ejection_time (float): How long, in seconds, an endpoint stays ejected before it is tried again.
+        """
+        if len(endpoints) == 0:
+            raise ValueError("A pooled backend needs at least one endpoint.")
+        if len({endpoint.name for endpoint in endpoints}) < len(endpoints):
+            raise ValueError(f"The names of the endpoints must be unique, but {[endpoint.name for endpoint in endpoints]} were given.")
+
+        self.endpoints = endpoints
+        self.failures_to_eject = failures_to_eject
+        self.ejection_time = ejection_time
+        self._lock = threading.Lock()
+
+        # the endpoints are equivalent, so responses can be cached regardless of which one produced them
+        self.model_name = ",".join(sorted({str(endpoint.backend.model_name) for endpoint in endpoints}))
+        self.max_concurrent_requests = sum(endpoint.max_concurrent_requests for endpoint in endpoints)
+
+    @classmethod
+    def from_config(cls, endpoint_names:list=None):
+        """
+        Builds the pool from the configuration file: the [Pool] section lists the ENDPOINTS, each configured in an 
+        [Endpoint.<name>] section with its API_TYPE, WEIGHT and MAX_CONCURRENT_REQUESTS. The other options of the section are
+        given to the constructor of the endpoint's backend (e.g., MODEL_NAME for gemini, LATENCY_MEAN for mock).
+        """
+        endpoint_names = endpoint_names if endpoint_names is not None else default["pool_endpoints"]
+        if len(endpoint_names) == 0:
+            raise ValueError("API_TYPE is 'pool', but no endpoints are given in the ENDPOINTS option of the [Pool] section.")
+
+        endpoints = []
+        for name in endpoint_names:
+            section_name = f"Endpoint.{name}"
+            if not config.has_section(section_name):
+                raise ValueError(f"Endpoint '{name}' is listed in the [Pool] section, but there is no [{section_name}] section.")
+
+            options = {key.lower(): value for key, value in config[section_name].items()}
+            api_type = options.pop("api_type", "gemini")
+            if api_type == "pool" or api_type not in _backend_classes:
+                raise ValueError(f"Endpoint '{name}' has an invalid API_TYPE '{api_type}'.")
+            weight = float(options.pop("weight", "1"))
+            max_concurrent_requests = int(options.pop("max_concurrent_requests", str(default["max_concurrent_requests"])))
+
+            backend_class = _backend_classes[api_type]
+            endpoints.append(Endpoint(name, backend_class(**PooledBackend._backend_arguments(backend_class, options)),
+                                      weight=weight, max_concurrent_requests=max_concurrent_requests))
+
+        return cls(endpoints)
+
+    @staticmethod
+    def _backend_arguments(backend_class, options:dict) -> dict:
+        """
+        Converts configuration options, which are strings, to the types of the backend constructor's parameters.
+        """
+        parameters = inspect.signature(backend_class).parameters
+        arguments = {}
+        for key, value in options.items():
+            if key not in parameters:
+                raise ValueError(f"{backend_class.__name__} has no '{key}' parameter.")
+            annotation = parameters[key].annotation
+            if annotation is bool:
+                arguments[key] = value.strip().lower() in ("true", "yes", "on", "1")
+            elif annotation in (int, float):
+                arguments[key] = annotation(value)
+            else:
+                arguments[key] = value
+        return arguments
+
+    def generate(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        tried = set()
+        while True:
+            endpoint = self._acquire_endpoint(tried)
+            start = time.monotonic()
+            try:
+                response = endpoint.backend.generate(messages, response_format, generation_parameters, timeout)
+            except Exception as e:
+                self._release_endpoint(endpoint, error=e)
+                if not self._should_fail_over(e, tried):
+                    raise
+                continue
+
+            self._release_endpoint(endpoint, latency=time.monotonic() - start)
+            return response
+
+    async def generate_async(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        tried = set()
+        while True:
+            endpoint = self._acquire_endpoint(tried)
+            start = time.monotonic()
+            try:
+                response = await endpoint.backend.generate_async(messages, response_format, generation_parameters, timeout)
+            except asyncio.CancelledError:
+                self._release_endpoint(endpoint)
+                raise
+            except Exception as e:
+                self._release_endpoint(endpoint, error=e)
+                if not self._should_fail_over(e, tried):
+                    raise
+                continue
+
+            self._release_endpoint(endpoint, latency=time.monotonic() - start)
+            return response
+
+    def generate_stream(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None):
+        tried = set()
+        while True:
+            endpoint = self._acquire_endpoint(tried)
+            start = time.monotonic()
+            streamed = False
+            try:
+                for chunk in endpoint.backend.generate_stream(messages, response_format, generation_parameters, timeout):
+                    streamed = True
+                    yield chunk
+            except GeneratorExit:
+                self._release_endpoint(endpoint)
+                raise
+            except Exception as e:
+                self._release_endpoint(endpoint, error=e)
+                # once chunks were handed out, the response can't be started over elsewhere
+                if streamed or not self._should_fail_over(e, tried):
+                    raise
+                continue
+
+            self._release_endpoint(endpoint, latency=time.monotonic() - start)
+            return
+
+    def stats(self) -> dict:
+        """
+        Returns the routing statistics of each endpoint, by name.
+        """
+        with self._lock:
+            return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+    def _acquire_endpoint(self, tried:set) -> Endpoint:
+        """
+        Picks the endpoint for a request, among those not tried yet, and counts the request as outstanding there.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = []
+            for endpoint in self.endpoints:
+                if endpoint.name in tried:
+                    continue
+                if endpoint.ejected_until is not None and (endpoint.ejected_until > now or endpoint.probing):
+                    continue
+                candidates.append(endpoint)
+
+            if len(candidates) == 0:
+                raise NoHealthyEndpointError(f"None of the {len(self.endpoints)} endpoints of the pool is available.")
+
+            # endpoints without latency measurements yet are assumed to be as fast as the average one
+            known_latencies = [endpoint.latency for endpoint in self.endpoints if endpoint.latency is not None]
+            typical_latency = sum(known_latencies) / len(known_latencies) if len(known_latencies) > 0 else 1.0
+
+            def expected_wait(endpoint):
+                latency = endpoint.latency if endpoint.latency is not None else typical_latency
+                return ((endpoint.outstanding + 1) * latency / endpoint.weight, endpoint.outstanding)
+
+            with_room = [endpoint for endpoint in candidates if endpoint.outstanding < endpoint.max_concurrent_requests]
+            endpoint = min(with_room if len(with_room) > 0 else candidates, key=expected_wait)
+
+            if endpoint.ejected_until is not None:
+                # the ejection time is over, so this request checks whether the endpoint recovered
+                endpoint.probing = True
+            endpoint.outstanding += 1
+            tried.add(endpoint.name)
+            return endpoint
+
+    def _release_endpoint(self, endpoint:Endpoint, latency:float=None, error:Exception=None):
+        """
+        Records the outcome of a request: a latency if it succeeded, an error if it failed, or neither if it was abandoned.
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if latency is None and error is None:
+                endpoint.probing = False
+                return
+
+            endpoint.calls += 1
+            if error is None:
+                endpoint.latency = latency if endpoint.latency is None else \
+                                   (1 - PooledBackend.LATENCY_SMOOTHING) * endpoint.latency + PooledBackend.LATENCY_SMOOTHING * latency
+                endpoint.consecutive_failures = 0
+                if endpoint.ejected_until is not None:
+                    logger.info(f"Endpoint '{endpoint.name}' recovered; adding it back to the pool.")
+                endpoint.ejected_until = None
+                endpoint.probing = False
+
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.probing or endpoint.consecutive_failures >= self.failures_to_eject:
+                    endpoint.ejected_until = time.monotonic() + self.ejection_time
+                    endpoint.probing = False
+                    logger.warning(f"Endpoint '{endpoint.name}' failed {endpoint.consecutive_failures} times in a row "
+                                   f"({type(error).__name__}); ejecting it from the pool for {self.ejection_time:.1f} seconds.")
+
+    def _should_fail_over(self, error:Exception, tried:set) -> bool:
+        if type(error).__name__ in RetryPolicy.NON_RETRYABLE_ERROR_NAMES:
+            # the request itself is wrong, so other endpoints would reject it too
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            remaining = [endpoint for endpoint in self.endpoints
+                         if endpoint.name not in tried and (endpoint.ejected_until is None or (endpoint.ejected_until <= now and not endpoint.probing))]
+
+        if len(remaining) == 0:
+            return False
+        logger.warning(f"A pooled request failed ({type(error).__name__}: {error}); failing over to another endpoint.")
+        return True
+
+
+class LLMBatchError(Exception):
+    """
+    Raised for a call made in batch mode whose request could not be completed by its batch job.
+    """
+    pass
+
+
+class LocalBatchBackend(LLMBackend):
+    """
+    File-based stand-in for a batch API, for backends that have none, and for testing. Each job is written to an input file 
+    and run by a worker thread through the wrapped backend, which writes all responses to an output file once the job is done.
+    Jobs whose worker was lost, e.g. because the process was restarted, are run again when they are polled.
+
+    Other calls go straight to the wrapped backend.
+    """
+
+    supports_batches = True
+
+    def __init__(self, backend:LLMBackend, directory:str=default["batch_directory"], max_workers:int=8):
+        """
+        Args:
+            backend (LLMBackend): The backend that runs the requests.
+            directory (str): Where the input and output files of the jobs are kept.
+            max_workers (int): How many requests of a job run at the same time.
+        """
+        self.backend = backend
+        self.model_name = backend.model_name
+        self.supports_prefix_caching = backend.supports_prefix_caching
+        self.min_cached_prefix_tokens = backend.min_cached_prefix_tokens
+        self.max_concurrent_requests = backend.max_concurrent_requests
+        self.directory = directory
+        self.max_workers = max_workers
+
+        self._running = set() # ids of the jobs that have a worker in this process
+        self._lock = threading.Lock()
+
+    def generate(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        return self.backend.generate(messages, response_format, generation_parameters, timeout, prefix)
+
+    async def generate_async(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None) -> LLMBackendResponse:
+        return await self.backend.generate_async(messages, response_format, generation_parameters, timeout, prefix)
+
+    def generate_stream(self, messages:list, response_format=None, generation_parameters:dict=None, timeout:float=None, prefix:PromptPrefix=None):
+        return self.backend.generate_stream(messages, response_format, generation_parameters, timeout, prefix)
+
+    def cache_prefix(self, messages:list, response_format, ttl:float):
+        return self.backend.cache_prefix(messages, response_format, ttl)
+
+    def release_prefix(self, handle):
+        self.backend.release_prefix(handle)
+
+    def submit_batch(self, requests:list) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        LocalBatchBackend._write_jsonl(self._path(batch_id, "input"), requests)
+        self._start(batch_id)
+        return batch_id
+
+    def batch_status(self, batch_id:str) -> str:
+        if os.path.exists(self._path(batch_id, "output")):
+            return "completed"
+        if not os.path.exists(self._path(batch_id, "input")):
+            return "failed"
+
+        self._start(batch_id) # in case its worker was lost
+        return "in_progress"
+
+    def batch_results(self, batch_id:str) -> dict:
+        results = {}
+        with open(self._path(batch_id, "output"), "r", encoding="utf-8") as f:
+            for line in f:
+                result = json.loads(line)
+                if "error" in result:
+                    results[result["custom_id"]] = LLMBatchError(result["error"])
+                else:
+                    results[result["custom_id"]] = LLMBackendResponse(result["text"], input_tokens=result.get("input_tokens"),
+                                                                      output_tokens=result.get("output_tokens"))
+        return results
+
+    def _start(self, batch_id:str):
+        with self._lock:
+            if batch_id in self._running:
+                return
+            self._running.add(batch_id)
+        threading.Thread(target=self._run, args=(batch_id,), name=f"tinytroupe-{batch_id}", daemon=True).start()
+
+    def _run(self, batch_id:str):
+        try:
+            with open(self._path(batch_id, "input"), "r", encoding="utf-8") as f:
+                requests = [json.loads(line) for line in f]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(self._run_request, requests))
+
+            # the output appears at once, so that a job is never seen as completed with only part of its results
+            LocalBatchBackend._write_jsonl(self._path(batch_id, "output"), results)
+        except Exception as e:
+            logger.error(f"Local batch job {batch_id} failed: {type(e).__name__} - {e}")
+        finally:
+            with self._lock:
+                self._running.discard(batch_id)
+
+    def _run_request(self, request:dict) -> dict:
+        try:
+            response = self.backend.generate(request["messages"], request["response_format"], request["generation_parameters"])
+            return {"custom_id": request["custom_id"], "text": response.text, 
+                    "input_tokens": response.input_tokens, "output_tokens": response.output_tokens}
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "error": f"{type(e).__name__}: {e}"}
+
+    def _path(self, batch_id:str, kind:str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    @staticmethod
+    def _write_jsonl(path:str, items:list):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+        os.replace(temporary_path, path)
+
+
+###########################################################################
+# Backend registry
+###########################################################################
+_backend_classes = {}
+
+def register_backend(api_type:str, backend_class):
+    """
+    Registers a backend class (or any callable returning an `LLMBackend`) for the given API type, which can then be selected
+    with the API_TYPE configuration or `force_api_type`.
+    """
+    _backend_classes[api_type] = backend_class
+
+def _create_backend(api_type:str) -> LLMBackend:
+    if api_type not in _backend_classes:
+        raise ValueError(f"No backend registered for API type '{api_type}'. Registered API types: {sorted(_backend_classes.keys())}.")
+    return _backend_classes[api_type]()
+
+register_backend("gemini", GeminiBackend)
+register_backend("openai", GeminiBackend) # older configuration files still say "openai", which has always meant Gemini in this package
+register_backend("mock", MockBackend)
+register_backend("pool", PooledBackend.from_config)
+
+
+###########################################################################
+# Telemetry
+###########################################################################
+_call_context = contextvars.ContextVar("tinytroupe_llm_call_context", default={})
+
+@contextlib.contextmanager
+def call_context(call_site:str=None, agent:str=None, simulation_id:str=None, priority:str=None):
+    """
+    Tags the model calls made within the context (in the same thread or asyncio task, or in tasks created from it) with
+    the given call site, agent, simulation id and priority (see `PRIORITIES`). Contexts can be nested, inner values taking 
+    precedence. Calls that are not tagged get, as call site, the function that made them, as simulation id, that of the 
+    current simulation, and the "interactive" priority.
+
+    Example:
+        with openai_utils.call_context(agent=agent.name):
+            openai_utils.client().send_message(messages)
+    """
+    if priority is not None:
+        _priority_level(priority) # fails early on unknown priorities
+
+    tags = {key: value for key, value in (("call_site", call_site), ("agent", agent), ("simulation_id", simulation_id), ("priority", priority))
+            if value is not None}
+    token = _call_context.set({**_call_context.get(), **tags})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+# modules whose functions only relay model calls, and are thus never reported as call sites
+_RELAYING_MODULES = {__name__, "tinytroupe.utils.llm", "tinytroupe.control", "contextlib", "functools"}
+
+# packages that run calls on behalf of others (e.g., asyncio tasks), which are not call sites either
+_RELAYING_PACKAGES = ("asyncio", "concurrent", "threading")
+
+def _infer_call_site() -> str:
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_globals.get("__name__") in _RELAYING_MODULES or 
+                                 str(frame.f_globals.get("__name__")).split(".")[0] in _RELAYING_PACKAGES):
+        frame = frame.f_back
+
+    if frame is None:
+        return None
+    return f"{frame.f_globals.get('__name__')}.{_code_qualname(frame.f_code)}"
+
+def _code_qualname(code) -> str:
+    # qualified names of code objects only exist from Python 3.11 on; before, the plain name is the best there is
+    return getattr(code, "co_qualname", code.co_name)
+
+def _current_simulation_id():
+    from tinytroupe import control # avoids circular import
+
+    simulation = control.current_simulation()
+    return simulation.id if simulation is not None else None
+
+
+class LLMCallRecord:
+    """
+    The telemetry of one client call: where it came from, how long it took and what it cost.
+
+    Attributes:
+        call_site (str): The function that made the call, as module.qualified_name, or the tag given with `call_context`.
+        agent (str): The agent on whose behalf the call was made, if any.
+        simulation_id (str): The simulation during which the call was made, if any.
+        priority (str): The priority of the call (see `PRIORITIES`).
+        api_type (str), model (str): The backend and model that served the call.
+        mode (str): "blocking", "async" or "stream", or "batch" for calls made in batch mode (see `batch_mode`).
+        started_at (float): When the call started, as a Unix timestamp.
+        latency (float): How long the call took, in seconds, including retries.
+        attempts (int): How many backend calls were made (0 if the response came from the cache or another call).
+        input_tokens, output_tokens, cached_input_tokens (int): The token usage reported by the backend, if any.
+        cache (str): "hit" if the response came from the response cache, "coalesced" if it came from an identical call
+          in flight, and "miss" otherwise.
+        concurrency_limit (int): The client's concurrency limit when the call was (last) admitted to the backend.
+        error (str): The error that made the call fail, if it did.
+    """
+
+    FIELDS = ["call_site", "agent", "simulation_id", "priority", "api_type", "model", "mode", "started_at", "latency", "attempts",
+              "input_tokens", "output_tokens", "cached_input_tokens", "cache", "concurrency_limit", "error"]
+
+    def __init__(self, call_site:str, agent:str, simulation_id:str, api_type:str, model:str, mode:str, priority:str="interactive",
+                 concurrency_limit:int=None):
+        self.call_site = call_site
+        self.agent = agent
+        self.simulation_id = simulation_id
+        self.priority = priority
+        self.api_type = api_type
+        self.model = model
+        self.mode = mode
+        self.started_at = time.time()
+        self.latency = None
+        self.attempts = 0
+        self.input_tokens = None
+        self.output_tokens = None
+        self.cached_input_tokens = None
+        self.cache = "miss"
+        self.concurrency_limit = concurrency_limit
+        self.error = None
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+    def record_response(self, response:LLMBackendResponse):
+        self.input_tokens = response.input_tokens
+        self.output_tokens = response.output_tokens
+        self.cached_input_tokens = response.cached_input_tokens
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in LLMCallRecord.FIELDS}
+
+    def __repr__(self):
+        return f"LLMCallRecord({', '.join(f'{field}={getattr(self, field)!r}' for field in LLMCallRecord.FIELDS)})"
+
+
+class LLMTelemetry:
+    """
+    Keeps the records of the latest client calls (see `LLMCallRecord`), which can be queried, summarized and exported.
+    """
+
+    def __init__(self, max_records:int=default["telemetry_max_records"]):
+        """
+        Args:
+            max_records (int): How many of the latest records are kept. 0 disables the telemetry.
+        """
+        self.max_records = max_records
+        self._records = collections.deque(maxlen=max(1, max_records))
+        self._concurrency_limits = collections.deque(maxlen=max(1, max_records))
+        self._lock = threading.Lock()
+
+    def add(self, record:LLMCallRecord):
+        if self.max_records > 0:
+            with self._lock:
+                self._records.append(record)
+
+    def records(self, call_site:str=None, agent:str=None, simulation_id:str=None) -> list:
+        """
+        Returns the records, oldest first, optionally only those with the given call site, agent and/or simulation id.
+        """
+        with self._lock:
+            records = list(self._records)
+
+        return [record for record in records
+                if (call_site is None or record.call_site == call_site) and
+                   (agent is None or record.agent == agent) and
+                   (simulation_id is None or record.simulation_id == simulation_id)]
+
+    def summary(self, by:str="call_site", **filters) -> dict:
+        """
+        Aggregates the records by one of their fields (e.g., "call_site", "agent" or "simulation_id").
+
+        Args:
+            by (str): The field to group the records by.
+            filters: As in `records`.
+
+        Returns:
+            dict: For each value of the field, the number of calls, their total, mean and 95th percentile latency (in seconds), 
+              their total input, output and cached input tokens, and how many retries, cache hits, coalesced calls and errors there were.
+        """
+        groups = collections.defaultdict(list)
+        for record in self.records(**filters):
+            groups[getattr(record, by)].append(record)
+
+        summary = {}
+        for key, records in groups.items():
+            latencies = sorted(record.latency for record in records if record.latency is not None)
+            summary[key] = {"calls": len(records),
+                            "latency_total": sum(latencies),
+                            "latency_mean": sum(latencies) / len(latencies) if len(latencies) > 0 else None,
+                            "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if len(latencies) > 0 else None,
+                            "input_tokens": sum(record.input_tokens or 0 for record in records),
+                            "output_tokens": sum(record.output_tokens or 0 for record in records),
+                            "cached_input_tokens": sum(record.cached_input_tokens or 0 for record in records),
+                            "retries": sum(record.retries for record in records),
+                            "cache_hits": sum(1 for record in records if record.cache == "hit"),
+                            "coalesced": sum(1 for record in records if record.cache == "coalesced"),
+                            "errors": sum(1 for record in records if record.error is not None)}
+        return summary
+
+    def export_jsonl(self, file_path:str, **filters) -> int:
+        """
+        Writes the records, one JSON object per line, to the given file, appending to it if it exists.
+
+        Args:
+            file_path (str): The file to write to.
+            filters: As in `records`.
+
+        Returns:
+            int: How many records were written.
+        """
+        records = self.records(**filters)
+        with open(file_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record.to_dict(), ensure_ascii=False) + "\n")
+        return len(records)
+
+    def record_concurrency_limit(self, limit:int, reason:str):
+        """
+        Records a change of the client's concurrency limit (see `AdaptiveConcurrency`), and why it happened.
+        """
+        if self.max_records > 0:
+            with self._lock:
+                self._concurrency_limits.append({"time": time.time(), "limit": limit, "reason": reason})
+
+    def concurrency_limits(self) -> list:
+        """
+        Returns the history of the client's concurrency limit, oldest first, as dicts with the time (a Unix timestamp) 
+        the limit was set, the limit and the reason.
+        """
+        with self._lock:
+            return list(self._concurrency_limits)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._concurrency_limits.clear()
+
+
+###########################################################################
+# Batch execution
+###########################################################################
+_batch_mode = contextvars.ContextVar("tinytroupe_batch_mode", default=False)
+
+@contextlib.contextmanager
+def batch_mode(enabled:bool=True):
+    """
+    Within this context, model calls are not sent right away, but collected into batch jobs that the backend runs offline
+    (see `LLMBatcher`), which is much cheaper per call, at the price of latency. Each call still blocks until its response
+    arrives, so this is meant for non-interactive jobs that make many calls concurrently, e.g. from several threads or tasks.
+    Threads started with a copy of the current context (e.g., through `contextvars.copy_context`) are in batch mode as well.
+    """
+    token = _batch_mode.set(enabled)
+    try:
+        yield
+    finally:
+        _batch_mode.reset(token)
+
+def batch_mode_enabled() -> bool:
+    """
+    Whether the calls made in the current context go to batch jobs (see `batch_mode`).
+    """
+    return _batch_mode.get()
+
+
+class LLMBatcher:
+    """
+    Collects the calls made in batch mode into batch jobs, submits them to a batch-capable backend, polls the jobs and hands 
+    each caller its response once its job completes. 
+
+    Calls are identified by their request key (as in the response cache), and the jobs submitted are journaled in the batch 
+    directory. Hence, when a run is restarted and makes the same calls again, they are not submitted again: they get the
+    results of the jobs the previous run had submitted, waiting for them if they are still running.
+    """
+
+    JOURNAL_FILE_NAME = "jobs.jsonl"
+
+    def __init__(self, backend:LLMBackend, directory:str=default["batch_directory"], max_requests:int=default["batch_max_requests"],
+                 window:float=default["batch_window"], poll_interval:float=default["batch_poll_interval"]):
+        """
+        Args:
+            backend (LLMBackend): A backend that supports batch jobs.
+            directory (str): Where the journal of the submitted jobs is kept.
+            max_requests (int): The most requests a job takes.
+            window (float): How long, in seconds, calls are collected before they are submitted, unless `max_requests` are pending.
+            poll_interval (float): How often, in seconds, the submitted jobs are polled.
+        """
+        if not backend.supports_batches:
+            raise ValueError(f"{type(backend).__name__} does not support batch jobs; wrap it in a LocalBatchBackend.")
+
+        self.backend = backend
+        self.directory = directory
+        self.max_requests = max_requests
+        self.window = window
+        self.poll_interval = poll_interval
+        self.submitted_jobs = 0
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._futures = {}        # custom id -> future, of the calls waiting for their response
+        self._pending = {}        # custom id -> request, of the calls not yet submitted
+        self._pending_since = None
+        self._jobs = None         # custom id -> id of the job it was submitted with, as journaled; loaded upon the first call
+        self._active_jobs = set() # ids of the jobs being polled
+
+    def submit(self, custom_id:str, messages:list, response_format, generation_parameters:dict) -> concurrent.futures.Future:
+        """
+        Queues a call for the next batch job, unless it was already submitted (by this or a previous run), and returns
+        the future of its `LLMBackendResponse`.
+        """
+        with self._lock:
+            if self._jobs is None:
+                self._jobs = self._read_journal()
+
+            future = self._futures.get(custom_id)
+            if future is None:
+                future = concurrent.futures.Future()
+                self._futures[custom_id] = future
+
+                if custom_id in self._jobs:
+                    logger.info(f"Call {custom_id} was already submitted, with batch job {self._jobs[custom_id]}; waiting for its result.")
+                    self._active_jobs.add(self._jobs[custom_id])
+                else:
+                    self._pending[custom_id] = {"custom_id": custom_id, "messages": messages,
+                                                "response_format": LLMBatcher._serializable_response_format(response_format),
+                                                "generation_parameters": generation_parameters}
+                    if self._pending_since is None:
+                        self._pending_since = time.monotonic()
+
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="tinytroupe-llm-batcher", daemon=True)
+                self._worker.start()
+
+        self._wakeup.set()
+        return future
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        while True:
+            with self._lock:
+                if len(self._pending) == 0 and len(self._active_jobs) == 0:
+                    self._worker = None
+                    return
+
+                now = time.monotonic()
+                requests = []
+                if len(self._pending) >= self.max_requests or (len(self._pending) > 0 and now - self._pending_since >= self.window):
+                    for custom_id in list(self._pending.keys())[:self.max_requests]:
+                        requests.append(self._pending.pop(custom_id))
+                    self._pending_since = now if len(self._pending) > 0 else None
+
+            if len(requests) > 0:
+                self._submit_job(requests)
+
+            if time.monotonic() >= next_poll:
+                self._poll()
+                next_poll = time.monotonic() + self.poll_interval
+
+            with self._lock:
+                waiting_time = next_poll - time.monotonic()
+                if self._pending_since is not None:
+                    waiting_time = min(waiting_time, self._pending_since + self.window - time.monotonic())
+            self._wakeup.wait(max(0.0, waiting_time))
+            self._wakeup.clear()
+
+    def _submit_job(self, requests:list):
+        try:
+            batch_id = self.backend.submit_batch(requests)
+        except Exception as e:
+            logger.error(f"Could not submit a batch job of {len(requests)} calls: {type(e).__name__} - {e}")
+            self._resolve({request["custom_id"]: e for request in requests})
+            return
+
+        custom_ids = [request["custom_id"] for request in requests]
+        self._append_to_journal({"batch_id": batch_id, "custom_ids": custom_ids})
+        logger.info(f"Submitted batch job {batch_id}, with {len(requests)} calls.")
+        with self._lock:
+            self._jobs.update({custom_id: batch_id for custom_id in custom_ids})
+            self._active_jobs.add(batch_id)
+            self.submitted_jobs += 1
+
+    def _poll(self):
+        with self._lock:
+            active_jobs = list(self._active_jobs)
+
+        for batch_id in active_jobs:
+            try:
+                status = self.backend.batch_status(batch_id)
+                results = self.backend.batch_results(batch_id) if status == "completed" else None
+            except Exception as e:
+                logger.warning(f"Could not poll batch job {batch_id}: {type(e).__name__} - {e}")
+                continue
+
+            if status == "in_progress":
+                continue
+
+            with self._lock:
+                self._active_jobs.discard(batch_id)
+                custom_ids = [custom_id for custom_id, job in self._jobs.items() if job == batch_id]
+                if status == "failed":
+                    # the calls are submitted anew the next time they are made
+                    for custom_id in custom_ids:
+                        del self._jobs[custom_id]
+
+            if status == "failed":
+                self._append_to_journal({"batch_id": batch_id, "failed": True})
+                logger.error(f"Batch job {batch_id} failed.")
+                results = {}
+            else:
+                logger.info(f"Batch job {batch_id} completed.")
+
+            self._resolve({custom_id: results.get(custom_id, LLMBatchError(f"Batch job {batch_id} did not complete the call."))
+                           for custom_id in custom_ids})
+
+    def _resolve(self, results:dict):
+        with self._lock:
+            futures = {custom_id: self._futures.pop(custom_id) for custom_id in results if custom_id in self._futures}
+
+        for custom_id, future in futures.items():
+            if isinstance(results[custom_id], Exception):
+                future.set_exception(results[custom_id])
+            else:
+                future.set_result(results[custom_id])
+
+    def _read_journal(self) -> dict:
+        jobs = {}
+        path = os.path.join(self.directory, LLMBatcher.JOURNAL_FILE_NAME)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry.get("failed"):
+                        jobs = {custom_id: batch_id for custom_id, batch_id in jobs.items() if batch_id != entry["batch_id"]}
+                    else:
+                        jobs.update({custom_id: entry["batch_id"] for custom_id in entry["custom_ids"]})
+        return jobs
+
+    def _append_to_journal(self, entry:dict):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LLMBatcher.JOURNAL_FILE_NAME), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    @staticmethod
+    def _serializable_response_format(response_format):
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            return {"type": "json_schema", "json_schema": {"name": response_format.__name__, "schema": response_json_schema(response_format)}}
+        return response_format
+
+
+###########################################################################
+# Client class
+###########################################################################
+class LLMProvider:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        # several threads may ask for the client at once, so the singleton must be created only once
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance._setup_from_config()
+                cls._instance = instance
+        return cls._instance
+
+    def _setup_from_config(self):
+        self.telemetry = LLMTelemetry()
+        self._limiter = ConcurrencyLimiter(default["max_concurrent_requests"])
+        self.adaptive_concurrency = None
+        self.set_api_type(default["api_type"])
+
+        self.timeout = default["timeout"]
+        self.stream_responses = default["stream_responses"]
+        self.coalesce_requests = default["coalesce_requests"]
+        self._in_flight_requests = SingleFlight()
+
+        self.hedge_requests = default["hedge_requests"]
+        self.hedge_percentile = default["hedge_percentile"]
+        self.hedged_requests = 0
+        self._hedging_executor = concurrent.futures.ThreadPoolExecutor(max_workers=256, thread_name_prefix="tinytroupe-llm")
+        self.retry_policy = RetryPolicy()
+        self.rate_limiter = RateLimiter(default["requests_per_minute"], default["tokens_per_minute"])
+
+        self.api_cache = None
+        self.set_api_cache(default["cache_api_calls"], default["cache_file_name"])
+
+        self.prefix_cache = None
+        self.set_prefix_caching(default["prefix_caching"])
+
+    def set_api_type(self, api_type:str):
+        """
+        Switches to the backend registered for the given API type (see `register_backend`). Latency and failure
+        statistics start over, and the concurrency limit becomes the one of the backend, if it has its own (e.g., a pool
+        of endpoints allows as many requests as all of its endpoints together).
+        """
+        self.backend = _create_backend(api_type)
+        self.api_type = api_type
+        self._limiter.set_limit(self.backend.max_concurrent_requests or default["max_concurrent_requests"])
+        self.set_adaptive_concurrency(default["adaptive_concurrency"])
+
+        self.latencies = LatencyTracker()
+        self.circuit_breaker = CircuitBreaker()
+
+        # the calls made in batch mode go to the backend's batch API, or run locally from files if it has none
+        self.batcher = LLMBatcher(self.backend if self.backend.supports_batches else LocalBatchBackend(self.backend))
+
+    def set_max_concurrent_requests(self, max_concurrent_requests:int):
+        """
+        Sets how many requests this client may have in flight at the same time, counting both blocking and async calls.
+        With adaptive concurrency, this is only the starting point.
+        """
+        self._limiter.set_limit(max_concurrent_requests)
+
+    def set_adaptive_concurrency(self, adaptive_concurrency:bool):
+        """
+        Enables or disables the adaptation of the concurrency limit to the backend's throttling, errors and latency 
+        (see `AdaptiveConcurrency`), starting from the current limit. Changes of the limit are recorded in the telemetry.
+        """
+        if adaptive_concurrency:
+            self.adaptive_concurrency = AdaptiveConcurrency(self._limiter, on_change=self.telemetry.record_concurrency_limit)
+            self.telemetry.record_concurrency_limit(self._limiter.limit, "start")
+        else:
+            self.adaptive_concurrency = None
+
+    def set_api_cache(self, cache_api_calls:bool, cache_file_name:str=default["cache_file_name"]):
+        """
+        Enables or disables the persistent cache of model responses.
+
+        Args:
+            cache_api_calls (bool): Whether to cache the responses.
+            cache_file_name (str): The SQLite file where responses are stored.
+        """
+        if self.api_cache is not None:
+            self.api_cache.close()
+
+        if cache_api_calls:
+            self.api_cache = LLMResponseCache(cache_file_name,
+                                              max_entries=default["cache_max_entries"],
+                                              max_size_mb=default["cache_max_size_mb"],
+                                              max_age_days=default["cache_max_age_days"])
+        else:
+            self.api_cache = None
+
+    def api_cache_stats(self) -> dict:
+        """
+        Returns the hit/miss counters and size of the response cache, or None if caching is disabled.
+        """
+        return self.api_cache.stats() if self.api_cache is not None else None
+
+    def set_prefix_caching(self, prefix_caching:bool):
+        """
+        Enables or disables the backend-side caching of stable prompt prefixes (see `PromptPrefixCache`). It only
+        applies to backends that support it.
+        """
+        self.prefix_cache = PromptPrefixCache() if prefix_caching else None
+
+    def coalesced_requests(self) -> int:
+        """
+        Returns how many calls were served by an identical call that was already in flight, rather than by their own.
+        """
+        return self._in_flight_requests.coalesced_calls
+
+    def prefix_cache_stats(self) -> dict:
+        """
+        Returns how many prompt prefixes were cached, how many calls used them and how many input tokens that saved,
+        or None if prefix caching is disabled.
+        """
+        return self.prefix_cache.stats() if self.prefix_cache is not None else None
+
+    def send_message(self, messages, response_format=None, timeout=None, prefix_scope=None,
+                     temperature=None, top_p=None, max_tokens=None, stop=None,
+                     frequency_penalty=None, presence_penalty=None):
+        """
+        Sends a message to the model and blocks until the response arrives. If request coalescing is enabled (see the 
+        COALESCE_REQUESTS configuration) and an identical deterministic call (same messages, format and generation parameters, 
+        with temperature 0) is already in flight, from this or any other thread or task, its response is shared instead of 
+        making another one.
+
+        Args:
+            messages (list): The messages to send, in the OpenAI format (i.e., dicts with "role" and "content").
+            response_format (BaseModel or dict, optional): A Pydantic model the response must conform to, or an 
+              OpenAI-style format such as {"type": "json_object"}. If given, the response content is guaranteed to be valid JSON.
+            timeout (float, optional): The timeout, in seconds, for each attempt. Defaults to the TIMEOUT configuration.
+            prefix_scope (optional): Identifies a sequence of related calls (e.g., those of one agent), whose stable leading messages
+              are cached on the backend side if prefix caching is enabled. If None, no prefix is cached.
+            temperature, top_p, max_tokens, stop, frequency_penalty, presence_penalty (optional): Generation parameters. 
+              If not given, the model's own defaults apply.
+
+        Returns:
+            dict: The response message, with "role" and "content".
+        """
+        generation_parameters = LLMProvider._generation_parameters(temperature=temperature, top_p=top_p, max_tokens=max_tokens, stop=stop,
+                                                                   frequency_penalty=frequency_penalty, presence_penalty=presence_penalty)
+        timeout = timeout if timeout is not None else self.timeout
+
+        with self._recorded_call("blocking") as record:
+            request_key = self._request_key(messages, response_format, generation_parameters)
+            cached_response = self._cached_response(request_key, record)
+            if cached_response is not None:
+                return cached_response
+
+            if not self._coalesces(generation_parameters):
+                return self._send_message(messages, response_format, timeout, prefix_scope, generation_parameters, request_key, record)
+
+            result = self._in_flight_requests.do(request_key, functools.partial(self._send_message, messages, response_format, timeout, 
+                                                                                prefix_scope, generation_parameters, request_key, record))
+            return dict(result)
+
+    def _send_message(self, messages, response_format, timeout, prefix_scope, generation_parameters, request_key, record) -> dict:
+        record.cache = "miss"
+        if batch_mode_enabled():
+            return self._send_batched(messages, response_format, generation_parameters, request_key, record)
+
+        estimated_tokens = utils.num_tokens_from_messages(messages)
+        prefix = self._prefix(prefix_scope, messages, response_format)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            record.attempts = attempt
+            try:
+                logger.info(f"Sending request to the {self.api_type} backend (attempt {attempt}/{self.retry_policy.max_attempts}).")
+                self.rate_limiter.acquire(estimated_tokens, record.priority)
+                self._limiter.acquire(record.priority)
+                record.concurrency_limit = self._limiter.limit
+                with self._guarded_by_circuit_breaker():
+                    response = self._generate(messages, response_format, generation_parameters, timeout, prefix, estimated_tokens)
+
+                self.rate_limiter.record_usage(estimated_tokens, response.total_tokens)
+                record.record_response(response)
+                result = self._process_response(response, response_format, prefix)
+                if self.api_cache is not None:
+                    self.api_cache.put(request_key, result)
+                return result
+
+            except Exception as e:
+                logger.error(f"Error in {self.api_type} backend call: {type(e).__name__} - {e}")
+                prefix = self._drop_prefix(prefix)
+                if not self.retry_policy.should_retry(e, attempt):
+                    raise # Tüm denemeler başarısız olursa hatayı fırlat
+                time.sleep(self.retry_policy.waiting_time_before_retry(attempt))
+
+    async def send_message_async(self, messages, response_format=None, timeout=None, prefix_scope=None,
+                                 temperature=None, top_p=None, max_tokens=None, stop=None,
+                                 frequency_penalty=None, presence_penalty=None):
+        """
+        Async counterpart of `send_message`. Many of these calls can be outstanding at the same time, up to the
+        MAX_CONCURRENT_REQUESTS configuration; further calls wait, without blocking the event loop, for a free slot.
+
+        Args:
+            messages (list): The messages to send, in the OpenAI format (i.e., dicts with "role" and "content").
+            response_format (BaseModel or dict, optional): A Pydantic model the response must conform to, or an 
+              OpenAI-style format such as {"type": "json_object"}. If given, the response content is guaranteed to be valid JSON.
+            timeout (float, optional): The timeout, in seconds, for each attempt. Defaults to the TIMEOUT configuration.
+            prefix_scope (optional): Identifies a sequence of related calls (e.g., those of one agent), whose stable leading messages
+              are cached on the backend side if prefix caching is enabled. If None, no prefix is cached.
+            temperature, top_p, max_tokens, stop, frequency_penalty, presence_penalty (optional): Generation parameters. 
+              If not given, the model's own defaults apply.
+
+        Returns:
+            dict: The response message, with "role" and "content".
+        """
+        generation_parameters = LLMProvider._generation_parameters(temperature=temperature, top_p=top_p, max_tokens=max_tokens, stop=stop,
+                                                                   frequency_penalty=frequency_penalty, presence_penalty=presence_penalty)
+        timeout = timeout if timeout is not None else self.timeout
+
+        with self._recorded_call("async") as record:
+            request_key = self._request_key(messages, response_format, generation_parameters)
+            cached_response = self._cached_response(request_key, record)
+            if cached_response is not None:
+                return cached_response
+
+            if not self._coalesces(generation_parameters):
+                return await self._send_message_async(messages, response_format, timeout, prefix_scope, generation_parameters, request_key, record)
+
+            result = await self._in_flight_requests.do_async(request_key, functools.partial(self._send_message_async, messages, response_format, timeout, 
+                                                                                           prefix_scope, generation_parameters, request_key, record))
+            return dict(result)
+
+    async def _send_message_async(self, messages, response_format, timeout, prefix_scope, generation_parameters, request_key, record) -> dict:
+        record.cache = "miss"
+        if batch_mode_enabled():
+            return await asyncio.wrap_future(self._submit_batched(messages, response_format, generation_parameters, request_key, record))
+
+        estimated_tokens = utils.num_tokens_from_messages(messages)
+        prefix = self._prefix(prefix_scope, messages, response_format)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            record.attempts = attempt
+            try:
+                logger.info(f"Sending async request to the {self.api_type} backend (attempt {attempt}/{self.retry_policy.max_attempts}).")
+                await self.rate_limiter.acquire_async(estimated_tokens, record.priority)
+                await self._limiter.acquire_async(record.priority)
+                record.concurrency_limit = self._limiter.limit
+                with self._guarded_by_circuit_breaker():
+                    response = await self._generate_async(messages, response_format, generation_parameters, timeout, prefix, estimated_tokens)
+
+                self.rate_limiter.record_usage(estimated_tokens, response.total_tokens)
+                record.record_response(response)
+                result = self._process_response(response, response_format, prefix)
+                if self.api_cache is not None:
+                    self.api_cache.put(request_key, result)
+                return result
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in async {self.api_type} backend call: {type(e).__name__} - {e}")
+                prefix = self._drop_prefix(prefix)
+                if not self.retry_policy.should_retry(e, attempt):
+                    raise
+                await asyncio.sleep(self.retry_policy.waiting_time_before_retry(attempt))
+
+    def send_message_stream(self, messages, response_format=None, timeout=None, prefix_scope=None, on_member=None,
+                            temperature=None, top_p=None, max_tokens=None, stop=None,
+                            frequency_penalty=None, presence_penalty=None):
+        """
+        Streaming variant of `send_message`. The response is consumed as it is generated and, if a JSON response was requested,
+        parsed incrementally: `on_member` is called with the name and value of each top-level member of the response object as soon
+        as that member is complete. For example, the `action` of a `CognitiveActionModel` response can be handled while its
+        `cognitive_state` is still being generated.
+
+        Failures are retried as in `send_message`, but only while no member was handed to `on_member` yet, since the caller may
+        have already acted upon it; later failures are raised.
+
+        Args:
+            messages (list): The messages to send, in the OpenAI format (i.e., dicts with "role" and "content").
+            response_format (BaseModel or dict, optional): A Pydantic model the response must conform to, or an
+              OpenAI-style format such as {"type": "json_object"}. If given, the response content is guaranteed to be valid JSON.
+            timeout (float, optional): The timeout, in seconds, for each attempt. Defaults to the TIMEOUT configuration.
+            prefix_scope (optional): As in `send_message`.
+            on_member (callable, optional): Called as on_member(name, value) for each top-level member of a JSON response, in order.
+            temperature, top_p, max_tokens, stop, frequency_penalty, presence_penalty (optional): Generation parameters.
+              If not given, the model's own defaults apply.
+
+        Returns:
+            dict: The complete response message, with "role" and "content".
+        """
+        generation_parameters = LLMProvider._generation_parameters(temperature=temperature, top_p=top_p, max_tokens=max_tokens, stop=stop,
+                                                                   frequency_penalty=frequency_penalty, presence_penalty=presence_penalty)
+        timeout = timeout if timeout is not None else self.timeout
+
+        with self._recorded_call("stream") as record:
+            request_key = self._request_key(messages, response_format, generation_parameters)
+            cached_response = self._cached_response(request_key, record)
+            if cached_response is not None:
+                LLMProvider._replay_members(cached_response, response_format, on_member)
+                return cached_response
+
+            if not self._coalesces(generation_parameters):
+                return self._send_message_stream(messages, response_format, timeout, prefix_scope, on_member, generation_parameters, request_key, record)
+
+            result = self._in_flight_requests.do(request_key, functools.partial(self._send_message_stream, messages, response_format, timeout, prefix_scope, 
+                                                                                on_member, generation_parameters, request_key, record))
+            # the members reach only the caller that actually streams the response; the others get them once it is complete
+            if record.cache == "coalesced":
+                LLMProvider._replay_members(result, response_format, on_member)
+            return dict(result)
+
+    def _send_message_stream(self, messages, response_format, timeout, prefix_scope, on_member, generation_parameters, request_key, record) -> dict:
+        record.cache = "miss"
+        if batch_mode_enabled():
+            # nothing to stream: the members are handed over once the batch job completes
+            result = self._send_batched(messages, response_format, generation_parameters, request_key, record)
+            LLMProvider._replay_members(result, response_format, on_member)
+            return result
+
+        estimated_tokens = utils.num_tokens_from_messages(messages)
+        prefix = self._prefix(prefix_scope, messages, response_format)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            record.attempts = attempt
+            parser = utils.IncrementalJSONParser()
+            try:
+                logger.info(f"Sending streaming request to the {self.api_type} backend (attempt {attempt}/{self.retry_policy.max_attempts}).")
+                self.rate_limiter.acquire(estimated_tokens, record.priority)
+                self._limiter.acquire(record.priority)
+                record.concurrency_limit = self._limiter.limit
+                with self._guarded_by_circuit_breaker():
+                    try:
+                        for chunk in self._monitored(self.backend.generate_stream(messages, response_format, generation_parameters, timeout, prefix)):
+                            completed_members = parser.feed(chunk)
+                            if response_format and on_member is not None:
+                                for name, value in completed_members.items():
+                                    on_member(name, value)
+                    finally:
+                        self._limiter.release()
+
+                # streamed chunks do not carry the token usage, so the rate limiter keeps the estimate
+                response = LLMBackendResponse(parser.text, cached_input_tokens=prefix.tokens if prefix is not None else None)
+                record.record_response(response)
+                result = self._process_response(response, response_format, prefix)
+                if self.api_cache is not None:
+                    self.api_cache.put(request_key, result)
+                return result
+
+            except Exception as e:
+                logger.error(f"Error in streaming {self.api_type} backend call: {type(e).__name__} - {e}")
+                prefix = self._drop_prefix(prefix)
+                if (response_format and on_member is not None and len(parser.members) > 0) or not self.retry_policy.should_retry(e, attempt):
+                    raise
+                time.sleep(self.retry_policy.waiting_time_before_retry(attempt))
+
+    def _send_batched(self, messages, response_format, generation_parameters, request_key, record) -> dict:
+        """
+        Makes a call through a batch job (see `batch_mode`), and blocks until its job completes. Failed calls are not retried, 
+        since the batch job already retries on its side, and a retry would wait for another job.
+        """
+        return self._submit_batched(messages, response_format, generation_parameters, request_key, record).result()
+
+    def _submit_batched(self, messages, response_format, generation_parameters, request_key, record) -> concurrent.futures.Future:
+        record.mode = "batch"
+        record.attempts = 1
+        job = self.batcher.submit(request_key, messages, response_format, generation_parameters)
+
+        # the response is processed as soon as it arrives, so that the blocking and async variants can share this
+        result = concurrent.futures.Future()
+        def on_done(job):
+            try:
+                response = job.result()
+                record.record_response(response)
+                message = self._process_response(response, response_format)
+                if self.api_cache is not None:
+                    self.api_cache.put(request_key, message)
+                result.set_result(message)
+            except Exception as e:
+                result.set_exception(e)
+        job.add_done_callback(on_done)
+        return result
+
+    def _generate(self, messages, response_format, generation_parameters, timeout, prefix, estimated_tokens) -> LLMBackendResponse:
+        """
+        Makes a backend call, for which a concurrency slot was already taken. If hedging is enabled and the call takes longer 
+        than the HEDGE_PERCENTILE of recent calls, a duplicate call is made, if there is spare capacity for it, and the first
+        successful response is used.
+        """
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None:
+            return self._call_backend(messages, response_format, generation_parameters, timeout, prefix)
+
+        primary = self._hedging_executor.submit(self._call_backend, messages, response_format, generation_parameters, timeout, prefix)
+        try:
+            return primary.result(timeout=hedge_delay)
+        except concurrent.futures.TimeoutError:
+            pass
+
+        if not self._take_hedge_slot(estimated_tokens):
+            return primary.result()
+
+        logger.debug(f"The call is taking longer than {hedge_delay:.2f}s; sending a hedge request.")
+        hedge = self._hedging_executor.submit(self._call_backend, messages, response_format, generation_parameters, timeout, prefix)
+
+        # the loser is not interrupted, since blocking calls can't be, but it gives back its slot when it ends
+        pending = {primary, hedge}
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for call in done:
+                if call.exception() is None:
+                    return call.result()
+        return primary.result()
+
+    async def _generate_async(self, messages, response_format, generation_parameters, timeout, prefix, estimated_tokens) -> LLMBackendResponse:
+        """
+        Async counterpart of `_generate`. Here the loser of a hedged call is cancelled.
+        """
+        primary = self._backend_task(messages, response_format, generation_parameters, timeout, prefix)
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None:
+            return await primary
+
+        calls = [primary]
+        try:
+            done, _ = await asyncio.wait(calls, timeout=hedge_delay)
+            if len(done) == 0 and self._take_hedge_slot(estimated_tokens):
+                logger.debug(f"The async call is taking longer than {hedge_delay:.2f}s; sending a hedge request.")
+                calls.append(self._backend_task(messages, response_format, generation_parameters, timeout, prefix))
+
+            pending = set(calls)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    if call.exception() is None:
+                        return call.result()
+            return primary.result()
+
+        finally:
+            for call in calls:
+                if not call.done():
+                    call.cancel()
+
+    def _call_backend(self, messages, response_format, generation_parameters, timeout, prefix) -> LLMBackendResponse:
+        """
+        Makes one backend call, recording its outcome and latency, and gives back its concurrency slot.
+        """
+        start = time.monotonic()
+        in_flight = self._limiter.in_flight
+        try:
+            response = self.backend.generate(messages, response_format, generation_parameters, timeout, prefix)
+        except Exception as e:
+            self._record_backend_failure(e)
+            raise
+        finally:
+            self._limiter.release()
+
+        self._record_backend_success(time.monotonic() - start, in_flight)
+        return response
+
+    def _backend_task(self, messages, response_format, generation_parameters, timeout, prefix) -> asyncio.Task:
+        """
+        Starts an async backend call, for which a concurrency slot was already taken, as a task that gives back the slot 
+        when it ends. The slot is tied to the task rather than to the coroutine, since a task cancelled before it gets to 
+        run never executes any of its coroutine's code, not even a `finally` block.
+        """
+        task = asyncio.ensure_future(self._call_backend_async(messages, response_format, generation_parameters, timeout, prefix))
+        task.add_done_callback(lambda _: self._limiter.release())
+        return task
+
+    async def _call_backend_async(self, messages, response_format, generation_parameters, timeout, prefix) -> LLMBackendResponse:
+        """
+        Async counterpart of `_call_backend`, except that the slot is given back by the task running it (see `_backend_task`).
+        """
+        start = time.monotonic()
+        in_flight = self._limiter.in_flight
+        try:
+            response = await self.backend.generate_async(messages, response_format, generation_parameters, timeout, prefix)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_backend_failure(e)
+            raise
+
+        self._record_backend_success(time.monotonic() - start, in_flight)
+        return response
+
+    @contextlib.contextmanager
+    def _guarded_by_circuit_breaker(self):
+        """
+        Wraps a backend call, for which a concurrency slot was already taken, from the circuit breaker's check until the call 
+        ends, however it ends: a probe that is cancelled or abandoned does not keep the circuit open.
+        """
+        try:
+            probe = self.circuit_breaker.before_call()
+        except CircuitOpenError:
+            self._limiter.release() # the call is not made, so nothing else gives back its slot
+            raise
+
+        try:
+            yield
+        finally:
+            self.circuit_breaker.abandon_probe(probe)
+
+    def _record_backend_success(self, latency:float, in_flight:int):
+        self.circuit_breaker.record_success()
+        self.latencies.record(latency)
+        if self.adaptive_concurrency is not None:
+            self.adaptive_concurrency.record_success(latency, in_flight)
+
+    def _record_backend_failure(self, error:Exception):
+        self.circuit_breaker.record_failure()
+        if self.adaptive_concurrency is not None:
+            self.adaptive_concurrency.record_failure(error)
+
+    def _monitored(self, chunks):
+        """
+        Passes a streamed response through, recording the outcome and latency of the backend call, as `_call_backend` does,
+        once the stream ends. A stream that its consumer abandons records neither.
+        """
+        start = time.monotonic()
+        in_flight = self._limiter.in_flight
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            self._record_backend_failure(e)
+            raise
+
+        self._record_backend_success(time.monotonic() - start, in_flight)
+
+    def _hedge_delay(self) -> float:
+        """
+        How long to wait before hedging a call, or None if calls are not hedged (yet).
+        """
+        if not self.hedge_requests:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    def _take_hedge_slot(self, estimated_tokens:int) -> bool:
+        """
+        Takes a concurrency slot and rate limit budget for a hedge request, only if they are available right away, so 
+        that hedging never delays other requests.
+        """
+        if not self._limiter.try_acquire():
+            return False
+        if not self.rate_limiter.try_acquire(estimated_tokens):
+            self._limiter.release()
+            return False
+
+        self.hedged_requests += 1
+        return True
+
+    @staticmethod
+    def _generation_parameters(**parameters) -> dict:
+        """
+        Keeps only the generation parameters that were actually set.
+        """
+        return {key: value for key, value in parameters.items() if value is not None}
+
+    def _coalesces(self, generation_parameters:dict) -> bool:
+        """
+        Whether a call may share the response of an identical call in flight. Only deterministic (temperature 0) calls do,
+        since otherwise each caller is meant to get its own sample.
+        """
+        return self.coalesce_requests and generation_parameters.get("temperature") == 0
+
+    def _request_key(self, messages, response_format, generation_parameters) -> str:
+        """
+        Computes the key that identifies a call, under which its response is cached and concurrent identical calls are coalesced.
+        """
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            response_schema = response_json_schema(response_format)
+        else:
+            response_schema = response_format
+
+        return LLMResponseCache.compute_key(messages, self.backend.model_name, generation_parameters, response_schema)
+
+    def _cached_response(self, request_key:str, record:LLMCallRecord) -> dict:
+        """
+        Returns the cached response of a call, or None if there is none or caching is disabled.
+        """
+        # until the call is actually made, it's assumed to be served by an identical call in flight
+        record.cache = "coalesced"
+        if self.api_cache is None:
+            return None
+
+        cached_response = self.api_cache.get(request_key)
+        if cached_response is not None:
+            logger.debug(f"Cache hit for model call {request_key}.")
+            record.cache = "hit"
+        return cached_response
+
+    @contextlib.contextmanager
+    def _recorded_call(self, mode:str):
+        """
+        Creates the telemetry record of a call, tagged according to the current `call_context`, and adds it to the telemetry
+        once the call ends.
+        """
+        tags = _call_context.get()
+        record = LLMCallRecord(call_site=tags.get("call_site") or _infer_call_site(),
+                               agent=tags.get("agent"),
+                               simulation_id=tags.get("simulation_id") or _current_simulation_id(),
+                               api_type=self.api_type, model=self.backend.model_name, mode=mode,
+                               priority=tags.get("priority", "interactive"), concurrency_limit=self._limiter.limit)
+        start = time.monotonic()
+        try:
+            yield record
+        except BaseException as e:
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.latency = time.monotonic() - start
+            self.telemetry.add(record)
+
+    @staticmethod
+    def _replay_members(response:dict, response_format, on_member):
+        """
+        Hands the members of an already complete response to `on_member`, as if it had been streamed.
+        """
+        if response_format and on_member is not None:
+            for name, value in json.loads(response["content"]).items():
+                on_member(name, value)
+
+    def _prefix(self, prefix_scope, messages, response_format) -> PromptPrefix:
+        """
+        Returns the cached prompt prefix to use for a call, or None if there is none.
+        """
+        if self.prefix_cache is None:
+            return None
+        return self.prefix_cache.prefix_for(prefix_scope, messages, response_format, self.backend)
+
+    def _drop_prefix(self, prefix:PromptPrefix):
+        """
+        Stops using a prefix after a failed call, since the backend may have dropped it already. Returns None, the prefix 
+        to use when retrying.
+        """
+        if prefix is not None:
+            self.prefix_cache.invalidate(prefix, self.backend)
+        return None
+
+    def _process_response(self, response:LLMBackendResponse, response_format, prefix:PromptPrefix=None) -> dict:
+        """
+        Wraps the backend response into a message. If JSON was requested, checks that the content is valid JSON, and that it
+        conforms to the schema if one was given. Malformed JSON is repaired locally if possible (see `utils.extract_json`), 
+        and otherwise rejected, so that the call is retried.
+        """
+        if prefix is not None:
+            self.prefix_cache.record_usage(response.cached_input_tokens)
+
+        text = response.text
+        if response_format:
+            try:
+                LLMProvider._check_json(text, response_format)
+            except ValueError as e:
+                repairs = []
+                repaired = utils.extract_json(text, repairs)
+                if repaired == {}:
+                    raise
+                
+                text = json.dumps(repaired, ensure_ascii=False)
+                try:
+                    LLMProvider._check_json(text, response_format)
+                except ValueError:
+                    raise e
+                logger.warning(f"The model's response was malformed, and was repaired locally ({', '.join(repairs) or 'surrounding text removed'}).")
+
+        return {"role": "assistant", "content": text}
+
+    @staticmethod
+    def _check_json(text:str, response_format):
+        """
+        Raises a ValueError if the text is not valid JSON or, if a Pydantic model is given, if it does not conform to it.
+        """
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            try:
+                response_format.model_validate_json(text)
+            except ValidationError as validation_e:
+                logger.error(f"The model's response does not conform to {response_format.__name__}: {validation_e}")
+                raise ValueError(f"Response not conforming to {response_format.__name__}: {text[:200]}...") from validation_e
+
+        else:
+            try:
+                json.loads(text)
+            except json.JSONDecodeError as json_e:
+                logging.error(f"Modelden gelen JSON yanıtı ayrıştırılamadı: {text} - Hata: {json_e}")
+                raise ValueError(f"Geçersiz JSON yanıtı: {text[:200]}...") from json_e
+
+
+class AsyncLLMClient:
+    """
+    Awaitable view of an `LLMProvider`, so that async code can use the same `send_message` idiom as blocking code.
+    """
+
+    def __init__(self, provider:LLMProvider):
+        self.provider = provider
+
+    async def send_message(self, messages, response_format=None, timeout=None, **generation_parameters):
+        return await self.provider.send_message_async(messages, response_format=response_format, timeout=timeout, **generation_parameters)
+
+
+###########################################################################
+# Requests
+###########################################################################
+class LLMRequest:
+    """
+    A single request to the model, made of a system prompt and an optional user prompt (given directly or as templates),
+    whose response is converted to the requested output type. 
+    
+    Besides plain text (str), the output can be a verdict: a bool, an int, a float or a member of an Enum. Verdicts are requested
+    as a small structured response whose generation ends as soon as the value is produced, with `max_tokens` capped accordingly,
+    so that checks made at every simulation step take a few tokens instead of a paragraph. A justification and a confidence
+    are only generated if asked for.
+    """
+
+    OUTPUT_TYPES = (str, bool, int, float)
+
+    # the cap on the tokens of a verdict without justification; the structured response ends right after the value
+    VERDICT_MAX_TOKENS = 24
+
+    def __init__(self, system_prompt:str=None, user_prompt:str=None, system_template_name:str=None, user_template_name:str=None,
+                 base_module_folder:str=None, output_type=str, justify:bool=False, **model_params):
+        """
+        Args:
+            system_prompt (str, optional): The system prompt. Either it or `system_template_name` must be given.
+            user_prompt (str, optional): The user prompt.
+            system_template_name (str, optional): The name of a template in the prompts folder, rendered upon each call.
+            user_template_name (str, optional): Idem, for the user prompt.
+            base_module_folder (str, optional): The module whose prompts folder holds the templates, as in 
+              `utils.compose_initial_LLM_messages_with_templates`.
+            output_type (type): str, bool, int, float or an Enum subclass.
+            justify (bool): Whether a verdict comes with a justification and a confidence. Ignored for str outputs.
+            model_params: Generation parameters (temperature, top_p, max_tokens, stop, frequency_penalty, presence_penalty).
+        """
+        if (system_prompt is None) == (system_template_name is None):
+            raise ValueError("Either a system prompt or a system template name must be given, but not both.")
+        if output_type not in LLMRequest.OUTPUT_TYPES and not (isinstance(output_type, type) and issubclass(output_type, enum.Enum)):
+            raise ValueError(f"Unsupported output type {output_type}. Options: str, bool, int, float or an Enum subclass.")
+
+        # the prompts are often written indented in the code; the indentation is only noise to the model
+        self.system_prompt = textwrap.dedent(system_prompt).strip() if system_prompt is not None else None
+        self.user_prompt = textwrap.dedent(user_prompt).strip() if user_prompt is not None else None
+        self.system_template_name = system_template_name
+        self.user_template_name = user_template_name
+        self.base_module_folder = base_module_folder
+        self.output_type = output_type
+        self.justify = justify
+        self.model_params = model_params
+
+        self.messages = None
+        self.response_raw = None
+        self.response_value = None
+        self.response_justification = None
+        self.response_confidence = None
+
+    def __call__(self, **rendering_configs):
+        return self.call(**rendering_configs)
+
+    def call(self, **rendering_configs):
+        """
+        Sends the request and returns its value, converted to the output type. The raw response, justification and confidence,
+        if any, are available afterwards as `response_raw`, `response_justification` and `response_confidence`.
+
+        Args:
+            rendering_configs: The values with which the templates, if any, are rendered.
+        """
+        self.messages = self._messages(rendering_configs)
+        model_params = dict(self.model_params)
+
+        if self.output_type is str:
+            self.response_raw = client().send_message(self.messages, **model_params)["content"]
+            self.response_value = self.response_raw
+            return self.response_value
+
+        response_format = LLMRequest._verdict_model(self.output_type, self.justify)
+        self.messages[0] = {"role": "system", "content": f"{self.messages[0]['content']}\n\n{self._output_instructions()}"}
+        if not self.justify:
+            verdict_max_tokens = self._verdict_max_tokens()
+            model_params["max_tokens"] = min(model_params.get("max_tokens") or verdict_max_tokens, verdict_max_tokens)
+
+        self.response_raw = client().send_message(self.messages, response_format=response_format, **model_params)["content"]
+        verdict = response_format.model_validate_json(self.response_raw)
+        self.response_value = verdict.value
+        self.response_justification = getattr(verdict, "justification", None)
+        self.response_confidence = getattr(verdict, "confidence", None)
+        return self.response_value
+
+    def _messages(self, rendering_configs:dict) -> list:
+        if self.system_template_name is not None:
+            messages = utils.compose_initial_LLM_messages_with_templates(self.system_template_name, self.user_template_name,
+                                                                         base_module_folder=self.base_module_folder,
+                                                                         rendering_configs=rendering_configs)
+        else:
+            messages = [{"role": "system", "content": self.system_prompt}]
+
+        if self.user_prompt is not None:
+            messages.append({"role": "user", "content": self.user_prompt})
+        return messages
+
+    def _output_instructions(self) -> str:
+        if self.output_type is bool:
+            kind = "true or false"
+        elif self.output_type is int:
+            kind = "an integer"
+        elif self.output_type is float:
+            kind = "a number"
+        else:
+            kind = "one of " + ", ".join(json.dumps(member.value) for member in self.output_type)
+
+        if self.justify:
+            return f"Give your answer as the `value` ({kind}), followed by a brief `justification` and your `confidence` in the answer, from 0.0 to 1.0."
+        return f"Give only your answer, as the `value` ({kind}). Do not justify it."
+
+    def _verdict_max_tokens(self) -> int:
+        if isinstance(self.output_type, type) and issubclass(self.output_type, enum.Enum):
+            # the enumerated values may be long words or phrases
+            longest_value = max(utils.num_tokens_from_messages([{"role": "user", "content": str(member.value)}]) for member in self.output_type)
+            return LLMRequest.VERDICT_MAX_TOKENS + longest_value
+        return LLMRequest.VERDICT_MAX_TOKENS
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _verdict_model(output_type, justify:bool):
+        """
+        The response format of a verdict of the given type. The value comes first, so that it is generated before anything else.
+        """
+        fields = {"value": (output_type, ...)}
+        if justify:
+            fields["justification"] = (str, ...)
+            fields["confidence"] = (float, Field(ge=0.0, le=1.0))
+        return create_model("Verdict", **fields)
+
+
+class LLMSession:
+    """
+    A conversation with the model that is kept across calls, for callers whose messages mostly grow by appending (e.g., an
+    agent's system prompt followed by its episodic window). Instead of rebuilding and serializing all messages on every call,
+    only those appended since the previous call are serialized (and their tokens counted). 
+    
+    The backends' APIs are stateless, so the session by itself does not make the requests smaller. They only shrink with 
+    prefix caching (see the PREFIX_CACHING configuration and `PromptPrefixCache`): the conversation is sent with the session 
+    as the prefix scope, so that the backend keeps the part it already received, and each call only transmits what came after
+    it. That requires the conversation to reach the backend's minimum prefix size (e.g., 32768 tokens for Gemini); shorter 
+    ones are sent whole on every call.
+    
+    When the messages change other than by appending (e.g., the window of recent memories moves), the conversation is 
+    resynchronized, i.e., rebuilt from scratch.
+    """
+
+    def __init__(self, scope:str, serialize=None):
+        """
+        Args:
+            scope (str): Identifies the session, e.g. an agent's name. Used as the prefix scope of its calls.
+            serialize (callable, optional): Converts a message, as given to `update`, into the message to send. 
+              By default, messages are sent as given.
+        """
+        self.scope = scope
+        self.serialize = serialize if serialize is not None else (lambda message: message)
+
+        self.resyncs = 0
+        self.serialized_messages = 0
+
+        self._sources = []  # the messages given to the latest update
+        self._messages = [] # the same, serialized
+        self._tokens = 0    # the tokens of the serialized messages
+
+    def update(self, messages:list) -> int:
+        """
+        Brings the conversation up to date with the given messages, which are compared with those of the previous update
+        (by identity, or else by value). If the previous ones are all still there, at the start, only the new ones are 
+        serialized and appended; otherwise the conversation is resynchronized. 
+
+        Returns:
+            int: How many messages were serialized.
+        """
+        kept = 0
+        while kept < min(len(self._sources), len(messages)) and \
+              (self._sources[kept] is messages[kept] or self._sources[kept] == messages[kept]):
+            kept += 1
+
+        if kept < len(self._sources):
+            logger.debug(f"[{self.scope}] The conversation changed other than by appending messages; resynchronizing it.")
+            self.resyncs += 1
+            self.reset()
+            kept = 0
+
+        new_messages = [self.serialize(message) for message in messages[kept:]]
+        self._sources.extend(messages[kept:])
+        self._messages.extend(new_messages)
+        self._tokens += sum(utils.num_tokens_from_message(message) for message in new_messages)
+        self.serialized_messages += len(new_messages)
+        return len(new_messages)
+
+    def reset(self):
+        """
+        Forgets the conversation, so that the next update starts it over.
+        """
+        self._sources = []
+        self._messages = []
+        self._tokens = 0
+
+    def send(self, trailing_messages:list=None, response_format=None, stream:bool=False, on_member=None, **generation_parameters) -> dict:
+        """
+        Sends the conversation, followed by the given trailing messages, which are not kept in it (e.g., a final instruction).
+        The response is not added to the conversation either: callers that want it there include it in their next update.
+
+        Args:
+            trailing_messages (list, optional): Messages to send after the conversation, in the same form as those of `update`.
+            response_format (optional): As in `LLMProvider.send_message`.
+            stream (bool): Whether to use `LLMProvider.send_message_stream`, with the given `on_member`.
+            generation_parameters: As in `LLMProvider.send_message`.
+        """
+        trailing_messages = [self.serialize(message) for message in trailing_messages or []]
+        messages = self._messages + trailing_messages
+
+        # long conversations can outgrow the context window; the running token count tells when, without counting them all again
+        if self._tokens + utils.num_tokens_from_messages(trailing_messages) > utils.max_prompt_tokens():
+            messages = utils.truncate_messages_to_max_tokens(messages)
+
+        if stream:
+            return client().send_message_stream(messages, response_format=response_format, prefix_scope=self.scope, 
+                                                on_member=on_member, **generation_parameters)
+        return client().send_message(messages, response_format=response_format, prefix_scope=self.scope, **generation_parameters)
+
+
+# Global istemci örneği
+_llm_provider_instance = None
+def client():
+    global _llm_provider_instance
+    if _llm_provider_instance is None:
+        _llm_provider_instance = LLMProvider()
+    return _llm_provider_instance
+
+def force_api_type(api_type:str):
+    """
+    Forces the use of the backend registered for the given API type, regardless of the configuration file.
+    If the client was not created yet, the choice applies once it is.
+    """
+    default["api_type"] = api_type
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.set_api_type(api_type)
+
+def force_stream_responses(stream_responses:bool):
+    """
+    Forces the use (or not) of streaming for agents' responses, regardless of the configuration file.
+    If the client was not created yet, the choice applies once it is.
+    """
+    default["stream_responses"] = stream_responses
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.stream_responses = stream_responses
+
+def force_adaptive_concurrency(adaptive_concurrency:bool):
+    """
+    Forces the adaptation (or not) of the concurrency limit, regardless of the configuration file.
+    If the client was not created yet, the choice applies once it is.
+    """
+    default["adaptive_concurrency"] = adaptive_concurrency
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.set_adaptive_concurrency(adaptive_concurrency)
+
+def force_request_coalescing(coalesce_requests:bool):
+    """
+    Forces the coalescing (or not) of concurrent identical calls, regardless of the configuration file. Only calls
+    with temperature 0 are ever coalesced. If the client was not created yet, the choice applies once it is.
+    """
+    default["coalesce_requests"] = coalesce_requests
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.coalesce_requests = coalesce_requests
+
+def force_request_hedging(hedge_requests:bool, hedge_percentile:float=None):
+    """
+    Forces the hedging (or not) of slow requests, regardless of the configuration file. 
+    If the client was not created yet, the choice applies once it is.
+
+    Args:
+        hedge_requests (bool): Whether to hedge slow requests.
+        hedge_percentile (float, optional): The percentile of recent latencies after which a request is hedged.
+          If not given, the current one is kept.
+    """
+    default["hedge_requests"] = hedge_requests
+    if hedge_percentile is not None:
+        default["hedge_percentile"] = hedge_percentile
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.hedge_requests = hedge_requests
+        LLMProvider._instance.hedge_percentile = default["hedge_percentile"]
+
+def force_prefix_caching(prefix_caching:bool):
+    """
+    Forces the use (or not) of backend-side prompt prefix caching, regardless of the configuration file.
+    If the client was not created yet, the choice applies once it is.
+    """
+    default["prefix_caching"] = prefix_caching
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.set_prefix_caching(prefix_caching)
+
+def force_api_cache(cache_api_calls:bool, cache_file_name:str=default["cache_file_name"]):
+    """
+    Forces the use (or not) of the persistent response cache, regardless of the configuration file. 
+    If the client was not created yet, the choice applies once it is.
+    """
+    default["cache_api_calls"] = cache_api_calls
+    default["cache_file_name"] = cache_file_name
+
+    if LLMProvider._instance is not None:
+        LLMProvider._instance.set_api_cache(cache_api_calls, cache_file_name)
+
+async def client_async() -> AsyncLLMClient:
+    """
+    Awaitable variant of `client()`. The underlying provider is the same singleton, but its
+    setup runs in a worker thread, so that the event loop is not blocked.
+    """
+    if _llm_provider_instance is None:
+        provider = await asyncio.to_thread(client)
+    else:
+        provider = _llm_provider_instance
+
+    return AsyncLLMClient(provider)
@@ -1,31 +1,69 @@
-import os
+import re
 import json
-import logging
-import google.generativeai as genai
-from pydantic import BaseModel
-import time # sleep için
+import os
+import copy
 import functools
 import inspect
+import threading
+import collections
+import chevron
+import tiktoken
+from typing import Collection
 
-# Hedef dosyanın tam yolu
-file_path_llm = "/srv/conda/envs/notebook/lib/python3.10/site-packages/tinytroupe/utils/llm.py"
+from tinytroupe.utils import logger
+from tinytroupe.utils.rendering import break_text_at_length
+from tinytroupe.utils.misc import run_concurrently
 
-# Gemini uyumlu yeni llm.py içeriği
-# Bu kısım, orijinal llm.py dosyasının kritik bölümlerini Gemini'ye adapte eder.
-new_content_llm = """
-import functools
-import inspect
-import time
+################################################################################
+# Model input utilities
+################################################################################
+@functools.lru_cache(maxsize=None)
+def _compiled_template(template_path:str) -> tuple:
+    with open(template_path, "r") as f:
+        return tuple(chevron.tokenizer.tokenize(f.read()))
 
-# Doğrudan openai_utils'tan 'client'ı içeri aktarıyoruz (artık Gemini özellikli LLMProvider'ımız)
-from tinytroupe.openai_utils import client 
+def render_template(template_path:str, rendering_configs:dict) -> str:
+    """
+    Renders the Mustache template at the given path. Templates are read and parsed only once per process, 
+    so they should not be modified while it runs.
+    """
+    return chevron.render(_compiled_template(os.path.abspath(template_path)), rendering_configs)
 
-from tinytroupe.utils import logger
-from tinytroupe.utils.rendering import break_text_at_length
+def compose_initial_LLM_messages_with_templates(system_template_name:str, user_template_name:str=None,
+                                                base_module_folder:str=None,
+                                                rendering_configs:dict={}) -> list:
+    """
+    Composes the initial messages for the LLM model call, under the assumption that it always involves
+    a system (overall task description) and an optional user message (specific task description).
+    These messages are composed using the specified templates and rendering configurations.
+    """
+
+    # ../ to go to the base library folder, because that's the most natural reference point for the user
+    if base_module_folder is None:
+        sub_folder = "../prompts/"
+    else:
+        sub_folder = f"../{base_module_folder}/prompts/"
+
+    base_template_folder = os.path.join(os.path.dirname(__file__), sub_folder)
+
+    system_prompt_template_path = os.path.join(base_template_folder, f'{system_template_name}')
+    user_prompt_template_path = os.path.join(base_template_folder, f'{user_template_name}')
+
+    messages = []
+
+    messages.append({"role": "system",
+                     "content": render_template(system_prompt_template_path, rendering_configs)})
 
-MAX_RETRIES = 5
-RETRY_DELAY_SECONDS = 1.0
+    # optionally add a user message
+    if user_template_name is not None:
+        messages.append({"role": "user",
+                         "content": render_template(user_prompt_template_path, rendering_configs)})
+    return messages
 
+
+################################################################################
+# Model call utilities
+################################################################################
 def llm_call_wrapper(func):
     """
     LLM çağrıları için retries ve loglama gibi genel işlemleri yöneten bir dekoratör.
@@ -39,45 +77,31 @@ def llm_call_wrapper(func):
 def _send_chat_completion_request(messages, model=None, temperature=0.7, top_p=1.0, max_tokens=None, stop_sequences=None, response_format=None):
     """
     LLM'e bir chat completion isteği gönderir.
-    Doğrudan değiştirilmiş openai_utils.client().send_message'ı kullanır.
+    Doğrudan openai_utils.client().send_message'ı kullanır.
     """
-    # LLMRequest nesnesi oluşturmuyoruz.
-    # Tüm parametreler doğrudan send_message'a iletilir veya LLMProvider tarafından dahili olarak işlenir.
-    response = client().send_message(
-        messages=messages,
-        response_format=response_format # JSON modu için response_format'ı iletiyoruz
-        # Diğer parametreler (model, temperature, top_p, max_tokens, stop_sequences)
-        # LLMProvider içinde Gemini için yapılandırılır veya genai.GenerativeModel.generate_content
-        # çağrısında örtük olarak işlenir.
-    )
-    return response
+    from tinytroupe import openai_utils # avoids circular import
+
+    return openai_utils.client().send_message(messages,
+                                              response_format=response_format,
+                                              temperature=temperature,
+                                              top_p=top_p,
+                                              max_tokens=max_tokens,
+                                              stop=stop_sequences)
 
 def _llm_request_with_retries(messages, model=None, temperature=0.7, top_p=1.0, max_tokens=None, stop_sequences=None, response_format=None):
     """
-    LLM istekleri için yeniden denemeleri işleyen yardımcı fonksiyon.
-    Bu şimdi Gemini istemcimizi kullanan _send_chat_completion_request'i çağırır.
+    Sends a chat completion request. Retries are not handled here, but by the client's single retry policy
+    (see `openai_utils.RetryPolicy`), which is configured through MAX_ATTEMPTS, WAITING_TIME and EXPONENTIAL_BACKOFF_FACTOR.
     """
-    attempt = 0
-    while attempt < MAX_RETRIES:
-        try:
-            # Doğrudan uyarlanmış _send_chat_completion_request'i çağırın
-            return _send_chat_completion_request(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                top_p=top_p,
-                max_tokens=max_tokens,
-                stop_sequences=stop_sequences,
-                response_format=response_format
-            )
-        except Exception as e:
-            logger.error(f"[{attempt + 1}] Error: {e}")
-            attempt += 1
-            if attempt < MAX_RETRIES:
-                time.sleep(RETRY_DELAY_SECONDS)
-            else:
-                logger.error(f"Failed to get response after {MAX_RETRIES}.0 attempts.")
-                raise
+    return _send_chat_completion_request(
+        messages=messages,
+        model=model,
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        stop_sequences=stop_sequences,
+        response_format=response_format
+    )
 
 def _extract_llm_call_params(llm_call_func, *args, **kwargs):
     """
@@ -91,64 +115,668 @@ def _extract_llm_call_params(llm_call_func, *args, **kwargs):
     params.update(kwargs)
     return params
 
-def num_tokens_from_messages(messages, model="gemini-1.5-flash"): # Model adını Gemini olarak güncelledik
-    """Return the number of tokens in messages."""
-    # Bu fonksiyon genellikle OpenAI modelleri için tiktoken kullanır.
-    # Gemini için token sayımı farklıdır.
-    # Bu fonksiyon kritikse, Gemini'ye özgü bir uygulamaya ihtiyaç duyacaktır.
-    # Şimdilik, olduğu gibi bırakalım, doğrudan Gemini için kullanılmayabilir.
-    # Doğru token sayımı için Google Generative AI SDK'sının kendi token sayma metodunu kullanmak gerekebilir.
-    # Örneğin: model.count_tokens(messages).total_tokens
-    
-    # Basit bir tahmini sayaç bırakalım, zira tiktoken Gemini için doğru sonuç vermez
-    return sum(len(msg['content'].split()) for msg in messages) * 4 # Kaba tahmin
 
-def truncate_messages_to_max_tokens(messages, max_tokens, model="gemini-1.5-flash"):
+# Batches up to this size are packed into a single prompt by the `llm` decorator; larger ones run as concurrent calls.
+LLM_BATCH_PACKING_SIZE = 8
+
+# How many results each function decorated with `llm` memoizes.
+LLM_MEMOIZATION_SIZE = 4096
+
+def llm(memoize:bool=True, pack_batches_up_to:int=LLM_BATCH_PACKING_SIZE, **model_overrides):
     """
-    Bir mesaj listesini maksimum token limiti içinde kalacak şekilde kısaltır.
+    Turns a function into a model call. The function's docstring becomes the instructions, its arguments the input and 
+    the string its body returns, if any, an additional instruction. The response is converted to the function's return
+    annotation (str if there is none), which can be any type Pydantic validates, such as bool, float, list[str] or a model.
+
+    Results are memoized by argument values, and the decorated function gains a `batch` method, which takes a list of
+    keyword-argument dicts and returns the results in the same order. Small batches are packed into a single prompt;
+    larger ones run as concurrent calls.
+
+    Example:
+        @llm(temperature=0.3)
+        def rephrase(observation, rule) -> str:
+            \"\"\"Rephrases the observation so that it complies with the rule.\"\"\"
+
+        rephrase(observation="I'm sad.", rule="I'm always happy.")
+        rephrase.batch([{"observation": o, "rule": rule} for o in observations])
+
+    Args:
+        memoize (bool): Whether to memoize results by argument values.
+        pack_batches_up_to (int): The largest batch that is packed into a single prompt. 0 never packs batches.
+        model_overrides: Generation parameters for the model calls (temperature, top_p, max_tokens, stop, frequency_penalty,
+          presence_penalty).
     """
-    if num_tokens_from_messages(messages, model=model) <= max_tokens:
+    def decorator(func):
+        return _LLMFunction(func, memoize, pack_batches_up_to, model_overrides)
+    return decorator
+
+
+class _LLMFunction:
+    """
+    A function decorated with `llm`.
+    """
+
+    def __init__(self, func, memoize:bool, pack_batches_up_to:int, model_overrides:dict):
+        from pydantic import create_model # avoids slowing down the import of the utilities
+
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.memoize = memoize
+        self.pack_batches_up_to = pack_batches_up_to
+        self.model_overrides = model_overrides
+        self.call_site = f"{func.__module__}.{func.__qualname__}"
+
+        self._signature = inspect.signature(func)
+        return_type = self._signature.return_annotation
+        self.return_type = str if return_type in (inspect.Signature.empty, None) else return_type
+
+        # the responses are wrapped in objects, so that any return type (even a plain string) is structured output
+        self._response_model = create_model(f"{func.__name__}_result", result=(self.return_type, ...))
+        self._batch_response_model = create_model(f"{func.__name__}_results", results=(list[self.return_type], ...))
+
+        self._system_prompt = "You are an AI system that executes a computation as requested, following the specification below.\n\n" + \
+                              (inspect.getdoc(func) or f"Compute {func.__name__}.")
+        self._memo = collections.OrderedDict()
+        self._memo_lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        arguments = self._bind(args, kwargs)
+        key = self._memo_key(arguments)
+        found, result = self._memoized(key)
+        if found:
+            return result
+
+        result = self._call(arguments)
+        self._memorize(key, result)
+        return result
+
+    def batch(self, list_of_kwargs:list) -> list:
+        """
+        Calls the function for each of the given keyword-argument dicts, and returns the results in the same order.
+        Memoized results are reused; the remaining calls are packed into a single prompt if there are at most 
+        `pack_batches_up_to` of them, and made concurrently otherwise.
+        """
+        list_of_arguments = [self._bind((), kwargs) for kwargs in list_of_kwargs]
+        keys = [self._memo_key(arguments) for arguments in list_of_arguments]
+
+        results = [None] * len(keys)
+        pending = {} # key -> indices of the inputs with that key, so that repeated inputs are computed once
+        for i, key in enumerate(keys):
+            found, result = self._memoized(key)
+            if found:
+                results[i] = result
+            else:
+                pending.setdefault(key, []).append(i)
+
+        computed = {}
+        if 1 < len(pending) <= self.pack_batches_up_to:
+            computed = self._call_packed({key: list_of_arguments[indices[0]] for key, indices in pending.items()})
+
+        remaining = [key for key in pending if key not in computed]
+        results_of_remaining = run_concurrently(self._call, [list_of_arguments[pending[key][0]] for key in remaining])
+        computed.update(zip(remaining, results_of_remaining))
+
+        for key, indices in pending.items():
+            self._memorize(key, computed[key])
+            for i in indices:
+                results[i] = computed[key]
+        return results
+
+    def cache_clear(self):
+        """
+        Forgets the memoized results.
+        """
+        with self._memo_lock:
+            self._memo.clear()
+
+    def _bind(self, args, kwargs) -> dict:
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return dict(bound.arguments)
+
+    def _call(self, arguments:dict):
+        messages = [{"role": "system", "content": self._system_prompt},
+                    {"role": "user", "content": self._input_prompt(arguments)}]
+        return self._send(messages, self._response_model).result
+
+    def _call_packed(self, arguments_by_key:dict) -> dict:
+        """
+        Computes several results with a single model call. Returns them by key, or nothing if the call fails or its response
+        does not have as many results as inputs, in which case the caller computes them one by one.
+        """
+        inputs = "\n\n".join(f"## Input {i + 1}\n\n{self._input_prompt(arguments)}" for i, arguments in enumerate(arguments_by_key.values()))
+        messages = [{"role": "system", "content": self._system_prompt},
+                    {"role": "user", "content": f"Execute the computation independently for each of the {len(arguments_by_key)} inputs below, "
+                                                f"and give the results in the same order, one per input.\n\n{inputs}"}]
+        try:
+            results = self._send(messages, self._batch_response_model).results
+        except Exception as e:
+            logger.warning(f"Packed batch of {self.func.__name__} failed ({type(e).__name__} - {e}); computing its results separately.")
+            return {}
+
+        if len(results) != len(arguments_by_key):
+            logger.warning(f"Packed batch of {self.func.__name__} returned {len(results)} results for {len(arguments_by_key)} inputs; computing them separately.")
+            return {}
+        return dict(zip(arguments_by_key.keys(), results))
+
+    def _input_prompt(self, arguments:dict) -> str:
+        prompt = "\n".join(f"- {name}: {value!r}" for name, value in arguments.items())
+        prompt = f"Inputs:\n{prompt}" if prompt != "" else "There are no inputs."
+
+        instruction = self.func(**arguments)
+        if isinstance(instruction, str) and instruction.strip() != "":
+            prompt += f"\n\nInstruction: {instruction.strip()}"
+        return prompt
+
+    def _send(self, messages:list, response_model):
+        from tinytroupe import openai_utils # avoids circular import
+
+        with openai_utils.call_context(call_site=self.call_site):
+            message = openai_utils.client().send_message(messages, response_format=response_model, **self.model_overrides)
+        return response_model.model_validate_json(message["content"])
+
+    def _memo_key(self, arguments:dict) -> str:
+        return json.dumps(arguments, sort_keys=True, default=repr)
+
+    def _memoized(self, key:str):
+        if not self.memoize:
+            return False, None
+        with self._memo_lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return True, self._memo[key]
+        return False, None
+
+    def _memorize(self, key:str, result):
+        if not self.memoize:
+            return
+        with self._memo_lock:
+            self._memo[key] = result
+            self._memo.move_to_end(key)
+            while len(self._memo) > LLM_MEMOIZATION_SIZE:
+                self._memo.popitem(last=False)
+
+
+################################################################################
+# Model output utilities
+################################################################################
+def extract_json(text: str, repairs: list = None) -> dict:
+    """
+    Extracts a JSON object (or array) from a string, ignoring any text before its opening brace and after its end, such as
+    Markdown opening (```json) or closing (```) tags. If the JSON is malformed in a way models commonly produce, it is repaired
+    locally rather than rejected, which spares another model call. Repairs cover trailing commas, single-quoted strings,
+    unescaped newlines and quotes inside strings, invalid escapes, unquoted keys, Python literals and truncated objects.
+
+    Args:
+        text (str): The text containing the JSON.
+        repairs (list, optional): If given, the names of the repairs that were needed are appended to it.
+
+    Returns:
+        dict: The extracted JSON, or {} if there is none or it can't be repaired.
+    """
+    start = _json_start(text)
+    if start is None:
+        return {}
+
+    # fast path: well-formed JSON
+    try:
+        return json.JSONDecoder().raw_decode(text, start)[0]
+    except ValueError:
+        pass
+
+    applied_repairs = []
+    try:
+        repaired_text = _repair_json(text, start, applied_repairs)
+        result = json.loads(repaired_text)
+    except Exception as e:
+        logger.error(f"Error occurred while extracting JSON: {e}")
+        return {}
+
+    logger.debug(f"Repaired malformed JSON ({', '.join(applied_repairs)}).")
+    if repairs is not None:
+        repairs.extend(applied_repairs)
+    return result
+
+def _json_start(text: str):
+    positions = [position for position in (text.find("{"), text.find("[")) if position >= 0]
+    return min(positions) if len(positions) > 0 else None
+
+# after the end of a string, the next significant character must be one of these; otherwise, the quote was part of the string
+_JSON_STRING_FOLLOWERS = ",:}]"
+
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def _repair_json(text: str, start: int, repairs: list) -> str:
+    """
+    Rewrites the JSON that starts at the given position into well-formed JSON, in a single pass, appending the names of the 
+    repairs that were needed. Text after the end of the JSON is ignored.
+    """
+    output = []
+    stack = [] # the open containers, as their closing characters
+    expecting_key = [] # for each open container, whether a key comes next (objects only)
+    quote = None # the character that delimits the current string, if in one
+    i = start
+
+    def note(repair):
+        if repair not in repairs:
+            repairs.append(repair)
+
+    def next_significant(position):
+        while position < len(text) and text[position].isspace():
+            position += 1
+        return text[position] if position < len(text) else None
+
+    while i < len(text):
+        c = text[i]
+
+        if quote is not None:
+            if c == "\\":
+                if i + 1 < len(text) and text[i + 1] in '"\\/bfnrtu':
+                    output.append(text[i:i + 2])
+                elif i + 1 < len(text) and text[i + 1] == "'":
+                    output.append("'")
+                    note("invalid_escapes")
+                else:
+                    output.append("\\\\")
+                    note("invalid_escapes")
+                    i -= 1
+                i += 2
+                continue
+            elif c == quote and (next_significant(i + 1) is None or next_significant(i + 1) in _JSON_STRING_FOLLOWERS):
+                output.append('"')
+                quote = None
+            elif c == '"':
+                output.append('\\"')
+                note("unescaped_quotes" if quote == '"' else "single_quotes")
+            elif c in "\n\r\t":
+                output.append({"\n": "\\n", "\r": "\\r", "\t": "\\t"}[c])
+                note("unescaped_control_characters")
+            else:
+                output.append(c)
+            i += 1
+            continue
+
+        if c in "\"'":
+            if c == "'":
+                note("single_quotes")
+            quote = c
+            output.append('"')
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+            expecting_key.append(c == "{")
+            output.append(c)
+        elif c in "}]":
+            if len(stack) == 0 or c != stack[-1]:
+                raise ValueError(f"Unexpected '{c}' at position {i}.")
+            stack.pop()
+            expecting_key.pop()
+            output.append(c)
+            if len(stack) == 0:
+                return "".join(output)
+        elif c == ",":
+            if next_significant(i + 1) in ("}", "]"):
+                note("trailing_commas")
+            else:
+                output.append(c)
+                if len(stack) > 0 and stack[-1] == "}":
+                    expecting_key[-1] = True
+        elif c == ":":
+            output.append(c)
+            if len(expecting_key) > 0:
+                expecting_key[-1] = False
+        elif c.isalpha():
+            word_end = i
+            while word_end < len(text) and (text[word_end].isalnum() or text[word_end] == "_"):
+                word_end += 1
+            word = text[i:word_end]
+            if word in _PYTHON_LITERALS:
+                output.append(_PYTHON_LITERALS[word])
+                note("python_literals")
+            elif len(expecting_key) > 0 and expecting_key[-1]:
+                output.append(f'"{word}"')
+                note("unquoted_keys")
+            else:
+                output.append(word)
+            i = word_end
+            continue
+        else:
+            output.append(c)
+
+        i += 1
+
+    # the text ended before the JSON did
+    note("truncated")
+    if quote is not None:
+        output.append('"')
+    repaired = "".join(output).rstrip()
+    if repaired.endswith(","):
+        repaired = repaired[:-1]
+    if repaired.endswith(":"):
+        repaired += " null"
+    elif len(stack) > 0 and stack[-1] == "}" and expecting_key[-1] and repaired.endswith('"'):
+        # a key without a value
+        repaired += ": null"
+    return repaired + "".join(reversed(stack))
+
+def extract_code_block(text: str) -> str:
+    """
+    Extracts a code block from a string, ignoring any text before the first
+    opening triple backticks and any text after the closing triple backticks.
+    """
+    try:
+        # remove any text before the first opening triple backticks, using regex. Leave the backticks.
+        text = re.sub(r'^.*?(```)', r'\1', text, flags=re.DOTALL)
+
+        # remove any trailing text after the LAST closing triple backticks, using regex. Leave the backticks.
+        text = re.sub(r'(```)(?!.*```).*$', r'\1', text, flags=re.DOTALL)
+
+        return text
+
+    except Exception:
+        return ""
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON object that arrives in chunks (e.g., a streamed model response), and surfaces each of its
+    top-level members as soon as that member is complete, without waiting for the rest of the object. For example,
+    the `action` of a `CognitiveActionModel` response is available before its `cognitive_state` is generated.
+
+    Any text before the opening brace (e.g., a code block marker) is ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.members = {}
+
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = None # where the text of the current top-level member starts, if one is pending
+        self._done = False
+
+    def feed(self, chunk:str) -> dict:
+        """
+        Adds the next chunk of text, and returns the top-level members it completed (possibly none).
+        """
+        self.text += chunk
+        completed = {}
+
+        while self._position < len(self.text) and not self._done:
+            i = self._position
+            c = self.text[i]
+            self._position += 1
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+
+            elif c == '"':
+                if self._depth > 0:
+                    self._in_string = True
+
+            elif c in "{[":
+                if self._depth == 0 and c != "{":
+                    continue # still before the object
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = i + 1
+
+            elif c in "}]":
+                if self._depth == 0:
+                    continue
+                self._depth -= 1
+                if self._depth == 1:
+                    # a nested object or array just closed, so the member that contains it is complete
+                    self._complete_member(self._member_start, i + 1, completed)
+                    self._member_start = None
+                elif self._depth == 0:
+                    self._complete_member(self._member_start, i, completed)
+                    self._done = True
+
+            elif c == "," and self._depth == 1:
+                self._complete_member(self._member_start, i, completed)
+                self._member_start = i + 1
+
+        return completed
+
+    def _complete_member(self, start:int, end:int, completed:dict):
+        if start is None:
+            return
+
+        member_text = self.text[start:end].strip()
+        if member_text:
+            try:
+                member = json.loads("{" + member_text + "}")
+            except json.JSONDecodeError:
+                logger.debug(f"Could not parse streamed JSON member: {member_text}")
+                return
+
+            self.members.update(member)
+            completed.update(member)
+
+
+################################################################################
+# Model control utilities
+################################################################################
+def repeat_on_error(retries:int, exceptions:list):
+    """
+    Decorator that repeats the specified function call if an exception among those specified occurs,
+    up to the specified number of retries. If that number of retries is exceeded, the
+    exception is raised. If no exception occurs, the function returns normally.
+
+    Args:
+        retries (int): The number of retries to attempt.
+        exceptions (list): The list of exception classes to catch.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for i in range(retries):
+                try:
+                    return func(*args, **kwargs)
+                except tuple(exceptions) as e:
+                    logger.debug(f"Exception occurred: {e}")
+                    if i == retries - 1:
+                        raise e
+                    else:
+                        logger.debug(f"Retrying ({i+1}/{retries})...")
+                        continue
+        return wrapper
+    return decorator
+
+
+################################################################################
+# Prompt engineering
+################################################################################
+def add_rai_template_variables_if_enabled(template_variables: dict) -> dict:
+    """
+    Adds the RAI template variables to the specified dictionary, if the RAI disclaimers are enabled.
+    These can be configured in the config.ini file. If enabled, the variables will then load the RAI disclaimers from the
+    appropriate files in the prompts directory. Otherwise, the variables will be set to None.
+    """
+
+    from tinytroupe import config # avoids circular import
+    rai_harmful_content_prevention = config["Simulation"].getboolean(
+        "RAI_HARMFUL_CONTENT_PREVENTION", True
+    )
+    rai_copyright_infringement_prevention = config["Simulation"].getboolean(
+        "RAI_COPYRIGHT_INFRINGEMENT_PREVENTION", True
+    )
+
+    # Harmful content
+    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_harmful_content_prevention.md"), "r") as f:
+        rai_harmful_content_prevention_content = f.read()
+
+    template_variables['rai_harmful_content_prevention'] = rai_harmful_content_prevention_content if rai_harmful_content_prevention else None
+
+    # Copyright infringement
+    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_copyright_infringement_prevention.md"), "r") as f:
+        rai_copyright_infringement_prevention_content = f.read()
+
+    template_variables['rai_copyright_infringement_prevention'] = rai_copyright_infringement_prevention_content if rai_copyright_infringement_prevention else None
+
+    return template_variables
+
+
+################################################################################
+# Truncation
+################################################################################
+def truncate_actions_or_stimuli(list_of_actions_or_stimuli: Collection[dict], max_content_length: int) -> Collection[str]:
+    """
+    Truncates the content of actions or stimuli at the specified maximum length. Does not modify the original list.
+
+    Args:
+        list_of_actions_or_stimuli (Collection[dict]): The list of actions or stimuli to truncate.
+        max_content_length (int): The maximum length of the content.
+
+    Returns:
+        Collection[str]: The truncated list of actions or stimuli. It is a new list, not a reference to the original list,
+        to avoid unexpected side effects.
+    """
+    cloned_list = copy.deepcopy(list_of_actions_or_stimuli)
+
+    for element in cloned_list:
+        # the external wrapper of the LLM message: {'role': ..., 'content': ...}
+        if "content" in element and isinstance(element["content"], dict):
+            msg_content = element["content"]
+
+            # now the actual action or stimulus content
+
+            # has action, stimuli or stimulus as key?
+            if "action" in msg_content:
+                # is content there?
+                if "content" in msg_content["action"]:
+                    msg_content["action"]["content"] = break_text_at_length(msg_content["action"]["content"], max_content_length)
+            elif "stimulus" in msg_content:
+                # is content there?
+                if "content" in msg_content["stimulus"]:
+                    msg_content["stimulus"]["content"] = break_text_at_length(msg_content["stimulus"]["content"], max_content_length)
+            elif "stimuli" in msg_content:
+                # for each element in the list
+                for stimulus in msg_content["stimuli"]:
+                    # is content there?
+                    if "content" in stimulus:
+                        stimulus["content"] = break_text_at_length(stimulus["content"], max_content_length)
+
+    return cloned_list
+
+# The encoding used to count tokens, when the model's own is unknown to tiktoken (e.g., Gemini models). Counts are then
+# close estimates, which is what budgets need.
+DEFAULT_TOKEN_ENCODING = "o200k_base"
+
+# Every message is wrapped in a few formatting tokens, and every reply is primed with a few more.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+@functools.lru_cache(maxsize=None)
+def _token_encoding(model:str):
+    """
+    Returns the tiktoken encoding of the given model, or None if no encoding can be loaded (e.g., offline, 
+    before tiktoken cached its files), in which case tokens are estimated from the number of characters.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_TOKEN_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load a tokenizer for model {model}, so token counts will be estimated: {e}")
+        return None
+
+@functools.lru_cache(maxsize=16384)
+def _num_tokens_from_text(text:str, model:str) -> int:
+    # memoized, since the same messages (e.g., an agent's system prompt) are counted again on every call
+    encoding = _token_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _message_text(value) -> str:
+    return value if isinstance(value, str) else json.dumps(value)
+
+def num_tokens_from_message(message:dict, model:str="gemini-1.5-flash") -> int:
+    """
+    Returns the number of tokens of a single message, including its formatting overhead.
+    """
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        if key in ("role", "content", "name"):
+            num_tokens += _num_tokens_from_text(_message_text(value), model)
+    return num_tokens
+
+def num_tokens_from_messages(messages:list, model:str="gemini-1.5-flash") -> int:
+    """
+    Returns the number of tokens that the given messages take in a request, including the priming of the reply.
+    """
+    return sum(num_tokens_from_message(message, model=model) for message in messages) + TOKENS_PER_REPLY
+
+def max_tokens_from_messages(messages:list) -> int:
+    """
+    Returns an upper bound of the number of tokens that the given messages take in a request, which is much cheaper to 
+    compute than the actual number, since no text is tokenized: a token is never shorter than a byte of text.
+    """
+    return sum(TOKENS_PER_MESSAGE + sum(len(_message_text(value).encode("utf-8")) + 1 for key, value in message.items() if key in ("role", "content", "name"))
+               for message in messages) + TOKENS_PER_REPLY
+
+def max_prompt_tokens() -> int:
+    """
+    Returns the default token budget of a prompt: the model's context window (MAX_CONTEXT_TOKENS in the configuration) minus 
+    the tokens reserved for the response (MAX_TOKENS).
+    """
+    from tinytroupe import config # avoids circular import
+    return int(config["OpenAI"].get("MAX_CONTEXT_TOKENS", "128000")) - int(config["OpenAI"].get("MAX_TOKENS", "4000"))
+
+def truncate_messages_to_max_tokens(messages:list, max_tokens:int=None, model:str="gemini-1.5-flash") -> list:
+    """
+    Drops the oldest messages until the rest fit in the given token budget. The system message, if the first one, is always 
+    kept. If even the latest message alone does not fit, the beginning of its content is cut. The original messages are not modified.
+
+    Args:
+        messages (list): The messages, in the OpenAI format.
+        max_tokens (int, optional): The token budget. Defaults to the model's context window (MAX_CONTEXT_TOKENS in the 
+          configuration) minus the tokens reserved for the response (MAX_TOKENS).
+        model (str): The model whose tokenizer is used.
+
+    Returns:
+        list: The messages that fit in the budget.
+    """
+    if max_tokens is None:
+        max_tokens = max_prompt_tokens()
+
+    message_tokens = [num_tokens_from_message(message, model=model) for message in messages]
+    total_tokens = sum(message_tokens) + TOKENS_PER_REPLY
+    if total_tokens <= max_tokens:
         return messages
 
-    truncated_messages = []
-    current_tokens = 0
-
-    # Sistem mesajını (varsa) koru
-    if messages and messages[0]['role'] == 'system':
-        truncated_messages.append(messages[0])
-        current_tokens += num_tokens_from_messages([messages[0]], model=model)
-        messages = messages[1:]
-
-    # Maksimum token sayısına ulaşılana kadar son mesajları ekle
-    for i in range(len(messages) - 1, -1, -1):
-        msg = messages[i]
-        msg_tokens = num_tokens_from_messages([msg], model=model)
-        if current_tokens + msg_tokens <= max_tokens:
-            truncated_messages.insert(0, msg) # Başa ekle, çünkü sondan başa doğru okuyoruz
-            current_tokens += msg_tokens
+    first = 1 if len(messages) > 0 and messages[0]["role"] == "system" else 0
+    budget = max_tokens - TOKENS_PER_REPLY - sum(message_tokens[:first])
+
+    # keep the latest messages that fit
+    start = len(messages)
+    while start > first and message_tokens[start - 1] <= budget:
+        budget -= message_tokens[start - 1]
+        start -= 1
+
+    truncated_messages = messages[:first] + messages[start:]
+
+    if start == len(messages) and start > first and budget > TOKENS_PER_MESSAGE:
+        # not even the latest message fits, so only the end of its content is kept
+        latest_message = dict(messages[-1])
+        content = _message_text(latest_message["content"])
+        encoding = _token_encoding(model)
+        content_budget = budget - TOKENS_PER_MESSAGE - _num_tokens_from_text(latest_message["role"], model)
+        if encoding is not None:
+            latest_message["content"] = encoding.decode(encoding.encode(content, disallowed_special=())[-content_budget:]) if content_budget > 0 else ""
         else:
-            break
-    
-    # Hala fazlaysa, en eski sistem dışı mesajın içeriğini kısalt
-    if current_tokens > max_tokens and truncated_messages:
-        for i, msg in enumerate(truncated_messages):
-            if msg['role'] != 'system':
-                estimated_tokens_to_remove = current_tokens - max_tokens
-                chars_to_remove = estimated_tokens_to_remove * 4 # Kaba tahmin
-                if len(msg['content']) > chars_to_remove:
-                    msg['content'] = msg['content'][chars_to_remove:]
-                    logger.warning(f"Mesaj içeriği token limitine uyması için kısaltıldı. Orjinal: {current_tokens}, Hedef: {max_tokens}")
-                    break
+            latest_message["content"] = content[-(content_budget - 1) * 4:] if content_budget > 1 else ""
+        truncated_messages.append(latest_message)
+
+    logger.warning(f"Messages were truncated to fit in {max_tokens} tokens: {total_tokens} tokens in {len(messages)} messages "
+                   f"were reduced to {len(truncated_messages)} messages.")
 
     return truncated_messages
-""" # new_content_llm stringinin sonu
-
-# Dosyayı yazma işlemi
-try:
-    with open(file_path_llm, "w") as f:
-        f.write(new_content_llm)
-    print(f"✅ '{file_path_llm}' dosyası başarıyla Gemini uyumlu hale getirildi!")
-    print("Artık ana kodunuzu deneyebilirsiniz.")
-except Exception as e:
-    print(f"❌ Dosya güncellenirken bir hata oluştu: {e}")
-    print("Lütfen yolun doğru olduğundan ve MyBinder ortamında bu dosyaya yazma izniniz olduğundan emin olun.")
@@ -1,4 +1,6 @@
 import hashlib
+import contextvars
+import concurrent.futures
 from typing import Union
 AgentOrWorld = Union["TinyPerson", "TinyWorld"]
 
@@ -38,3 +40,16 @@ def reset_fresh_id():
     """
     global _fresh_id_counter
     _fresh_id_counter = 0
+
+def run_concurrently(func, items:list, max_workers:int=64) -> list:
+    """
+    Calls the function on each of the items concurrently, and returns the results in the same order. The calls run in 
+    worker threads with a copy of the caller's context, so that settings such as `openai_utils.call_context` or 
+    `openai_utils.batch_mode` apply to them as well.
+    """
+    if len(items) == 0:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(items), max_workers)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+        return [future.result() for future in futures]
@@ -1,6 +1,5 @@
 import os
 import json
-import chevron
 import logging
 
 from tinytroupe import openai_utils
@@ -38,10 +37,7 @@ class TinyPersonValidator:
         
         # Generating the prompt to check the person
         check_person_prompt_template_path = os.path.join(os.path.dirname(__file__), 'prompts/check_person.mustache')
-        with open(check_person_prompt_template_path, 'r') as f:
-            check_agent_prompt_template = f.read()
-        
-        system_prompt = chevron.render(check_agent_prompt_template, {"expectations": expectations})
+        system_prompt = utils.render_template(check_person_prompt_template_path, {"expectations": expectations})
 
         # use dedent
         import textwrap
@@ -66,7 +62,8 @@ class TinyPersonValidator:
         current_messages.append({"role": "system", "content": system_prompt})
         current_messages.append({"role": "user", "content": user_prompt})
 
-        message = openai_utils.client().send_message(current_messages)
+        with openai_utils.call_context(priority="background"):
+            message = openai_utils.client().send_message(current_messages)
 
         # What string to look for to terminate the conversation
         termination_mark = "```json"
@@ -84,7 +81,8 @@ class TinyPersonValidator:
 
             # Appending the responses to the current conversation and checking the next message
             current_messages.append({"role": "user", "content": responses})
-            message = openai_utils.client().send_message(current_messages)
+            with openai_utils.call_context(priority="background"):
+                message = openai_utils.client().send_message(current_messages)
 
         if message is not None:
             json_content = utils.extract_json(message['content'])